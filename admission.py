@@ -0,0 +1,109 @@
+import asyncio
+import threading
+
+# Requests of each class allowed to run at once. Replication traffic between chunk servers has
+# its own class so client writes holding write slots can never starve the forwards they wait on
+DEFAULT_REQUEST_LIMITS = {"read": 64, "write": 32, "replication": 32}
+DEFAULT_QUEUE_LIMITS = {"read": 256, "write": 128, "replication": 128}  # Requests that may wait for a slot
+DEFAULT_QUEUE_TIMEOUT = 1.0  # Seconds a queued request waits before it is turned away
+DEFAULT_RETRY_AFTER = 0.05  # Seconds a busy reply asks the client to wait before trying again
+DEFAULT_MAX_CONNECTIONS = 1024  # Connections served at once in threaded mode, one thread each
+DEFAULT_IDLE_TIMEOUT = 30  # Seconds a threaded-mode connection may wait between requests before it is closed
+DEFAULT_WORKER_THREADS = 64  # Threads running blocking request work in asyncio mode
+
+
+def busy_response(retry_after):
+    return {"status": "busy", "retry_after": retry_after}
+
+
+class AdmissionController:
+    # Bounds the requests running per class. A request over its class limit waits up to
+    # queue_timeout for a slot if the class queue has room, and is rejected otherwise, so an
+    # overloaded server answers quickly instead of piling up threads. Requests with no class
+    # (heartbeats, primary assignments, stats) are always admitted
+    def __init__(self, limits=None, queue_limits=None, queue_timeout=DEFAULT_QUEUE_TIMEOUT):
+        self.limits = dict(DEFAULT_REQUEST_LIMITS, **(limits or {}))
+        self.queue_limits = dict(DEFAULT_QUEUE_LIMITS, **(queue_limits or {}))
+        self.queue_timeout = queue_timeout
+        self.running = {request_class: 0 for request_class in self.limits}
+        self.waiting = {request_class: 0 for request_class in self.limits}
+        self.rejected = {request_class: 0 for request_class in self.limits}
+        self.lock = threading.Lock()
+        self.conditions = {request_class: threading.Condition(self.lock) for request_class in self.limits}
+
+    def admit(self, request_class):
+        if request_class is None:
+            return True
+        condition = self.conditions[request_class]
+        with condition:
+            if self.running[request_class] < self.limits[request_class]:
+                self.running[request_class] += 1
+                return True
+            if self.waiting[request_class] >= self.queue_limits[request_class]:
+                self.rejected[request_class] += 1
+                return False
+            self.waiting[request_class] += 1
+            try:
+                admitted = condition.wait_for(lambda: self.running[request_class] < self.limits[request_class],
+                                              self.queue_timeout)
+            finally:
+                self.waiting[request_class] -= 1
+            if not admitted:
+                self.rejected[request_class] += 1
+                return False
+            self.running[request_class] += 1
+            return True
+
+    def release(self, request_class):
+        if request_class is None:
+            return
+        condition = self.conditions[request_class]
+        with condition:
+            self.running[request_class] -= 1
+            condition.notify()
+
+    def snapshot(self):
+        with self.lock:
+            return {request_class: {"running": self.running[request_class], "waiting": self.waiting[request_class],
+                                    "rejected": self.rejected[request_class]}
+                    for request_class in self.limits}
+
+
+class AsyncAdmissionController(AdmissionController):
+    # The same limits for the asyncio mode, where waiting must not block the event loop. Only
+    # used from the loop thread; create it inside the running loop
+    def __init__(self, limits=None, queue_limits=None, queue_timeout=DEFAULT_QUEUE_TIMEOUT):
+        super().__init__(limits, queue_limits, queue_timeout)
+        self.async_conditions = {request_class: asyncio.Condition() for request_class in self.limits}
+
+    async def admit_async(self, request_class):
+        if request_class is None:
+            return True
+        if self.running[request_class] < self.limits[request_class]:
+            self.running[request_class] += 1
+            return True
+        if self.waiting[request_class] >= self.queue_limits[request_class]:
+            self.rejected[request_class] += 1
+            return False
+        condition = self.async_conditions[request_class]
+        self.waiting[request_class] += 1
+        try:
+            async with condition:
+                await asyncio.wait_for(
+                    condition.wait_for(lambda: self.running[request_class] < self.limits[request_class]),
+                    self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.rejected[request_class] += 1
+            return False
+        finally:
+            self.waiting[request_class] -= 1
+        self.running[request_class] += 1
+        return True
+
+    async def release_async(self, request_class):
+        if request_class is None:
+            return
+        self.running[request_class] -= 1
+        condition = self.async_conditions[request_class]
+        async with condition:
+            condition.notify()
@@ -0,0 +1,251 @@
+import os
+import threading
+from collections import OrderedDict
+from checksum import BlockChecksums, verify_blocks
+from metrics import get_logger
+
+DEFAULT_MAX_OPEN_FILES = 1024
+
+log = get_logger("append_engine")
+
+
+class AppenderClosed(Exception):
+    pass
+
+
+class ChunkAppender:
+    # Keeps one chunk file open and group-commits concurrent appends: the first writer to find
+    # data pending becomes the leader, writes every queued append and syncs once for all of them.
+    # The chunk's block checksums are updated in the same flush. Without create, a missing chunk
+    # raises FileNotFoundError instead of being made empty
+    def __init__(self, path, fsync=True, create=True):
+        self.path = path
+        self.fsync = fsync
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | (os.O_CREAT if create else 0), 0o644)
+        self.checksums = BlockChecksums(path)
+        data_size = os.fstat(self.fd).st_size
+        covered = self.checksums.load(data_size)
+        if covered < data_size:
+            log.warning("Dropping unchecksummed bytes from the end of a chunk", path=path, bytes=data_size - covered)
+            os.ftruncate(self.fd, covered)
+        self.condition = threading.Condition()
+        self.pending = []
+        self.size = covered  # Logical size including queued appends
+        self.durable_size = self.size  # Bytes written (and synced when fsync is on)
+        self.flushing = False
+        self.closed = False
+        self.generation = 0  # Bumped when a flush fails so every append queued with it fails too
+
+    def append(self, data, offset=None):
+        # Returns the offset the data was committed at once it is durable. With an explicit
+        # offset the data must land exactly there: a longer file still holds the tail of a
+        # mutation that was never committed and is cut off first, a shorter one is missing data
+        with self.condition:
+            if self.closed:
+                raise AppenderClosed(self.path)
+            if offset is not None and offset != self.size:
+                if offset > self.size:
+                    raise OSError(f"Write at offset {offset} of {self.path} would leave a gap after byte {self.size}")
+                self.truncate_locked(offset)
+            offset = self.size
+            self.size += len(data)
+            self.pending.append(data)
+            target = self.size
+            generation = self.generation
+            while self.durable_size < target:
+                if self.generation != generation:
+                    raise OSError(f"Append to {self.path} failed in a batched flush")
+                if self.flushing:
+                    self.condition.wait()
+                    continue
+                self.flush_locked()
+            return offset
+
+    def flush_locked(self):
+        # Called with the condition held; drops it while writing so new appends keep queueing
+        self.flushing = True
+        batch, self.pending = self.pending, []
+        batch_end = self.size
+        self.condition.release()
+        try:
+            data = b"".join(batch)
+            # Only the leader touches the checksums outside the lock, so this is safe to compute here
+            first_block, checksums = self.checksums.extend(data)
+            written = 0
+            while written < len(data):
+                written += os.write(self.fd, data[written:])
+            self.checksums.persist(first_block, checksums, batch_end)
+            if self.fsync:
+                os.fdatasync(self.fd)
+                self.checksums.sync()
+        except OSError:
+            self.condition.acquire()
+            # Nothing past the last durable byte can be trusted; fail everything queued and
+            # let later appends start from there
+            os.ftruncate(self.fd, self.durable_size)
+            self.checksums.truncate(self.durable_size)
+            self.pending = []
+            self.size = self.durable_size
+            self.generation += 1
+            self.flushing = False
+            self.condition.notify_all()
+            raise
+        self.condition.acquire()
+        self.checksums.apply(first_block, checksums, batch_end)
+        self.durable_size = batch_end
+        self.flushing = False
+        self.condition.notify_all()
+
+    def truncate_locked(self, size):
+        while self.flushing:
+            self.condition.wait()
+        if self.pending:
+            self.flush_locked()
+        if size < self.size:
+            os.ftruncate(self.fd, size)
+            self.checksums.truncate(size)
+            if self.fsync:
+                os.fdatasync(self.fd)
+                self.checksums.sync()
+            self.size = self.durable_size = size
+
+    def truncate(self, size):
+        with self.condition:
+            if self.closed:
+                raise AppenderClosed(self.path)
+            self.truncate_locked(size)
+
+    def verify(self, offset, length):
+        # Check only the blocks the range touches. The data is read outside the lock, so a
+        # mismatch is confirmed under it in case a rollback truncated the chunk meanwhile
+        with self.condition:
+            snapshot = self.checksums.snapshot(offset, length)
+        if verify_blocks(self.path, *snapshot) is None:
+            return True
+        with self.condition:
+            return verify_blocks(self.path, *self.checksums.snapshot(offset, length)) is None
+
+    def idle(self):
+        return not self.pending and not self.flushing
+
+    def close(self):
+        with self.condition:
+            while self.flushing:
+                self.condition.wait()
+            if self.pending:
+                self.flush_locked()
+            self.closed = True
+            os.close(self.fd)
+            self.checksums.close()
+
+
+class AppendEngine:
+    # Open appenders per chunk path, closing the least recently used idle ones past max_open_files
+    def __init__(self, fsync=True, max_open_files=DEFAULT_MAX_OPEN_FILES):
+        self.fsync = fsync
+        self.max_open_files = max_open_files
+        self.appenders = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, path, create=True):
+        with self.lock:
+            appender = self.appenders.get(path)
+            if appender is None:
+                appender = ChunkAppender(path, self.fsync, create)
+                self.appenders[path] = appender
+                self.evict_locked()
+            else:
+                self.appenders.move_to_end(path)
+            return appender
+
+    def evict_locked(self):
+        for path in list(self.appenders):
+            if len(self.appenders) <= self.max_open_files:
+                break
+            appender = self.appenders[path]
+            if appender.idle():
+                del self.appenders[path]
+                appender.close()
+
+    def append(self, path, data, offset=None):
+        while True:
+            try:
+                return self.get(path).append(data, offset)
+            except AppenderClosed:
+                # Evicted between lookup and append; reopen and try again
+                continue
+
+    def truncate(self, path, size):
+        # Rolling back a mutation is a single truncate to the offset it started at
+        while True:
+            try:
+                return self.get(path).truncate(size)
+            except AppenderClosed:
+                continue
+
+    def verify(self, path, offset, length):
+        # True if the blocks holding [offset, offset + length) match their checksums. Checking
+        # never creates the chunk: one that is gone, e.g. compressed or deleted meanwhile, raises
+        # FileNotFoundError
+        while True:
+            try:
+                return self.get(path, create=False).verify(offset, length)
+            except AppenderClosed:
+                continue
+
+    def discard(self, path):
+        # Close the appender of a chunk that is about to be deleted
+        with self.lock:
+            appender = self.appenders.pop(path, None)
+        if appender is not None:
+            appender.close()
+
+    def size(self, path):
+        # Logical size including appends still queued for the next flush
+        with self.lock:
+            appender = self.appenders.get(path)
+        if appender is not None and not appender.closed:
+            return appender.size
+        return os.path.getsize(path) if os.path.exists(path) else 0
+
+    def close(self):
+        with self.lock:
+            for appender in self.appenders.values():
+                appender.close()
+            self.appenders.clear()
+
+
+class MutationBatcher:
+    # Serializes mutations to one chunk while still batching them: callers queue records, and
+    # whichever caller finds no batch in progress applies everything queued as one mutation
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.queue = []
+        self.busy = False
+
+    def submit(self, record, apply_batch):
+        # apply_batch takes a list of records and returns one result per record
+        entry = {"record": record, "done": False, "result": None}
+        with self.condition:
+            self.queue.append(entry)
+            while not entry["done"]:
+                if self.busy:
+                    self.condition.wait()
+                    continue
+                self.busy = True
+                batch, self.queue = self.queue, []
+                self.condition.release()
+                try:
+                    results = apply_batch([queued["record"] for queued in batch])
+                except Exception as e:
+                    results = [e] * len(batch)
+                finally:
+                    self.condition.acquire()
+                    self.busy = False
+                    self.condition.notify_all()
+                for queued, result in zip(batch, results):
+                    queued["result"] = result
+                    queued["done"] = True
+        if isinstance(entry["result"], Exception):
+            raise entry["result"]
+        return entry["result"]
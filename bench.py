@@ -0,0 +1,272 @@
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from client import Client
+
+REPO_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+WORKLOADS = ["sequential-read", "random-read", "small-append", "large-append", "mixed"]
+DEFAULT_DURATION = 10  # Seconds each workload runs
+DEFAULT_CLIENTS = 4
+DEFAULT_DATASET_BYTES = 32 * 1024 * 1024  # Size of the file the read workloads read from
+DEFAULT_READ_SIZE = 64 * 1024
+DEFAULT_SMALL_APPEND_SIZE = 4 * 1024
+DEFAULT_LARGE_APPEND_SIZE = 1024 * 1024
+DEFAULT_READ_FRACTION = 0.8  # Share of reads in the mixed workload; the rest are small appends
+STARTUP_TIMEOUT = 30  # Seconds to wait for the cluster to accept connections
+DATA_FILE = "bench-data"
+LOG_FILE = "bench-log"
+
+
+def find_free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(address, port, deadline):
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((address, port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Nothing listening on {address}:{port} after {STARTUP_TIMEOUT}s")
+
+
+class LocalCluster:
+    # The master and every chunk server from the config, each in its own process, on free
+    # localhost ports and with all storage in a temporary directory
+    def __init__(self, config_file, overrides=None, keep=False):
+        with open(config_file, 'r') as f:
+            self.config = json.load(f)
+        self.config.update(overrides or {})
+        self.config["master_server"] = {"address": "127.0.0.1", "port": find_free_port()}
+        for server in self.config["chunk_servers"]:
+            server["address"] = "127.0.0.1"
+            server["port"] = find_free_port()
+        self.keep = keep  # Leave the directory and logs behind for inspection
+        self.directory = None
+        self.config_path = None
+        self.processes = []
+
+    def start(self):
+        self.directory = tempfile.mkdtemp(prefix="gfs-bench-")
+        self.config_path = os.path.join(self.directory, "mserver_config.json")
+        with open(self.config_path, 'w') as f:
+            json.dump(self.config, f, indent=2)
+        for server in self.config["chunk_servers"]:
+            self.launch(server["name"], [os.path.join(REPO_DIRECTORY, "server.py"), server["name"]])
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        for server in self.config["chunk_servers"]:
+            wait_for_port(server["address"], server["port"], deadline)
+        self.launch("master", [os.path.join(REPO_DIRECTORY, "mserver.py")])
+        wait_for_port(self.config["master_server"]["address"], self.config["master_server"]["port"], deadline)
+        print(f"Cluster running in {self.directory}", file=sys.stderr)
+
+    def launch(self, name, command):
+        env = dict(os.environ, PYTHONPATH=REPO_DIRECTORY)
+        with open(os.path.join(self.directory, f"{name}.log"), 'w') as log:
+            self.processes.append(subprocess.Popen([sys.executable, "-u"] + command, cwd=self.directory, env=env,
+                                                   stdout=log, stderr=subprocess.STDOUT))
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        self.processes = []
+        if self.directory and not self.keep:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def percentile(sorted_values, fraction):
+    # Nearest-rank percentile of an already sorted list
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, max(0, math.ceil(fraction * len(sorted_values)) - 1))]
+
+
+def summarize_latencies(latencies):
+    latencies = sorted(latencies)
+    if not latencies:
+        return {"count": 0}
+    return {
+        "count": len(latencies),
+        "mean": sum(latencies) / len(latencies) * 1000,
+        "p50": percentile(latencies, 0.5) * 1000,
+        "p99": percentile(latencies, 0.99) * 1000,
+        "p999": percentile(latencies, 0.999) * 1000,
+        "max": latencies[-1] * 1000,
+    }
+
+
+def populate(config_path, dataset_bytes, chunk_size):
+    # Write the file the read workloads use, one record at a time so no record outgrows a chunk
+    record_size = min(1024 * 1024, chunk_size // 4)
+    block = os.urandom(record_size)
+    client = Client(config_path)
+    for offset in range(0, dataset_bytes, record_size):
+        if not client.write_file(DATA_FILE, block[:min(record_size, dataset_bytes - offset)]):
+            raise RuntimeError(f"Could not write {DATA_FILE} at offset {offset}")
+
+
+def run_client(index, workload, options, config_path):
+    # One benchmark client: issues operations back to back until the duration is up and
+    # returns the latency of each, by operation type
+    client = Client(config_path)
+    rng = random.Random(index)
+    dataset_bytes = options["dataset_bytes"]
+    read_size = options["read_size"]
+    position = index * dataset_bytes // options["clients"] // read_size * read_size
+    small = os.urandom(options["small_append_size"])
+    large = os.urandom(options["large_append_size"])
+    latencies = {"read": [], "append": []}
+    errors = 0
+    transferred = 0
+    deadline = time.monotonic() + options["duration"]
+    while time.monotonic() < deadline:
+        if workload == "sequential-read":
+            operation, offset = "read", position
+            position = (position + read_size) % (dataset_bytes - read_size + 1)
+        elif workload == "random-read" or (workload == "mixed" and rng.random() < options["read_fraction"]):
+            operation, offset = "read", rng.randrange(0, dataset_bytes - read_size + 1)
+        else:
+            operation = "append"
+        started = time.perf_counter()
+        if operation == "read":
+            data = client.read(DATA_FILE, offset, read_size)
+            ok = data is not None and len(data) == read_size
+            size = read_size
+        else:
+            data = large if workload == "large-append" else small
+            ok = client.write_file(LOG_FILE, data)
+            size = len(data)
+        elapsed = time.perf_counter() - started
+        if ok:
+            latencies[operation].append(elapsed)
+            transferred += size
+        else:
+            errors += 1
+    return {"latencies": latencies, "errors": errors, "bytes": transferred}
+
+
+def run_workload(workload, options, config_path):
+    started = time.monotonic()
+    with multiprocessing.Pool(options["clients"]) as pool:
+        results = pool.starmap(run_client, [(index, workload, options, config_path)
+                                            for index in range(options["clients"])])
+    elapsed = time.monotonic() - started
+    latencies = {"read": [], "append": []}
+    for result in results:
+        for operation, values in result["latencies"].items():
+            latencies[operation].extend(values)
+    operations = sum(len(values) for values in latencies.values())
+    transferred = sum(result["bytes"] for result in results)
+    return {
+        "workload": workload,
+        "clients": options["clients"],
+        "elapsed": elapsed,
+        "operations": operations,
+        "errors": sum(result["errors"] for result in results),
+        "ops_per_second": operations / elapsed,
+        "mb_per_second": transferred / elapsed / (1024 * 1024),
+        "latency_ms": {operation: summarize_latencies(values)
+                       for operation, values in latencies.items() if values},
+    }
+
+
+def parse_overrides(settings):
+    # "key=value" pairs for the cluster config; values are JSON where they parse as JSON
+    overrides = {}
+    for setting in settings:
+        key, _, value = setting.partition("=")
+        try:
+            overrides[key] = json.loads(value)
+        except json.JSONDecodeError:
+            overrides[key] = value
+    return overrides
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run workloads against a local cluster and report JSON results")
+    parser.add_argument("--workload", action="append", choices=WORKLOADS + ["all"],
+                        help="Workload to run; repeat for several (default: all)")
+    parser.add_argument("--clients", type=int, default=DEFAULT_CLIENTS, help="Concurrent client processes")
+    parser.add_argument("--duration", type=float, default=DEFAULT_DURATION, help="Seconds per workload")
+    parser.add_argument("--dataset-bytes", type=int, default=DEFAULT_DATASET_BYTES)
+    parser.add_argument("--read-size", type=int, default=DEFAULT_READ_SIZE)
+    parser.add_argument("--small-append-size", type=int, default=DEFAULT_SMALL_APPEND_SIZE)
+    parser.add_argument("--large-append-size", type=int, default=DEFAULT_LARGE_APPEND_SIZE)
+    parser.add_argument("--read-fraction", type=float, default=DEFAULT_READ_FRACTION)
+    parser.add_argument("--config", default=os.path.join(REPO_DIRECTORY, "mserver_config.json"))
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE",
+                        help="Override a cluster config value, e.g. server_mode=asyncio")
+    parser.add_argument("--output", help="Write the JSON results here instead of stdout")
+    parser.add_argument("--keep", action="store_true", help="Keep the cluster directory and logs")
+    args = parser.parse_args()
+
+    workloads = args.workload or ["all"]
+    if "all" in workloads:
+        workloads = WORKLOADS
+    options = {
+        "clients": args.clients,
+        "duration": args.duration,
+        "dataset_bytes": args.dataset_bytes,
+        "read_size": args.read_size,
+        "small_append_size": args.small_append_size,
+        "large_append_size": args.large_append_size,
+        "read_fraction": args.read_fraction,
+    }
+    if args.read_size > args.dataset_bytes:
+        parser.error("--read-size must not exceed --dataset-bytes")
+
+    with LocalCluster(args.config, parse_overrides(args.set), keep=args.keep) as cluster:
+        chunk_size = cluster.config.get("chunk_size", 64 * 1024 * 1024)
+        if max(args.small_append_size, args.large_append_size) > chunk_size:
+            parser.error("Appends must fit in a chunk")
+        if any(workload.endswith("read") or workload == "mixed" for workload in workloads):
+            populate(cluster.config_path, args.dataset_bytes, chunk_size)
+        results = []
+        for workload in workloads:
+            print(f"Running {workload} with {args.clients} client(s) for {args.duration}s", file=sys.stderr)
+            results.append(run_workload(workload, options, cluster.config_path))
+
+    report = {
+        "config": {
+            "server_mode": cluster.config.get("server_mode"),
+            "chunk_size": chunk_size,
+            "replication_factor": cluster.config.get("replication_factor"),
+            "overrides": parse_overrides(args.set),
+            "options": options,
+        },
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
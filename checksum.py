@@ -0,0 +1,122 @@
+import os
+import struct
+import zlib
+from metrics import get_logger
+
+BLOCK_SIZE = 64 * 1024  # Bytes covered by each checksum
+# A checksum file holds the number of chunk bytes it covers followed by one CRC32 per block
+HEADER_FORMAT = "!Q"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+ENTRY_FORMAT = "!I"
+ENTRY_SIZE = struct.calcsize(ENTRY_FORMAT)
+
+log = get_logger("checksum")
+
+
+def checksum_path(chunk_path):
+    return os.path.splitext(chunk_path)[0] + ".crc"
+
+
+def block_count(size, block_size=BLOCK_SIZE):
+    return (size + block_size - 1) // block_size
+
+
+def verify_blocks(chunk_path, first_block, checksums, covered_size, block_size=BLOCK_SIZE):
+    # Returns the index of the first block whose data does not match its checksum, or None
+    with open(chunk_path, 'rb') as f:
+        for index, expected in enumerate(checksums, first_block):
+            start = index * block_size
+            data = os.pread(f.fileno(), min(block_size, covered_size - start), start)
+            if zlib.crc32(data) != expected:
+                return index
+    return None
+
+
+class BlockChecksums:
+    # Per-block CRC32s of one chunk, kept in memory and mirrored to "<handle>.crc". Appends only
+    # extend the tail block's checksum, since crc32 can continue from a previous value
+    def __init__(self, chunk_path, block_size=BLOCK_SIZE):
+        self.chunk_path = chunk_path
+        self.path = checksum_path(chunk_path)
+        self.block_size = block_size
+        self.checksums = []
+        self.size = 0  # Chunk bytes covered by the checksums
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+
+    def load(self, data_size):
+        # Returns the chunk size the checksums cover. Data past it never finished its flush and
+        # is cut off by the caller; a chunk with no usable checksum file gets one built from its data
+        stored = os.pread(self.fd, os.fstat(self.fd).st_size, 0)
+        if len(stored) >= HEADER_SIZE:
+            (covered,) = struct.unpack_from(HEADER_FORMAT, stored)
+            count = block_count(covered, self.block_size)
+            if covered <= data_size and len(stored) >= HEADER_SIZE + count * ENTRY_SIZE:
+                self.checksums = list(struct.unpack_from(f"!{count}I", stored, HEADER_SIZE))
+                self.size = covered
+                return covered
+        if data_size:
+            log.info("Building checksums", path=self.chunk_path)
+        self.checksums = []
+        with open(self.chunk_path, 'rb') as f:
+            while True:
+                block = f.read(self.block_size)
+                if not block:
+                    break
+                self.checksums.append(zlib.crc32(block))
+        self.size = data_size
+        self.persist(0, self.checksums, data_size, truncate=True)
+        return data_size
+
+    def extend(self, data):
+        # Checksums for appending data at the current end: (first changed block, new values)
+        index = self.size // self.block_size
+        offset_in_block = self.size % self.block_size
+        crc = self.checksums[index] if offset_in_block else 0
+        view = memoryview(data)
+        checksums = []
+        position = 0
+        while position < len(data):
+            take = self.block_size - offset_in_block
+            crc = zlib.crc32(view[position:position + take], crc)
+            checksums.append(crc)
+            position += take
+            offset_in_block = 0
+            crc = 0
+        return index, checksums
+
+    def persist(self, index, checksums, size, truncate=False):
+        if checksums:
+            os.pwrite(self.fd, struct.pack(f"!{len(checksums)}I", *checksums), HEADER_SIZE + index * ENTRY_SIZE)
+        if truncate:
+            os.ftruncate(self.fd, HEADER_SIZE + (index + len(checksums)) * ENTRY_SIZE)
+        os.pwrite(self.fd, struct.pack(HEADER_FORMAT, size), 0)
+
+    def apply(self, index, checksums, size):
+        self.checksums[index:] = checksums
+        self.size = size
+
+    def truncate(self, size):
+        # Only the block the new end falls in has to be re-read
+        index = size // self.block_size
+        checksums = []
+        partial = size % self.block_size
+        if partial:
+            with open(self.chunk_path, 'rb') as f:
+                checksums.append(zlib.crc32(os.pread(f.fileno(), partial, index * self.block_size)))
+        self.persist(index, checksums, size, truncate=True)
+        self.apply(index, checksums, size)
+
+    def snapshot(self, offset, length):
+        # The checksums of the blocks touching [offset, offset + length): (first block, values, covered size)
+        end = min(offset + length, self.size)
+        if end <= offset:
+            return 0, [], self.size
+        first = offset // self.block_size
+        last = (end - 1) // self.block_size
+        return first, self.checksums[first:last + 1], self.size
+
+    def sync(self):
+        os.fdatasync(self.fd)
+
+    def close(self):
+        os.close(self.fd)
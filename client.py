@@ -1,15 +1,139 @@
-import socket
+import argparse
+import contextlib
+import io
 import json
+import mmap
+import os
+import random
+import socket
+import sys
+import threading
 import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from compression import decode_payload, encode_payload
+from erasure import ReedSolomon, fragment_handle, shard_size
+from protocol import ConnectionPool
+from metrics import configure_logging, get_logger
+from routing import ReadRouter
+
+DEFAULT_BATCH_PARALLELISM = 16  # Operations a batch runs at once
+
+log = get_logger("client")
+
+class LocationCache:
+    # Size-bounded LRU of chunk locations per file; entries expire after ttl seconds
+    def __init__(self, ttl=60, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, file_name):
+        with self.lock:
+            entry = self.entries.get(file_name)
+            if entry is None:
+                return None
+            expires_at, chunk_locations = entry
+            if time.monotonic() >= expires_at:
+                del self.entries[file_name]
+                return None
+            self.entries.move_to_end(file_name)
+            return chunk_locations
+
+    def put(self, file_name, chunk_locations, ttl=None):
+        with self.lock:
+            self.entries[file_name] = (time.monotonic() + (self.ttl if ttl is None else ttl), chunk_locations)
+            self.entries.move_to_end(file_name)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, file_name):
+        with self.lock:
+            self.entries.pop(file_name, None)
+
+class BufferWriter:
+    # File-like writes into a caller-supplied buffer such as a bytearray or an mmap
+    def __init__(self, buffer):
+        self.view = memoryview(buffer).cast("B")
+        if self.view.readonly:
+            raise TypeError("Destination buffer is read-only")
+        self.position = 0
+
+    def write(self, data):
+        end = self.position + len(data)
+        if end > len(self.view):
+            raise ValueError(f"Destination buffer holds {len(self.view)} bytes, {end} needed")
+        self.view[self.position:end] = data
+        self.position = end
+        return len(data)
+
+    def seek(self, position):
+        self.position = position
+
+    def truncate(self, size):
+        if size > len(self.view):
+            raise ValueError(f"Destination buffer holds {len(self.view)} bytes, {size} needed")
+
+class ReadAheadBuffer:
+    # Remembers, per file, bytes fetched past the end of the last read and where that read ended,
+    # so sequential readers are served from memory
+    def __init__(self, max_files=1024):
+        self.max_files = max_files
+        self.entries = OrderedDict()  # file -> (buffer offset, buffered bytes, end of the last read)
+        self.lock = threading.Lock()
+
+    def get(self, file_name, offset, length):
+        with self.lock:
+            entry = self.entries.get(file_name)
+            if entry is None or length is None:
+                return None
+            buffer_offset, data, _ = entry
+            if not buffer_offset <= offset or offset + length > buffer_offset + len(data):
+                return None
+            self.entries[file_name] = (buffer_offset, data, offset + length)
+            return data[offset - buffer_offset:offset - buffer_offset + length]
+
+    def is_sequential(self, file_name, offset):
+        with self.lock:
+            entry = self.entries.get(file_name)
+            return entry is not None and entry[2] == offset
+
+    def put(self, file_name, offset, data, read_end):
+        with self.lock:
+            self.entries[file_name] = (offset, data, read_end)
+            self.entries.move_to_end(file_name)
+            while len(self.entries) > self.max_files:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, file_name):
+        with self.lock:
+            self.entries.pop(file_name, None)
 
 class Client:
     def __init__(self, config_file='client_config.json'):
         self.master_address = None
         self.master_port = None
-        self.client_socket = None
+        self.socket_timeout = 5  # Timeout in seconds for connects and replies
         self.retry_attempts = 5  # Set max retry attempts or -1 for infinite retries
-        self.retry_delay = 3  # Seconds to wait before retrying
+        self.retry_delay = 3  # Base of the jittered exponential backoff between retries, in seconds
+        self.max_retry_delay = 30  # Cap on a single backoff
+        self.busy_retries = 8  # Times a request is resent to a server that answered busy
         self.temp_file_path = 'temp_output_file.txt'  # Path to store the temporary file
+        self.parallel_reads = False  # Stripe reads across all replicas instead of one server
+        self.read_workers = 8  # Maximum concurrent range fetches in parallel read mode
+        self.stripe_size = 4 * 1024 * 1024  # Bytes fetched per range request in parallel read mode
+        self.receive_buffer_size = 1024 * 1024  # Bytes of the reusable buffer streamed reads land in
+        self.location_cache = LocationCache(ttl=60, max_entries=10000)  # Chunk locations per file
+        # The master's write reply per file, kept while the primary's lease lasts
+        self.primary_cache = LocationCache(ttl=0, max_entries=10000)
+        self.read_ahead_bytes = 0  # Bytes fetched per sequential ranged read; 0 disables read-ahead
+        self.read_ahead = ReadAheadBuffer()
+        self.read_router = ReadRouter()  # Picks among cached replicas by our own in-flight reads and latency
+        self.wire_compression = None  # Codec for chunk data sent and requested, e.g. "zlib"; None sends raw bytes
+        self.two_phase_writes = True  # Push data to every replica first, then send a small commit to the primary
+        self.connection_pool = ConnectionPool(timeout=self.socket_timeout)  # Persistent connections to all servers
         self.load_config(config_file)
 
     def load_config(self, config_file):
@@ -18,141 +142,606 @@ class Client:
                 config = json.load(file)
             self.master_address = config['master_server']['address']
             self.master_port = config['master_server']['port']
-            print(f"Configuration loaded from {config_file}")
+            log.debug("Configuration loaded", path=config_file)
         except (FileNotFoundError, json.JSONDecodeError) as e:
-            print(f"Error loading config file: {e}")
+            log.error("Error loading config file", path=config_file, error=e)
     
     def connect_to_master(self):
         attempts = 0
-        socket_timeout = 5  # Timeout in seconds for each connection attempt
+        master = (self.master_address, self.master_port)
+        address = f"{self.master_address}:{self.master_port}"
         while self.retry_attempts == -1 or attempts < self.retry_attempts:
             try:
-                # Create a new socket for each attempt
-                self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                self.client_socket.settimeout(socket_timeout)  # Set connection timeout
-                print(f"Attempting to connect to Master Server at {self.master_address}:{self.master_port} (Attempt {attempts + 1})")
-                # Attempt to connect to the master server
-                self.client_socket.connect((self.master_address, self.master_port))
-                print(f"Connected to Master Server at {self.master_address}:{self.master_port}")
+                # Open a persistent connection and park it in the pool for later requests
+                if attempts:
+                    log.info("Connecting to master", address=address, attempt=attempts + 1)
+                master_socket, reused = self.connection_pool.acquire(master)
+                self.connection_pool.release(master, master_socket)
+                if not reused:
+                    log.debug("Connected to master", address=address)
                 return  # Exit function after successful connection
             except Exception as e:
-                print(f"Connection timed out after {socket_timeout} seconds. Retrying...")
                 attempts += 1
-                error_code = e.errno
-                print(f"Error connecting to Master Server: {e}, Error Code: {error_code}")
                 if self.retry_attempts != -1 and attempts >= self.retry_attempts:
-                    print(f"Max retry attempts reached. Unable to connect to Master Server.")
+                    log.error("Unable to connect to master", address=address, attempts=attempts, error=e)
                     return
-                print(f"Retrying in {self.retry_delay} seconds...")
-                time.sleep(self.retry_delay)
-        print("Failed to connect to the Master Server after all attempts.")
+                delay = self.backoff_delay(attempts - 1)
+                log.warning("Error connecting to master", address=address, error=e, retry_in=round(delay, 1))
+                time.sleep(delay)
+
+    def master_request(self, request):
+        return self.send_request((self.master_address, self.master_port), request)
+
+    def chunk_server_request(self, chunk_server_address, request, payload=b""):
+        host, port = chunk_server_address.split(':')
+        return self.send_request((host, int(port)), request, payload)
+
+    def send_request(self, address, request, payload=b""):
+        # An overloaded server answers busy with how long to wait; the last busy reply is
+        # returned to the caller once busy_retries runs out
+        attempt = 0
+        while True:
+            response, response_payload = self.connection_pool.request(address, request, payload)
+            if response.get("status") != "busy" or attempt >= self.busy_retries:
+                return response, response_payload
+            time.sleep(self.backoff_delay(attempt, response.get("retry_after", self.retry_delay)))
+            attempt += 1
 
-    def request_file(self, file_name):
+    def backoff_delay(self, attempt, base=None):
+        # Exponential backoff with jitter, so clients turned away together don't retry together
+        delay = min(self.max_retry_delay, (self.retry_delay if base is None else base) * 2 ** attempt)
+        return delay * random.uniform(0.5, 1.5)
+
+    def add_latency_feedback(self, request):
+        # Lookups carry our observed per-server read latency so the master can route other clients
+        feedback = self.read_router.latency_snapshot()
+        if feedback:
+            request["latency_feedback"] = feedback
+
+    def encode_for_wire(self, request, payload):
+        if self.wire_compression and payload:
+            return encode_payload(request, payload, self.wire_compression)
+        return payload
+
+    def timed_chunk_server_request(self, chunk_server_address, request):
+        if self.wire_compression:
+            # The server compresses the reply only if it supports one of the codecs we accept
+            request["accept_encoding"] = [self.wire_compression]
+        started = time.monotonic()
+        self.read_router.begin(chunk_server_address)
         try:
-            # Step 1: Construct a read request in JSON format
-            request = json.dumps({"type": "read", "file_name": file_name})
-            
-            # Step 2: Send the read request to the Master Server
-            self.client_socket.sendall(request.encode())
-            print(f"Sent read request for file '{file_name}' to Master Server")
-
-            # Step 3: Receive the chunk server address from the Master Server
-            chunk_server_response = self.client_socket.recv(4096).decode().strip()
-            
-            # Check if the response is an error message
-            if "Error" in chunk_server_response:
-                print(f"Error from Master Server: {chunk_server_response}")
-                return
-            
-            # Step 4: Parse the chunk server address
-            chunk_server_address = chunk_server_response
-            print(f"Received chunk server address from Master Server: {chunk_server_address}")
-
-            # Ensure the chunk server address format is correct ('host:port')
-            if ':' not in chunk_server_address:
-                print(f"Invalid chunk server address format: {chunk_server_address}")
-                return
-
-            # Step 5: Retrieve the file from the specified chunk server
-            self.retrieve_file_from_chunk_server(file_name, chunk_server_address)
+            response = self.chunk_server_request(chunk_server_address, request)
+        except socket.error:
+            self.read_router.end(chunk_server_address)
+            raise
+        self.read_router.end(chunk_server_address, time.monotonic() - started)
+        return response
 
-        except socket.error as e:
-            print(f"Error sending request to Master Server: {e}")
+    @contextlib.contextmanager
+    def timed_chunk_server_stream(self, chunk_server_address, request):
+        # Like timed_chunk_server_request, but the payload is left for the caller to receive in place
+        if self.wire_compression:
+            request["accept_encoding"] = [self.wire_compression]
+        host, port = chunk_server_address.split(':')
+        started = time.monotonic()
+        self.read_router.begin(chunk_server_address)
+        completed = False
+        try:
+            with self.connection_pool.stream((host, int(port)), request) as (response, reader):
+                yield response, reader
+            completed = True
+        finally:
+            self.read_router.end(chunk_server_address, time.monotonic() - started if completed else None)
+
+    def lookup_file(self, file_name):
+        # Resolve a file to every live replica of each chunk, serving repeat lookups from the cache
+        chunk_locations = self.location_cache.get(file_name)
+        if chunk_locations is not None:
+            return chunk_locations
+        request = {"type": "read", "file_name": file_name, "all_replicas": True}
+        self.add_latency_feedback(request)
+        response, _ = self.master_request(request)
+        if response.get("status") != "ok":
+            log.warning("Error from master", file=file_name, error=response.get('message'))
+            return None
+        chunk_locations = response["chunks"]
+        log.debug("Received chunk locations", file=file_name, chunks=len(chunk_locations))
+        self.location_cache.put(file_name, chunk_locations)
+        return chunk_locations
+
+    def lookup_files(self, file_names):
+        # Resolve many files in one round-trip, only asking the master about uncached ones
+        results = {}
+        missing = []
+        for file_name in file_names:
+            chunk_locations = self.location_cache.get(file_name)
+            if chunk_locations is None:
+                missing.append(file_name)
+            else:
+                results[file_name] = chunk_locations
+        if missing:
+            request = {"type": "lookup_batch", "file_names": missing, "all_replicas": True}
+            self.add_latency_feedback(request)
+            response, _ = self.master_request(request)
+            if response.get("status") != "ok":
+                log.warning("Error from master", files=len(missing), error=response.get('message'))
+                return results
+            for file_name, chunk_locations in response["files"].items():
+                if chunk_locations is not None:
+                    self.location_cache.put(file_name, chunk_locations)
+                    results[file_name] = chunk_locations
+        return results
+
+    def request_file(self, file_name, parallel=None, destination=None):
+        # Fetch the whole file into destination: a path (temp_file_path by default), a writable
+        # binary file object, or a writable buffer such as a bytearray. Returns the number of
+        # bytes read, or None if the file could not be read
+        if parallel if parallel is not None else self.parallel_reads:
+            return self.request_file_parallel(file_name, destination)
+        try:
+            size = 0
+            with self.open_destination(destination) as output:
+                for block in self.stream_file(file_name):
+                    output.write(block)
+                    size += len(block)
+        except (OSError, KeyError, ValueError) as e:
+            log.warning("Error reading file", file=file_name, error=e)
+            return None
+        log.debug("Read file", file=file_name, bytes=size, destination=self.describe_destination(destination))
+        return size
+
+    def read_file(self, file_name, parallel=None):
+        # Return the whole file as bytes, or None if it could not be read
+        output = io.BytesIO()
+        if self.request_file(file_name, parallel, output) is None:
+            return None
+        return output.getvalue()
+
+    def iter_file(self, file_name):
+        # Yield the file's bytes in order as they arrive, in blocks of at most receive_buffer_size,
+        # so callers can stream files of any size. Raises FileNotFoundError for unknown files and
+        # OSError when a chunk can't be read
+        for block in self.stream_file(file_name):
+            yield bytes(block)
+
+    def stream_file(self, file_name, buffer=None):
+        # Like iter_file, but every block is a memoryview over one reusable buffer that the
+        # socket receives into, valid only until the next block is requested
+        if buffer is None:
+            buffer = bytearray(self.receive_buffer_size)
+        chunk_locations = self.lookup_file(file_name)
+        if chunk_locations is None:
+            raise FileNotFoundError(f"File '{file_name}' not found")
+        for location in chunk_locations:
+            chunk_handle = location["chunk_handle"]
+            complete, offset = yield from self.stream_location(location, buffer)
+            if not complete:
+                # The cached replicas may be gone; ask the master once more for this chunk
+                self.location_cache.invalidate(file_name)
+                fresh = next((fresh for fresh in self.lookup_file(file_name) or []
+                              if fresh["chunk_handle"] == chunk_handle), None)
+                if fresh is not None:
+                    complete, offset = yield from self.stream_location(fresh, buffer, offset)
+                if not complete:
+                    raise OSError(f"No replica could serve chunk {chunk_handle} of '{file_name}'")
+
+    @contextlib.contextmanager
+    def open_destination(self, destination):
+        # Paths are written through a uniquely named temporary file that is renamed into place,
+        # so concurrent reads to the same path never interleave and a failed read leaves any
+        # earlier file untouched
+        if destination is None:
+            destination = self.temp_file_path
+        if isinstance(destination, (str, os.PathLike)):
+            partial_path = f"{destination}.{uuid.uuid4().hex}.part"
+            try:
+                with open(partial_path, 'w+b') as output:  # Readable too, so it can be mapped
+                    yield output
+                os.replace(partial_path, destination)
+            finally:
+                if os.path.exists(partial_path):
+                    os.remove(partial_path)
+        elif hasattr(destination, "write"):
+            yield destination
+        else:
+            yield BufferWriter(destination)
+
+    def describe_destination(self, destination):
+        if destination is None:
+            return self.temp_file_path
+        if isinstance(destination, (str, os.PathLike)):
+            return os.fspath(destination)
+        return type(destination).__name__
+
+    def stream_location(self, location, buffer, offset=0):
+        # An erasure-coded chunk is rebuilt whole from its fragments; a replicated one is streamed
+        if "coding" not in location:
+            return (yield from self.stream_chunk(location["chunk_handle"], location["addresses"], buffer, offset))
+        data = self.read_coded_range(location["chunk_handle"], location["coding"], offset)
+        if data is None:
+            return False, offset
+        yield memoryview(data)
+        return True, offset + len(data)
+
+    def stream_chunk(self, chunk_handle, addresses, buffer, offset=0):
+        # Yield the chunk from offset on as views over buffer, trying the replica the router
+        # prefers first. A replica that fails partway is replaced by the next one from where it
+        # stopped. Returns whether the chunk was read to its end, and how far it got
+        for chunk_server_address in self.read_router.order(addresses):
+            request = {"type": "read", "chunk_handle": chunk_handle}
+            if offset:
+                request["offset"] = offset
+            try:
+                with self.timed_chunk_server_stream(chunk_server_address, request) as (response, reader):
+                    if response.get("status") != "ok":
+                        # E.g. a replica whose checksums failed; another replica may still be good
+                        log.warning("Error from chunk server", chunk=chunk_handle, server=chunk_server_address,
+                                    error=response.get('message'))
+                        continue
+                    if response.get("encoding"):
+                        # Compressed blocks only decode whole
+                        data = decode_payload(response, reader.read_all())
+                        offset += len(data)
+                        yield memoryview(data)
+                    else:
+                        for block in reader.iter_blocks(buffer):
+                            offset += len(block)
+                            yield block
+                return True, offset
+
+            except socket.error as e:
+                log.warning("Error reading chunk", chunk=chunk_handle, server=chunk_server_address, error=e)
+        return False, offset
 
-    def retrieve_file_from_chunk_server(self, file_name, chunk_server_address):
+    def request_file_parallel(self, file_name, destination=None):
         try:
-            # Split the chunk server address into host and port
-            host, port = chunk_server_address.split(':')
-            chunk_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            chunk_socket.connect((host, int(port)))
-
-            # Step 5: Send the file request to the Chunk Server
-            request = json.dumps({"type": "read", "file_name": file_name})
-            chunk_socket.sendall(request.encode())
-            print(f"Requested file '{file_name}' from Chunk Server at {chunk_server_address}")
-
-            # Step 6: Receive the file data from the Chunk Server
-            with open(self.temp_file_path, 'wb') as temp_file:  # Open the file in binary mode
-                while True:
-                    file_data = chunk_socket.recv(4096)  # Receive file in chunks of 4096 bytes
-                    if not file_data:
-                        print("No more data received from the Chunk Server.")
-                        break  # End of file transfer
-                    temp_file.write(file_data)  # Write received binary data to the temp file
-                print(f"File successfully written to {self.temp_file_path}")
-
-            chunk_socket.close()
+            # Every live replica of every chunk is needed to stripe the read
+            chunk_locations = self.lookup_file(file_name)
+            if chunk_locations is None:
+                return None
+        except (socket.error, KeyError) as e:
+            log.warning("Error sending request to master", file=file_name, error=e)
+            return None
 
+        with ThreadPoolExecutor(max_workers=self.read_workers) as executor:
+            # Chunks may be shorter than the chunk size, so learn each length before striping.
+            # The master already knows the length of every erasure-coded chunk
+            lengths = list(executor.map(
+                lambda location: location["coding"]["length"] if "coding" in location
+                else self.get_chunk_length(location["chunk_handle"], location["addresses"]),
+                chunk_locations
+            ))
+            if None in lengths:
+                log.warning("Could not determine the length of every chunk", file=file_name)
+                self.location_cache.invalidate(file_name)
+                return None
+
+            # Split each chunk into disjoint stripes handed to its replicas round-robin. Stripes of
+            # an erasure-coded chunk fall on different data fragments instead
+            stripes = []
+            file_offset = 0
+            for location, chunk_length in zip(chunk_locations, lengths):
+                addresses = location.get("addresses", [])
+                coding = location.get("coding")
+                for index, offset in enumerate(range(0, chunk_length, self.stripe_size)):
+                    length = min(self.stripe_size, chunk_length - offset)
+                    rotation = index % len(addresses) if addresses else 0
+                    stripes.append((file_offset + offset, location["chunk_handle"], offset, length,
+                                    addresses[rotation:] + addresses[:rotation], coding))
+                file_offset += chunk_length
+
+            # Stripes are received straight into the destination where it can be mapped into
+            # memory; other file objects get them written in file order and must be seekable
+            try:
+                with self.open_destination(destination) as output:
+                    output.truncate(file_offset)
+                    with self.map_destination(output, file_offset) as target:
+                        if target is not None:
+                            futures = [
+                                (file_position, length, executor.submit(
+                                    self.fetch_stripe_into, chunk_handle, offset, length, addresses,
+                                    target[file_position:file_position + length], coding))
+                                for file_position, chunk_handle, offset, length, addresses, coding in stripes
+                            ]
+                            # Every fetch must finish before the mapping is closed, failed or not
+                            failed = [(file_position, length) for file_position, length, future in futures
+                                      if not future.result()]
+                            if failed:
+                                file_position, length = failed[0]
+                                raise OSError(f"Failed to fetch bytes {file_position}-{file_position + length}")
+                        else:
+                            futures = [
+                                (file_position, length, executor.submit(
+                                    self.fetch_stripe, chunk_handle, offset, length, addresses, coding))
+                                for file_position, chunk_handle, offset, length, addresses, coding in stripes
+                            ]
+                            for file_position, length, future in futures:
+                                data = future.result()
+                                if data is None or len(data) != length:
+                                    raise OSError(f"Failed to fetch bytes {file_position}-{file_position + length}")
+                                output.seek(file_position)
+                                output.write(data)
+            except (OSError, ValueError) as e:
+                log.warning("Error reading file", file=file_name, error=e)
+                self.location_cache.invalidate(file_name)
+                return None
+        log.debug("Read file", file=file_name, bytes=file_offset, destination=self.describe_destination(destination),
+                  stripes=len(stripes))
+        return file_offset
+
+    def read(self, file_name, offset=0, length=None):
+        # Return length bytes of the file starting at offset (to the end when length is None),
+        # or None if the range could not be read. Reads that continue where the previous read
+        # of the file stopped fetch read_ahead_bytes and serve what follows from memory
+        data = self.read_ahead.get(file_name, offset, length)
+        if data is not None:
+            return data
+        fetch_length = length
+        if self.read_ahead_bytes and length is not None and self.read_ahead.is_sequential(file_name, offset):
+            fetch_length = max(length, self.read_ahead_bytes)
+        data = self.read_range(file_name, offset, fetch_length)
+        if data is None:
+            return None
+        result = data if length is None else data[:length]
+        self.read_ahead.put(file_name, offset, data, offset + len(result))
+        return result
+
+    def read_range(self, file_name, offset, length):
+        # Only the chunks covering the range are resolved, so the master answers each range read
+        request = {"type": "read", "file_name": file_name, "offset": offset, "length": length, "all_replicas": True}
+        self.add_latency_feedback(request)
+        try:
+            response, _ = self.master_request(request)
         except socket.error as e:
-            print(f"Error retrieving file from Chunk Server: {e}")
+            log.warning("Error sending request to master", file=file_name, error=e)
+            return None
+        if response.get("status") != "ok":
+            log.warning("Error from master", file=file_name, error=response.get('message'))
+            return None
+        parts = []
+        for location in response["chunks"]:
+            if "coding" in location:
+                data = self.read_coded_range(location["chunk_handle"], location["coding"], location["offset"],
+                                             location["length"])
+            else:
+                data = self.read_chunk_range(location["chunk_handle"], location["offset"], location["length"],
+                                             location["addresses"])
+            if data is None:
+                return None
+            parts.append(data)
+        return b"".join(parts)
+
+    def read_chunk_range(self, chunk_handle, offset, length, addresses):
+        # Try the replica the router prefers first and fall back to the others. Only the file's
+        # tail chunk has an open length, and there the server may return fewer bytes than asked
+        for address in self.read_router.order(addresses):
+            try:
+                request = {"type": "read", "chunk_handle": chunk_handle, "offset": offset, "length": length}
+                response, data = self.timed_chunk_server_request(address, request)
+                if response.get("status") == "ok":
+                    return data
+                log.warning("Error from chunk server", chunk=chunk_handle, server=address, error=response.get('message'))
+            except socket.error as e:
+                log.warning("Error reading chunk", chunk=chunk_handle, server=address, error=e)
+        return None
+
+    def read_coded_range(self, chunk_handle, coding, offset=0, length=None):
+        # Read from an erasure-coded chunk, or return None. Data fragment i holds the chunk's
+        # bytes from i * fragment size on, so while they are all readable a range comes straight
+        # from the data fragments it covers, in parallel. Otherwise the same byte range of any
+        # data_shards fragments, data fragments first, rebuilds that range of every data fragment
+        data_shards = coding["data_shards"]
+        addresses = coding["fragments"]
+        end = coding["length"] if length is None else min(coding["length"], offset + length)
+        if end <= offset:
+            return b""
+        size = shard_size(coding["length"], data_shards)
+        # (fragment index, offset inside the fragment, byte count) of each data fragment the range touches
+        pieces = []
+        for index in range(offset // size, (end - 1) // size + 1):
+            piece_start = max(offset, index * size)
+            pieces.append((index, piece_start - index * size, min(end, (index + 1) * size) - piece_start))
+
+        def fetch(index, start, count):
+            if addresses[index] is None:
+                return None
+            return self.fetch_stripe(fragment_handle(chunk_handle, index), start, count, [addresses[index]])
+
+        with ThreadPoolExecutor(max_workers=data_shards) as executor:
+            parts = list(executor.map(lambda piece: fetch(*piece), pieces))
+            if None not in parts:
+                return b"".join(parts)
+            log.info("Rebuilding range of erasure-coded chunk", chunk=chunk_handle, start=offset, end=end)
+            start = min(piece[1] for piece in pieces)
+            count = max(piece[1] + piece[2] for piece in pieces) - start
+            remaining = [index for index, address in enumerate(addresses) if address is not None]
+            fragments = {}
+            while len(fragments) < data_shards and remaining:
+                batch, remaining = remaining[:data_shards - len(fragments)], remaining[data_shards - len(fragments):]
+                for index, data in zip(batch, executor.map(lambda index: fetch(index, start, count), batch)):
+                    if data is not None:
+                        fragments[index] = data
+        if len(fragments) < data_shards:
+            log.warning("Too few fragments readable to rebuild chunk", chunk=chunk_handle, readable=len(fragments),
+                        needed=data_shards)
+            return None
+        shards = ReedSolomon(data_shards, coding["parity_shards"]).decode_shards(fragments)
+        return b"".join(bytes(shards[index][piece_start - start:piece_start - start + piece_count])
+                        for index, piece_start, piece_count in pieces)
+
+    def get_chunk_length(self, chunk_handle, addresses):
+        for address in addresses:
+            try:
+                response, _ = self.chunk_server_request(address, {"type": "chunk_length", "chunk_handle": chunk_handle})
+                if response.get("status") == "ok":
+                    return response["length"]
+                log.warning("Error getting chunk length", chunk=chunk_handle, server=address,
+                            error=response.get('message'))
+            except socket.error as e:
+                log.warning("Error getting chunk length", chunk=chunk_handle, server=address, error=e)
+        return None
+
+    def fetch_stripe(self, chunk_handle, offset, length, addresses, coding=None):
+        # Try the assigned replica first and fall back to the others
+        if coding is not None:
+            return self.read_coded_range(chunk_handle, coding, offset, length)
+        for address in addresses:
+            try:
+                request = {"type": "read", "chunk_handle": chunk_handle, "offset": offset, "length": length}
+                response, data = self.timed_chunk_server_request(address, request)
+                if response.get("status") == "ok" and len(data) == length:
+                    return data
+                log.warning("Short read of chunk", chunk=chunk_handle, server=address)
+            except socket.error as e:
+                log.warning("Error fetching chunk", chunk=chunk_handle, server=address, error=e)
+        return None
+
+    @contextlib.contextmanager
+    def map_destination(self, output, size):
+        # Yield a writable memoryview of the first size bytes of the destination, or None if it
+        # can't be written in place
+        if isinstance(output, BufferWriter):
+            yield output.view[:size]
+            return
+        try:
+            mapped = mmap.mmap(output.fileno(), size) if size else None
+        except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+            mapped = None
+        if mapped is None:
+            yield None
+            return
+        view = memoryview(mapped)
+        try:
+            yield view
+        finally:
+            view.release()
+            mapped.close()
+
+    def fetch_stripe_into(self, chunk_handle, offset, length, addresses, view, coding=None):
+        # Receive the stripe from the socket straight into view. Returns whether it was filled
+        try:
+            if coding is not None:
+                data = self.read_coded_range(chunk_handle, coding, offset, length)
+                if data is not None and len(data) == length:
+                    view[:] = data
+                    return True
+                return False
+            for address in addresses:
+                try:
+                    request = {"type": "read", "chunk_handle": chunk_handle, "offset": offset, "length": length}
+                    with self.timed_chunk_server_stream(address, request) as (response, reader):
+                        if response.get("status") == "ok" and response.get("encoding"):
+                            data = decode_payload(response, reader.read_all())
+                            if len(data) == length:
+                                view[:] = data
+                                return True
+                        elif response.get("status") == "ok" and reader.remaining == length:
+                            reader.read_into(view)
+                            return True
+                    log.warning("Short read of chunk", chunk=chunk_handle, server=address)
+                except socket.error as e:
+                    log.warning("Error fetching chunk", chunk=chunk_handle, server=address, error=e)
+            return False
+        finally:
+            view.release()
+
+    def push_data(self, replicas, data_id, data):
+        # Compress once and push the same bytes to every replica
+        request = {"type": "push_data", "data_id": data_id}
+        payload = self.encode_for_wire(request, data)
+
+        def push(address):
+            try:
+                response, _ = self.chunk_server_request(address, request, payload)
+                return response.get("status") == "ok"
+            except socket.error as e:
+                log.warning("Error pushing data", server=address, error=e)
+                return False
+
+        with ThreadPoolExecutor(max_workers=len(replicas)) as executor:
+            return all(executor.map(push, replicas))
 
     def write_file(self, file_name, data):
             attempt = 0
+            full_chunk = None
+            if isinstance(data, str):
+                data = data.encode()
             while attempt < self.retry_attempts:
                 try:
-                    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as master_socket:
-                        master_socket.connect((self.master_address, self.master_port))
-                        write_request = {
-                            "type": "write",
-                            "file_name": file_name
-                        }
-                        master_socket.sendall(json.dumps(write_request).encode())
-                        
-                        primary_server_info = master_socket.recv(4096).decode()
-                        primary_server = json.loads(primary_server_info)
-                        primary_address, primary_port = primary_server["address"], primary_server["port"]
-                        print(f"Received primary server address: {primary_address}:{primary_port}")
-
-                    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as primary_socket:
-                        primary_socket.connect((primary_address, primary_port))
-                        write_data = {
-                            "type": "write",
-                            "file_name": file_name,
-                            "data": data,
-                            "server": "primary"
-                        }
-                        primary_socket.sendall(json.dumps(write_data).encode())
-
-                        response = primary_socket.recv(4096).decode()
-                        if response == "Write success":
-                            print("Write operation completed successfully.")
-                            return True  # Write successful, exit function
-                        else:
-                            print("Primary chunk server failed to commit write. Retrying...")
-                            attempt += 1
-                            time.sleep(self.retry_delay)
+                    write_request = {
+                        "type": "write",
+                        "file_name": file_name,
+                        "full_chunk": full_chunk
+                    }
+                    # Write straight to the primary while its lease lasts; a full chunk needs the master
+                    primary_server = self.primary_cache.get(file_name) if full_chunk is None else None
+                    cached = primary_server is not None
+                    if not cached:
+                        primary_server, _ = self.master_request(write_request)
+                        if primary_server.get("status") != "ok":
+                            raise RuntimeError(primary_server.get("message"))
+                        # Leave a margin so the cached primary is not used right as its lease ends
+                        self.primary_cache.put(file_name, primary_server, ttl=primary_server.get("lease_seconds", 0) * 0.9)
+                    primary_address, primary_port = primary_server["address"], primary_server["port"]
+                    chunk_handle = primary_server["chunk_handle"]
+                    log.debug("Writing to primary", file=file_name, chunk=chunk_handle,
+                              primary=f"{primary_address}:{primary_port}", cached=cached)
+
+                    write_data = {
+                        "type": "write",
+                        "chunk_handle": chunk_handle,
+                        "server": "primary",
+                        "secondaries": primary_server["secondaries"],
+                        # Lets the primary refuse the write if either side missed a version bump
+                        "version": primary_server.get("version")
+                    }
+                    if self.two_phase_writes:
+                        # Phase one: push the data to every replica; phase two commits it by data ID
+                        replicas = [f"{primary_address}:{primary_port}"] + [
+                            f"{host}:{port}" for host, port in primary_server["secondaries"]
+                        ]
+                        write_data["data_id"] = uuid.uuid4().hex
+                        if not self.push_data(replicas, write_data["data_id"], data):
+                            raise RuntimeError(f"Could not push data to every replica of chunk {chunk_handle}")
+                        payload = b""
+                    else:
+                        payload = self.encode_for_wire(write_data, data)
+                    response, _ = self.chunk_server_request(f"{primary_address}:{primary_port}", write_data, payload)
+                    if response.get("status") == "ok":
+                        # The write may have added a tail chunk our cached locations do not list
+                        self.location_cache.invalidate(file_name)
+                        self.read_ahead.invalidate(file_name)
+                        log.debug("Write completed", file=file_name, chunk=chunk_handle, offset=response.get('offset'))
+                        return True  # Write successful, exit function
+                    elif response.get("status") == "chunk_full":
+                        # Ask the master for a fresh tail chunk and retry right away
+                        log.debug("Chunk is full; requesting a new chunk", file=file_name, chunk=chunk_handle)
+                        self.primary_cache.invalidate(file_name)
+                        full_chunk = chunk_handle
+                    elif cached:
+                        # E.g. the chunk moved on to a new primary; ask the master right away
+                        log.info("Cached primary refused the write; asking the master", file=file_name,
+                                 chunk=chunk_handle, error=response.get('message'))
+                        self.primary_cache.invalidate(file_name)
+                    else:
+                        log.warning("Primary failed to commit write; retrying", file=file_name, chunk=chunk_handle,
+                                    error=response.get('message'))
+                        self.primary_cache.invalidate(file_name)
+                        time.sleep(self.backoff_delay(attempt))
+                        attempt += 1
 
                 except Exception as e:
-                    print(f"Error in write operation attempt {attempt + 1}: {e}")
+                    log.warning("Error in write attempt", file=file_name, attempt=attempt + 1, error=e)
+                    self.primary_cache.invalidate(file_name)
+                    time.sleep(self.backoff_delay(attempt))
                     attempt += 1
-                    time.sleep(self.retry_delay)
 
-            print("Write operation failed after all retry attempts.")
+            log.error("Write failed after all retry attempts", file=file_name)
             return False
 
 # Define a handler function with a while True loop
-def client_handler():
-    client = Client("mserver_config.json")
+def client_handler(config_file="mserver_config.json"):
+    client = Client(config_file)
     
     while True:
         client.connect_to_master()
@@ -163,13 +752,108 @@ def client_handler():
             break
         elif choice == 'read':
             file_name = input("Enter the file name you want to request: ").strip()
-            client.request_file(file_name)
+            size = client.request_file(file_name)
+            if size is None:
+                print(f"Could not read '{file_name}'")
+            else:
+                print(f"Read {size} bytes of '{file_name}' into {client.describe_destination(None)}")
         elif choice == 'write':
             file_name = input("Enter the file name you want to write to: ").strip()
             data = input("Enter the data you want to write: ").strip()
-            client.write_file(file_name, data)
+            print("Write succeeded" if client.write_file(file_name, data) else f"Could not write to '{file_name}'")
+
+
+def run_operation(client, operation):
+    # One batch operation, e.g. {"op": "read", "file_name": "a", "destination": "a.out"} or
+    # {"op": "write", "file_name": "a", "data": "text"}. Reads may name an offset and length;
+    # writes may take their data from a "source" path. Reads without a destination only count
+    # the bytes
+    op = operation.get("op")
+    file_name = operation.get("file_name")
+    result = {"op": op, "file_name": file_name}
+    if "id" in operation:
+        result["id"] = operation["id"]
+    started = time.monotonic()
+    size = None
+    try:
+        if op == "read" and ("offset" in operation or "length" in operation):
+            data = client.read(file_name, operation.get("offset", 0), operation.get("length"))
+            if data is not None:
+                if "destination" in operation:
+                    with client.open_destination(operation["destination"]) as output:
+                        output.write(data)
+                size = len(data)
+        elif op == "read" and "destination" in operation:
+            size = client.request_file(file_name, operation.get("parallel"), operation["destination"])
+        elif op == "read":
+            size = sum(len(data) for data in client.iter_file(file_name))
+        elif op == "write":
+            data = operation.get("data")
+            if data is None:
+                with open(operation["source"], 'rb') as source:
+                    data = source.read()
+            if client.write_file(file_name, data):
+                size = len(data)
+        else:
+            result["message"] = f"Unknown operation {op}"
+    except (OSError, KeyError, ValueError) as e:
+        result["message"] = str(e)
+    result["status"] = "ok" if size is not None else "error"
+    result["bytes"] = size
+    result["seconds"] = time.monotonic() - started
+    return result
+
+
+def run_batch(client, operations, parallelism, output):
+    # Run the operations on a shared client with up to parallelism at once and write one JSON
+    # result per line, in input order. Returns how many failed
+    client.connection_pool.max_idle_per_address = max(client.connection_pool.max_idle_per_address, parallelism)
+    failed = 0
+    with ThreadPoolExecutor(max_workers=parallelism) as executor:
+        for line, result in enumerate(executor.map(lambda operation: run_operation(client, operation), operations), 1):
+            result["line"] = line
+            failed += result["status"] != "ok"
+            output.write(json.dumps(result) + "\n")
+            output.flush()
+    return failed
+
+
+def read_operations(path):
+    operations = []
+    with open(path, 'r') as f:
+        for line in f:
+            if line.strip():
+                operations.append(json.loads(line))
+    return operations
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Read and write files; interactive unless --batch is given")
+    parser.add_argument("--config", default="mserver_config.json")
+    parser.add_argument("--batch", metavar="JSONL", help="Run the operations in this file, one JSON object per line")
+    parser.add_argument("--parallelism", type=int, default=DEFAULT_BATCH_PARALLELISM, help="Operations run at once")
+    parser.add_argument("--output", help="Write the JSONL results here instead of stdout")
+    parser.add_argument("--verbose", action="store_true", help="Log every request, not just failures")
+    args = parser.parse_args()
+    # Log records go to stderr so batch results on stdout stay plain JSONL
+    configure_logging({"log_level": "DEBUG" if args.verbose else "WARNING"}, stream=sys.stderr)
+    if not args.batch:
+        client_handler(args.config)
+        return
+
+    operations = read_operations(args.batch)
+    results = open(args.output, 'w') if args.output else sys.stdout
+    started = time.monotonic()
+    try:
+        failed = run_batch(Client(args.config), operations, max(1, args.parallelism), results)
+    finally:
+        if results is not sys.stdout:
+            results.close()
+    print(f"{len(operations) - failed} of {len(operations)} operation(s) succeeded in "
+          f"{time.monotonic() - started:.1f}s", file=sys.stderr)
+    sys.exit(1 if failed else 0)
 
 
 # Main function to call the handler
 if __name__ == "__main__":
-    client_handler()
+    main()
@@ -0,0 +1,197 @@
+import lzma
+import os
+import struct
+import zlib
+
+BLOCK_SIZE = 64 * 1024  # Bytes of raw data compressed independently, on the wire and at rest
+# Each compressed block is framed as (flag, length); flag 0 marks a block kept raw because
+# compression did not shrink it
+BLOCK_PREFIX_FORMAT = "!BI"
+BLOCK_PREFIX_SIZE = struct.calcsize(BLOCK_PREFIX_FORMAT)
+COMPRESSED_CHUNK_MAGIC = b"GFSZ0001"
+# Index entry per stored block: (file offset, stored length, flag, crc32 of the raw block)
+INDEX_ENTRY_FORMAT = "!QIBI"
+INDEX_ENTRY_SIZE = struct.calcsize(INDEX_ENTRY_FORMAT)
+
+
+class ZlibCodec:
+    name = "zlib"
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+
+class LzmaCodec:
+    name = "lzma"
+
+    def __init__(self, preset=1):
+        self.preset = preset
+
+    def compress(self, data):
+        return lzma.compress(data, preset=self.preset)
+
+    def decompress(self, data):
+        return lzma.decompress(data)
+
+
+# Codecs by name; anything with a name, compress and decompress can be registered
+CODECS = {}
+
+
+def register_codec(codec):
+    CODECS[codec.name] = codec
+
+
+register_codec(ZlibCodec())
+register_codec(LzmaCodec())
+
+
+def get_codec(name):
+    codec = CODECS.get(name)
+    if codec is None:
+        raise ValueError(f"Unsupported encoding {name}")
+    return codec
+
+
+def negotiate(accepted):
+    # The first codec in the peer's preference list that we also support, or None
+    for name in accepted or []:
+        if name in CODECS:
+            return name
+    return None
+
+
+def compress_block(codec, block):
+    compressed = codec.compress(block)
+    if len(compressed) < len(block):
+        return 1, compressed
+    return 0, bytes(block)
+
+
+def decompress_block(codec, flag, data):
+    return codec.decompress(data) if flag else data
+
+
+def encode_payload(header, payload, codec_name):
+    # Compress a payload block by block and mark the header; returns the new payload
+    codec = get_codec(codec_name)
+    view = memoryview(payload)
+    parts = []
+    for start in range(0, len(payload), BLOCK_SIZE):
+        flag, data = compress_block(codec, view[start:start + BLOCK_SIZE])
+        parts.append(struct.pack(BLOCK_PREFIX_FORMAT, flag, len(data)))
+        parts.append(data)
+    header["encoding"] = codec_name
+    return b"".join(parts)
+
+
+def decode_payload(header, payload):
+    # Undo encode_payload if the header says the payload is compressed
+    codec_name = header.get("encoding")
+    if not codec_name or not payload:
+        return payload
+    codec = get_codec(codec_name)
+    parts = []
+    position = 0
+    while position < len(payload):
+        flag, length = struct.unpack_from(BLOCK_PREFIX_FORMAT, payload, position)
+        position += BLOCK_PREFIX_SIZE
+        parts.append(decompress_block(codec, flag, payload[position:position + length]))
+        position += length
+    return b"".join(parts)
+
+
+class CompressedChunk:
+    # A chunk stored compressed block by block, with an index so a range read only
+    # decompresses the blocks it covers. Layout: magic, codec name, block size, raw length,
+    # block count, the index, then the stored blocks
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            header = f.read(len(COMPRESSED_CHUNK_MAGIC) + 2)
+            if not header.startswith(COMPRESSED_CHUNK_MAGIC):
+                raise ValueError(f"{path} is not a compressed chunk")
+            (name_length,) = struct.unpack_from("!H", header, len(COMPRESSED_CHUNK_MAGIC))
+            self.codec = get_codec(f.read(name_length).decode())
+            self.block_size, self.length, block_count = struct.unpack("!IQI", f.read(struct.calcsize("!IQI")))
+            index = f.read(block_count * INDEX_ENTRY_SIZE)
+        self.index = [struct.unpack_from(INDEX_ENTRY_FORMAT, index, position)
+                      for position in range(0, len(index), INDEX_ENTRY_SIZE)]
+
+    def read_block(self, f, index):
+        # Raises ValueError when the block no longer matches its checksum
+        offset, stored_length, flag, checksum = self.index[index]
+        try:
+            data = decompress_block(self.codec, flag, os.pread(f.fileno(), stored_length, offset))
+        except (zlib.error, lzma.LZMAError) as e:
+            raise ValueError(f"Block {index} of {self.path} does not decompress: {e}")
+        if zlib.crc32(data) != checksum:
+            raise ValueError(f"Block {index} of {self.path} failed its checksum")
+        return data
+
+    def read(self, offset=0, length=None):
+        end = self.length if length is None else min(self.length, offset + length)
+        if end <= offset:
+            return b""
+        first = offset // self.block_size
+        last = (end - 1) // self.block_size
+        with open(self.path, 'rb') as f:
+            data = b"".join(self.read_block(f, index) for index in range(first, last + 1))
+        start = offset - first * self.block_size
+        return data[start:start + end - offset]
+
+    def verify(self):
+        try:
+            with open(self.path, 'rb') as f:
+                for index in range(len(self.index)):
+                    self.read_block(f, index)
+        except ValueError:
+            return False
+        return True
+
+
+def write_compressed_chunk(raw_path, path, codec_name, block_size=BLOCK_SIZE):
+    # Build the compressed form next to the destination and rename it into place
+    codec = get_codec(codec_name)
+    length = os.path.getsize(raw_path)
+    block_count = (length + block_size - 1) // block_size
+    encoded_name = codec_name.encode()
+    header = (COMPRESSED_CHUNK_MAGIC + struct.pack("!H", len(encoded_name)) + encoded_name
+              + struct.pack("!IQI", block_size, length, block_count))
+    offset = len(header) + block_count * INDEX_ENTRY_SIZE
+    index = []
+    blocks = []
+    with open(raw_path, 'rb') as f:
+        for _ in range(block_count):
+            block = f.read(block_size)
+            flag, data = compress_block(codec, block)
+            index.append(struct.pack(INDEX_ENTRY_FORMAT, offset, len(data), flag, zlib.crc32(block)))
+            blocks.append(data)
+            offset += len(data)
+    with open(path + ".tmp", 'wb') as f:
+        f.write(header)
+        f.write(b"".join(index))
+        for data in blocks:
+            f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+    return offset
+
+
+def inflate_chunk(path, raw_path):
+    # Write the raw form back out, checking every block on the way
+    chunk = CompressedChunk(path)
+    with open(raw_path + ".tmp", 'wb') as f:
+        with open(path, 'rb') as source:
+            for index in range(len(chunk.index)):
+                f.write(chunk.read_block(source, index))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(raw_path + ".tmp", raw_path)
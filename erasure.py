@@ -0,0 +1,160 @@
+try:
+    import numpy
+except ImportError:  # The pure Python kernel is used instead
+    numpy = None
+
+DEFAULT_DATA_SHARDS = 3  # Fragments a coded chunk is split into; any this many rebuild it
+DEFAULT_PARITY_SHARDS = 2  # Extra fragments, i.e. how many fragments may be lost
+DEFAULT_CODING_COLD_SECONDS = 0  # Seconds without writes before a file is erasure coded; 0 keeps files replicated
+DEFAULT_CODING_INTERVAL = 60  # Seconds between passes looking for cold files to code
+DEFAULT_CODING_BANDWIDTH = 8 * 1024 * 1024  # Bytes per second a server may spend sending fragments
+
+# GF(256) with the polynomial x^8 + x^4 + x^3 + x^2 + 1. The exponent table is doubled so the
+# sum of two logarithms never needs reducing
+GF_POLYNOMIAL = 0x11d
+GF_EXP = [0] * 512
+GF_LOG = [0] * 256
+_value = 1
+for _power in range(255):
+    GF_EXP[_power] = _value
+    GF_LOG[_value] = _power
+    _value <<= 1
+    if _value & 0x100:
+        _value ^= GF_POLYNOMIAL
+for _power in range(255, 512):
+    GF_EXP[_power] = GF_EXP[_power - 255]
+
+_multiply_tables = {}  # Coefficient -> 256-byte table mapping every byte to its product
+_numpy_tables = None
+
+
+def gf_multiply(a, b):
+    if a == 0 or b == 0:
+        return 0
+    return GF_EXP[GF_LOG[a] + GF_LOG[b]]
+
+
+def gf_inverse(a):
+    if a == 0:
+        raise ZeroDivisionError("0 has no inverse in GF(256)")
+    return GF_EXP[255 - GF_LOG[a]]
+
+
+def multiply_table(coefficient):
+    table = _multiply_tables.get(coefficient)
+    if table is None:
+        table = _multiply_tables[coefficient] = bytes(gf_multiply(coefficient, value) for value in range(256))
+    return table
+
+
+def combine(coefficients, shards, size):
+    # Sum over GF(256) of coefficient * shard, byte by byte, for equally long shards. Without
+    # NumPy every product is one bytes.translate and the sum one big-integer XOR, both in C
+    if numpy is not None:
+        return _combine_numpy(coefficients, shards, size)
+    total = 0
+    for coefficient, shard in zip(coefficients, shards):
+        if coefficient == 0:
+            continue
+        product = bytes(shard) if coefficient == 1 else bytes(shard).translate(multiply_table(coefficient))
+        total ^= int.from_bytes(product, "little")
+    return total.to_bytes(size, "little")
+
+
+def _combine_numpy(coefficients, shards, size):
+    global _numpy_tables
+    if _numpy_tables is None:
+        _numpy_tables = numpy.array([list(multiply_table(coefficient)) for coefficient in range(256)],
+                                    dtype=numpy.uint8)
+    total = numpy.zeros(size, dtype=numpy.uint8)
+    for coefficient, shard in zip(coefficients, shards):
+        if coefficient:
+            total ^= _numpy_tables[coefficient][numpy.frombuffer(shard, dtype=numpy.uint8)]
+    return total.tobytes()
+
+
+def invert_matrix(rows):
+    # Gauss-Jordan elimination over GF(256)
+    size = len(rows)
+    augmented = [list(row) + [int(column == index) for column in range(size)] for index, row in enumerate(rows)]
+    for column in range(size):
+        pivot = next((index for index in range(column, size) if augmented[index][column]), None)
+        if pivot is None:
+            raise ValueError("Matrix is singular")
+        augmented[column], augmented[pivot] = augmented[pivot], augmented[column]
+        scale = gf_inverse(augmented[column][column])
+        augmented[column] = [gf_multiply(scale, value) for value in augmented[column]]
+        for index in range(size):
+            factor = augmented[index][column]
+            if index != column and factor:
+                augmented[index] = [value ^ gf_multiply(factor, pivot_value)
+                                    for value, pivot_value in zip(augmented[index], augmented[column])]
+    return [row[size:] for row in augmented]
+
+
+def shard_size(length, data_shards):
+    return -(-length // data_shards)
+
+
+def fragment_handle(chunk_handle, index):
+    # Fragments are stored by chunk servers like any other chunk, under a handle of their own
+    return f"{chunk_handle}.f{index}"
+
+
+def parse_fragment_handle(handle):
+    # Returns (chunk handle, fragment index), or None for an ordinary chunk handle
+    chunk_handle, _, index = handle.rpartition(".f")
+    if not chunk_handle or not index.isdigit():
+        return None
+    return chunk_handle, int(index)
+
+
+class ReedSolomon:
+    # Systematic Reed-Solomon code: a chunk is cut into data_shards equal fragments (the last
+    # one zero-padded) followed by parity_shards parity fragments, and any data_shards of them
+    # rebuild the rest. Parity rows form a Cauchy matrix, so every square submatrix of the
+    # generator is invertible. The code works on each byte position independently, so equal
+    # byte ranges of any data_shards fragments rebuild the same range of the others
+    def __init__(self, data_shards=DEFAULT_DATA_SHARDS, parity_shards=DEFAULT_PARITY_SHARDS):
+        if data_shards < 1 or parity_shards < 0 or data_shards + parity_shards > 256:
+            raise ValueError(f"Unsupported code {data_shards}+{parity_shards}")
+        self.data_shards = data_shards
+        self.parity_shards = parity_shards
+        self.total_shards = data_shards + parity_shards
+        self.generator = [[int(row == column) for column in range(data_shards)] for row in range(data_shards)]
+        self.generator += [[gf_inverse((data_shards + row) ^ column) for column in range(data_shards)]
+                           for row in range(parity_shards)]
+
+    def encode(self, data):
+        # Returns every fragment of data, data fragments first
+        size = shard_size(len(data), self.data_shards)
+        padded = bytes(data) + bytes(size * self.data_shards - len(data))
+        shards = [padded[index * size:(index + 1) * size] for index in range(self.data_shards)]
+        return shards + [combine(self.generator[self.data_shards + row], shards, size)
+                         for row in range(self.parity_shards)]
+
+    def decode_shards(self, fragments):
+        # fragments: index -> equally long byte ranges of at least data_shards fragments.
+        # Returns the same range of every data fragment
+        if len(fragments) < self.data_shards:
+            raise ValueError(f"{len(fragments)} fragments given, {self.data_shards} needed")
+        if all(index in fragments for index in range(self.data_shards)):
+            return [fragments[index] for index in range(self.data_shards)]
+        # Prefer data fragments, which need no arithmetic
+        chosen = sorted(fragments)[:self.data_shards]
+        size = len(fragments[chosen[0]])
+        decoder = invert_matrix([self.generator[index] for index in chosen])
+        shards = [fragments[index] for index in chosen]
+        return [fragments[row] if row in fragments else combine(decoder[row], shards, size)
+                for row in range(self.data_shards)]
+
+    def decode(self, fragments, length):
+        # Rebuild the first length bytes of the chunk from whole fragments
+        return b"".join(bytes(shard) for shard in self.decode_shards(fragments))[:length]
+
+    def reconstruct(self, fragments, index):
+        # Rebuild one fragment, data or parity, from any data_shards others
+        shards = self.decode_shards(fragments)
+        if index < self.data_shards:
+            return bytes(shards[index])
+        return combine(self.generator[index], shards, len(shards[0]))
@@ -0,0 +1,171 @@
+import atexit
+import bisect
+import json
+import logging
+import logging.handlers
+import math
+import queue
+import sys
+import threading
+import time
+
+DEFAULT_LOG_LEVEL = "INFO"  # Per-request messages are DEBUG, so they cost one level check by default
+DEFAULT_LOG_FORMAT = "text"  # "text" or "json"
+# Upper bounds in seconds of the latency histogram buckets, 25% apart from 20 microseconds to
+# about 2 minutes; anything slower lands in an overflow bucket
+LATENCY_BUCKETS = [0.00002 * 1.25 ** index for index in range(71)]
+
+_logging_configured = False
+_logging_lock = threading.Lock()
+
+
+class StructuredLogger(logging.LoggerAdapter):
+    # Takes a fixed message plus key/value fields, e.g. log.info("Sealed chunk", chunk=handle,
+    # length=length). Fields given when the logger is made are added to every record
+    def __init__(self, logger, **context):
+        super().__init__(logger, context)
+
+    def process(self, msg, kwargs):
+        fields = dict(self.extra)
+        for key in list(kwargs):
+            if key not in ("exc_info", "stack_info", "stacklevel"):
+                fields[key] = kwargs.pop(key)
+        kwargs["extra"] = {"fields": fields}
+        return msg, kwargs
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        line = f"{self.formatTime(record)} {record.levelname} {record.name}: {record.getMessage()}"
+        fields = getattr(record, "fields", None)
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    # One JSON object per line
+    def format(self, record):
+        entry = {"time": record.created, "level": record.levelname, "logger": record.name,
+                 "message": record.getMessage()}
+        entry.update(getattr(record, "fields", None) or {})
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure_logging(config=None, stream=None):
+    # Records are queued by the threads that log them and written by a single background
+    # thread, so no request waits on the stream (stdout by default). Only the first call in a
+    # process takes effect
+    global _logging_configured
+    config = config or {}
+    with _logging_lock:
+        if _logging_configured:
+            return
+        _logging_configured = True
+    handler = logging.StreamHandler(stream or sys.stdout)
+    handler.setFormatter(JsonFormatter() if config.get('log_format', DEFAULT_LOG_FORMAT) == "json"
+                         else TextFormatter())
+    records = queue.SimpleQueue()
+    root = logging.getLogger("gfs")
+    root.setLevel(str(config.get('log_level', DEFAULT_LOG_LEVEL)).upper())
+    root.addHandler(logging.handlers.QueueHandler(records))
+    root.propagate = False
+    listener = logging.handlers.QueueListener(records, handler)
+    listener.start()
+    atexit.register(listener.stop)  # Flush what is still queued
+
+
+def get_logger(name, **context):
+    return StructuredLogger(logging.getLogger(f"gfs.{name}"), **context)
+
+
+class Histogram:
+    # Counts observations in fixed buckets; percentiles are reported as the upper bound of the
+    # bucket they fall in, which is within 25% of the true value
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, fraction):
+        if not self.count:
+            return None
+        rank = max(1, math.ceil(fraction * self.count))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self.bounds[index], self.max) if index < len(self.bounds) else self.max
+        return self.max
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "sum": self.total,
+            "mean": self.total / self.count if self.count else None,
+            "p50": self.percentile(0.5),
+            "p99": self.percentile(0.99),
+            "p999": self.percentile(0.999),
+            "max": self.max,
+        }
+
+
+class MetricsRegistry:
+    # Counters, gauges and latency histograms by name. Gauges can also be functions, read only
+    # when a snapshot is taken, for values the owner already tracks
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.gauge_functions = {}
+        self.histograms = {}
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+
+    def increment(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def set_gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def register_gauge(self, name, function):
+        with self.lock:
+            self.gauge_functions[name] = function
+
+    def observe(self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    def snapshot(self):
+        with self.lock:
+            gauges = dict(self.gauges)
+            functions = list(self.gauge_functions.items())
+            snapshot = {
+                "uptime": time.monotonic() - self.started,
+                "counters": dict(self.counters),
+                "histograms": {name: histogram.snapshot() for name, histogram in self.histograms.items()},
+            }
+        for name, function in functions:
+            try:
+                gauges[name] = function()
+            except Exception as e:
+                gauges[name] = f"error: {e}"
+        snapshot["gauges"] = gauges
+        return snapshot
@@ -1,181 +1,1349 @@
+import asyncio
 import socket
 import threading
 import json
+import os
 import time
+import oplog
+from concurrent.futures import ThreadPoolExecutor
+from admission import (DEFAULT_IDLE_TIMEOUT, DEFAULT_MAX_CONNECTIONS, DEFAULT_QUEUE_TIMEOUT, DEFAULT_RETRY_AFTER,
+                       DEFAULT_WORKER_THREADS, AdmissionController, AsyncAdmissionController, busy_response)
+from replication import (DEFAULT_COPIES_PER_SERVER, DEFAULT_REPLICATION_BANDWIDTH, DEFAULT_REPLICATION_DELAY,
+                         DEFAULT_REBALANCE_INTERVAL, DEFAULT_HOT_READ_RATE, DEFAULT_MAX_REPLICAS,
+                         DEFAULT_REBALANCE_THRESHOLD, DEFAULT_REBALANCE_BANDWIDTH, DEFAULT_REBALANCE_CONCURRENCY,
+                         DEFAULT_REBALANCE_WRITE_IDLE, AccessHeat, ReplicationScheduler)
+from erasure import (DEFAULT_CODING_BANDWIDTH, DEFAULT_CODING_COLD_SECONDS, DEFAULT_CODING_INTERVAL,
+                     DEFAULT_DATA_SHARDS, DEFAULT_PARITY_SHARDS, fragment_handle, parse_fragment_handle)
+from metrics import MetricsRegistry, configure_logging, get_logger
+from routing import ReadRouter
+from protocol import (ConnectionPool, read_message, recv_message, send_message, set_nodelay, wait_for_message,
+                      write_message)
+
+DEFAULT_CHUNK_SIZE = 64 * 1024 * 1024  # 64 MB chunks
+DEFAULT_REPLICATION_FACTOR = 3
+DEFAULT_LISTEN_BACKLOG = 1024
+DEFAULT_CHECKPOINT_INTERVAL = 300  # Seconds between checkpoints while the log is growing
+DEFAULT_CHECKPOINT_LOG_RECORDS = 100000  # Log records that force an early checkpoint
+DEFAULT_HEARTBEAT_INTERVAL = 2  # Seconds between chunk server heartbeats
+DEFAULT_MISSED_HEARTBEATS = 3  # Heartbeats a server may miss before it is marked down
+DEFAULT_LEASE_DURATION = 60  # Seconds a primary may order writes without hearing from us
+REPLICATION_TIMEOUT = 600  # Seconds to wait for a destination server to finish copying a chunk
+CHUNK_LOCK_STRIPES = 64  # Locks that chunk handles are hashed over
+
+log = get_logger("master")
+
+
+class LeaseHeld(Exception):
+    # The primary of a chunk stopped responding but may still hold its lease, so no other
+    # replica can be made primary until the lease runs out
+    def __init__(self, remaining):
+        super().__init__(f"Primary lease held for another {remaining:.1f}s")
+        self.remaining = remaining
+
 
 class MasterServer:
     def __init__(self, config_file='mserver_config.json'):
         self.master_address = None
         self.master_port = None
         self.chunk_servers = []  # List to hold chunk server information
-        self.server_loads = {}  # Track server loads
+        self.read_router = ReadRouter()  # Spreads reads over replicas by outstanding load and latency
+        self.server_by_address = {}  # Map "host:port" to server names for client latency feedback
         self.server_status = {}  # Track server health status
-        self.file_chunk_mapping = {}  # Map files to primary chunk servers
+        self.last_heartbeat = {}  # Monotonic time of each server's latest heartbeat
+        self.down_since = {}  # Monotonic time each server currently marked down was marked down
+        self.server_stats = {}  # Latest load report (in-flight, bytes served, free disk, used bytes) per server
+        self.access_heat = AccessHeat()  # Smoothed read rate per chunk, from the servers' heartbeats
+        self.last_write = {}  # Monotonic time of the latest write lookup per file
+        self.chunk_last_write = {}  # Monotonic time a primary last reported commits per chunk
+        self.started = time.monotonic()
+        self.reported_chunks = {}  # Chunk handles each server listed in its latest chunk report
+        self.heartbeat_interval = DEFAULT_HEARTBEAT_INTERVAL
+        self.missed_heartbeats = DEFAULT_MISSED_HEARTBEATS
+        self.chunk_size = DEFAULT_CHUNK_SIZE  # Fixed size of every chunk in bytes
+        self.replication_factor = DEFAULT_REPLICATION_FACTOR  # Replicas kept per chunk
+        self.file_chunk_mapping = {}  # Map files to their ordered list of chunk handles
+        self.chunk_replicas = {}  # Map chunk handles to the servers holding a replica
+        self.chunk_primaries = {}  # Map chunk handles to their primary server
+        self.chunk_versions = {}  # Map chunk handles to their version, bumped on every primary election
+        self.chunk_lengths = {}  # Final length of every sealed chunk; only a file's tail chunk still grows
+        # Erasure-coded chunks: handle -> data_shards, parity_shards and the server holding each
+        # fragment (None once a fragment is lost). Coded chunks keep an empty replica list
+        self.chunk_coding = {}
+        self.encoding = set()  # Chunks whose fragments are being written
+        self.version_acks = {}  # Servers told about each chunk's current version since we started
+        # Chunk handle -> (granted, expires) of its primary's lease, in monotonic time. Leases are
+        # not logged: after a restart every primary is assumed to hold a full lease
+        self.leases = {}
+        self.lease_lock = threading.Lock()  # Guards leases; heartbeats renew them without waiting on metadata_lock
+        self.lease_duration = DEFAULT_LEASE_DURATION
+        self.server_chunks = {}  # Map servers to the set of chunk handles they hold
+        self.next_chunk_handle = 1  # Counter used to mint new chunk handles
+        self.metadata_lock = threading.Lock()  # Guards the chunk metadata above
+        # Serialize sealing, allocating and electing per chunk while the RPCs they make run
+        # outside metadata_lock. Striped by handle so the set of locks stays fixed
+        self.chunk_locks = [threading.Lock() for _ in range(CHUNK_LOCK_STRIPES)]
+        self.connection_pool = ConnectionPool(timeout=5)  # Persistent connections to chunk servers
+        self.replication_pool = ConnectionPool(timeout=REPLICATION_TIMEOUT)  # Copy requests run for a while
+        self.copies_per_server = DEFAULT_COPIES_PER_SERVER
+        self.replication_bandwidth = DEFAULT_REPLICATION_BANDWIDTH  # Bytes per second per server
+        self.replication_delay = DEFAULT_REPLICATION_DELAY
+        self.replication_scheduler = None
+        self.rebalance_interval = DEFAULT_REBALANCE_INTERVAL
+        self.hot_read_rate = DEFAULT_HOT_READ_RATE
+        self.max_replicas = DEFAULT_MAX_REPLICAS
+        self.rebalance_threshold = DEFAULT_REBALANCE_THRESHOLD
+        self.rebalance_bandwidth = DEFAULT_REBALANCE_BANDWIDTH  # Bytes per second per rebalancing copy
+        self.rebalance_concurrency = DEFAULT_REBALANCE_CONCURRENCY
+        self.rebalance_write_idle = DEFAULT_REBALANCE_WRITE_IDLE
+        self.data_shards = DEFAULT_DATA_SHARDS
+        self.parity_shards = DEFAULT_PARITY_SHARDS
+        self.coding_cold_seconds = DEFAULT_CODING_COLD_SECONDS
+        self.coding_interval = DEFAULT_CODING_INTERVAL
+        self.coding_bandwidth = DEFAULT_CODING_BANDWIDTH  # Bytes per second the encoding server sends
+        self.server_mode = 'threaded'  # 'threaded' or 'asyncio'
+        self.listen_backlog = DEFAULT_LISTEN_BACKLOG
+        self.metadata_directory = 'master_metadata'  # Operation log segments and the checkpoint
+        self.checkpoint_interval = DEFAULT_CHECKPOINT_INTERVAL
+        self.checkpoint_log_records = DEFAULT_CHECKPOINT_LOG_RECORDS
+        self.operation_log = None
+        self.stats_lock = threading.Lock()
+        self.in_flight = 0  # Requests currently being handled
+        self.request_limits = None  # Per-class overrides of the admission limits
+        self.request_queue_limits = None
+        self.request_queue_timeout = DEFAULT_QUEUE_TIMEOUT
+        self.admission = AdmissionController()  # Limits on lookups running at once; rebuilt from the config
+        self.busy_retry_after = DEFAULT_RETRY_AFTER
+        self.max_connections = DEFAULT_MAX_CONNECTIONS
+        self.idle_timeout = DEFAULT_IDLE_TIMEOUT
+        self.worker_threads = DEFAULT_WORKER_THREADS
+        self.connections = 0  # Connections being served in threaded mode
+        # Request latencies and replication progress, served by the "stats" request
+        self.metrics = MetricsRegistry()
+        self.metrics.register_gauge("connections", lambda: self.connections)
+        self.metrics.register_gauge("admission", lambda: self.admission.snapshot())
+        self.metrics.register_gauge("in_flight", lambda: self.in_flight)
+        self.metrics.register_gauge("files", lambda: len(self.file_chunk_mapping))
+        self.metrics.register_gauge("chunks", lambda: len(self.chunk_replicas))
+        self.metrics.register_gauge("coded_chunks", lambda: len(self.chunk_coding))
+        self.metrics.register_gauge("servers_up", lambda: sum(self.server_status.values()))
         self.load_config(config_file)
+        self.load_metadata()
+        self.start_checkpointing()
+        self.start_health_check()  # Start the health check thread before serving blocks forever
+        self.start_re_replication()
+        self.start_rebalancer()
+        self.start_erasure_coding()
         self.init_server()
-        self.start_health_check()  # Start the health check thread
 
     def load_config(self, config_file):
         try:
             with open(config_file, 'r') as file:
                 config = json.load(file)
+            configure_logging(config)
             self.master_address = config['master_server']['address']
             self.master_port = config['master_server']['port']
             self.chunk_servers = config['chunk_servers']  # Load chunk servers as a list
+            self.chunk_size = config.get('chunk_size', DEFAULT_CHUNK_SIZE)
+            self.replication_factor = config.get('replication_factor', DEFAULT_REPLICATION_FACTOR)
+            self.server_mode = config.get('server_mode', self.server_mode)
+            self.listen_backlog = config.get('listen_backlog', self.listen_backlog)
+            self.metadata_directory = config.get('metadata_directory', self.metadata_directory)
+            self.checkpoint_interval = config.get('checkpoint_interval', self.checkpoint_interval)
+            self.checkpoint_log_records = config.get('checkpoint_log_records', self.checkpoint_log_records)
+            self.heartbeat_interval = config.get('heartbeat_interval', self.heartbeat_interval)
+            self.missed_heartbeats = config.get('missed_heartbeats', self.missed_heartbeats)
+            self.lease_duration = config.get('lease_duration', self.lease_duration)
+            self.copies_per_server = config.get('replication_copies_per_server', self.copies_per_server)
+            self.replication_bandwidth = config.get('replication_bandwidth', self.replication_bandwidth)
+            self.replication_delay = config.get('replication_delay', self.replication_delay)
+            self.rebalance_interval = config.get('rebalance_interval', self.rebalance_interval)
+            self.hot_read_rate = config.get('hot_read_rate', self.hot_read_rate)
+            self.max_replicas = config.get('max_replicas', self.max_replicas)
+            self.rebalance_threshold = config.get('rebalance_threshold', self.rebalance_threshold)
+            self.rebalance_bandwidth = config.get('rebalance_bandwidth', self.rebalance_bandwidth)
+            self.rebalance_concurrency = config.get('rebalance_concurrency', self.rebalance_concurrency)
+            self.rebalance_write_idle = config.get('rebalance_write_idle', self.rebalance_write_idle)
+            self.data_shards = config.get('erasure_data_shards', self.data_shards)
+            self.parity_shards = config.get('erasure_parity_shards', self.parity_shards)
+            self.coding_cold_seconds = config.get('erasure_cold_seconds', self.coding_cold_seconds)
+            if self.coding_cold_seconds and self.coding_cold_seconds < self.lease_duration:
+                # Clients write straight to a primary for up to a lease without asking us, so a
+                # shorter idle time could code a file that is still being written
+                log.warning("erasure_cold_seconds is shorter than a lease; using the lease duration",
+                            erasure_cold_seconds=self.coding_cold_seconds, lease_duration=self.lease_duration)
+                self.coding_cold_seconds = self.lease_duration
+            self.coding_interval = config.get('erasure_interval', self.coding_interval)
+            self.coding_bandwidth = config.get('erasure_bandwidth', self.coding_bandwidth)
+            self.request_limits = config.get('request_limits', self.request_limits)
+            self.request_queue_limits = config.get('request_queue_limits', self.request_queue_limits)
+            self.request_queue_timeout = config.get('request_queue_timeout', self.request_queue_timeout)
+            self.admission = AdmissionController(self.request_limits, self.request_queue_limits,
+                                                 self.request_queue_timeout)
+            self.busy_retry_after = config.get('busy_retry_after', self.busy_retry_after)
+            self.max_connections = config.get('max_connections', self.max_connections)
+            self.idle_timeout = config.get('idle_timeout', self.idle_timeout)
+            self.worker_threads = config.get('worker_threads', self.worker_threads)
 
             # Initialize load and status for each server
             for server in self.chunk_servers:
                 server_key = server['name']  # Unique identifier for the server
-                self.server_loads[server_key] = 0  # Initialize load for each server
+                self.server_by_address[f"{server['address']}:{server['port']}"] = server_key
                 self.server_status[server_key] = True  # Initially mark servers as healthy
+                self.last_heartbeat[server_key] = time.monotonic()  # Grace period until the first heartbeat
+                self.server_chunks[server_key] = set()
             
-            print(f"Configuration loaded from {config_file}")
-
-            # Load file-to-primary mappings from the file metadata
-            self.load_file_chunk_mapping()
+            log.info("Configuration loaded", path=config_file)
         except (FileNotFoundError, json.JSONDecodeError, ValueError) as e:
-            print(f"Error loading config file: {e}")
+            log.error("Error loading config file", error=e)
             raise
 
+    def load_metadata(self):
+        # Restart from the latest checkpoint plus the log tail; bootstrap from files_metadata.json once
+        os.makedirs(self.metadata_directory, exist_ok=True)
+        state, covered_segment = oplog.read_checkpoint(self.metadata_directory)
+        if state is None and not oplog.list_segments(self.metadata_directory):
+            self.load_file_chunk_mapping()
+            self.operation_log = oplog.OperationLog(self.metadata_directory)
+            self.checkpoint()
+            return
+
+        started = time.monotonic()
+        if state is not None:
+            self.restore_state(state)
+        replayed = 0
+        for operation in oplog.replay_segments(self.metadata_directory, covered_segment):
+            self.apply_operation(operation)
+            replayed += 1
+        self.operation_log = oplog.OperationLog(self.metadata_directory)
+        # A primary elected before the restart may still be ordering writes
+        now = time.monotonic()
+        for chunk_handle in self.chunk_primaries:
+            if chunk_handle not in self.chunk_lengths:
+                self.leases[chunk_handle] = (now, now + self.lease_duration)
+        log.info("Metadata restored", files=len(self.file_chunk_mapping), replayed=replayed,
+                 seconds=round(time.monotonic() - started, 2))
+
     def load_file_chunk_mapping(self):
         try:
             with open("files_metadata.json", "r") as f:
                 files_metadata = json.load(f)
-            
+
             for file_name, file_info in files_metadata.items():
-                primary = file_info.get("primary")
-                if primary:
-                    # Map file to primary server address
-                    primary_server = next(
-                        (server for server in self.chunk_servers if server["name"] == primary),
-                        None
-                    )
-                    if primary_server:
-                        self.file_chunk_mapping[file_name] = f"{primary_server['address']}:{primary_server['port']}"
-            print("File-to-primary mappings initialized:", self.file_chunk_mapping)
-        except (FileNotFoundError, json.JSONDecodeError) as e:
-            print(f"Error loading file metadata: {e}")
+                self.file_chunk_mapping[file_name] = []
+                for chunk in file_info.get("chunks", []):
+                    self.apply_operation({"op": "add_chunk", "file_name": file_name, "chunk_handle": chunk["handle"],
+                                          "replicas": chunk.get("replicas", [])})
+                    if chunk.get("primary") in chunk.get("replicas", []):
+                        self.apply_operation({"op": "set_primary", "chunk_handle": chunk["handle"],
+                                              "primary": chunk["primary"]})
+            log.info("File-to-chunk mappings initialized", files=len(self.file_chunk_mapping))
+        except (FileNotFoundError, json.JSONDecodeError, KeyError, ValueError) as e:
+            log.error("Error loading file metadata", error=e)
+
+    def restore_state(self, state):
+        self.next_chunk_handle = state["next_chunk_handle"]
+        self.file_chunk_mapping = state["file_chunk_mapping"]
+        self.chunk_replicas = state["chunk_replicas"]
+        self.chunk_primaries = state["chunk_primaries"]
+        self.chunk_versions = state["chunk_versions"]
+        self.chunk_lengths = state["chunk_lengths"]
+        self.chunk_coding = state["chunk_coding"]
+        for chunk_handle, replicas in self.chunk_replicas.items():
+            for name in replicas:
+                if name in self.server_chunks:
+                    self.server_chunks[name].add(chunk_handle)
+        for chunk_handle, coding in self.chunk_coding.items():
+            for index, name in enumerate(coding["fragments"]):
+                if name in self.server_chunks:
+                    self.server_chunks[name].add(fragment_handle(chunk_handle, index))
+
+    def apply_operation(self, operation):
+        # Every metadata mutation goes through here, both live and during log replay
+        op = operation["op"]
+        chunk_handle = operation.get("chunk_handle")
+        if op == "add_chunk":
+            replicas = [name for name in operation["replicas"] if name in self.server_chunks]
+            self.file_chunk_mapping.setdefault(operation["file_name"], []).append(chunk_handle)
+            self.chunk_replicas[chunk_handle] = replicas
+            for name in replicas:
+                self.server_chunks[name].add(chunk_handle)
+            self.next_chunk_handle = max(self.next_chunk_handle, int(chunk_handle, 16) + 1)
+        elif op == "set_primary":
+            self.chunk_primaries[chunk_handle] = operation["primary"]
+            if "version" in operation:
+                self.chunk_versions[chunk_handle] = operation["version"]
+        elif op == "add_replica":
+            name = operation["server"]
+            if name in self.server_chunks and name not in self.chunk_replicas.setdefault(chunk_handle, []):
+                self.chunk_replicas[chunk_handle].append(name)
+                self.server_chunks[name].add(chunk_handle)
+        elif op == "seal_chunk":
+            self.chunk_lengths[chunk_handle] = operation["length"]
+            with self.lease_lock:
+                self.leases.pop(chunk_handle, None)
+        elif op == "remove_replica":
+            name = operation["server"]
+            if name in self.chunk_replicas.get(chunk_handle, []):
+                self.chunk_replicas[chunk_handle].remove(name)
+            self.server_chunks.get(name, set()).discard(chunk_handle)
+            if self.chunk_primaries.get(chunk_handle) == name:
+                del self.chunk_primaries[chunk_handle]
+        elif op == "encode_chunk":
+            # The fragments replace every replica; servers delete the replicas once their chunk
+            # reports show them untracked
+            for name in self.chunk_replicas.get(chunk_handle, []):
+                self.server_chunks[name].discard(chunk_handle)
+            self.chunk_replicas[chunk_handle] = []
+            self.chunk_primaries.pop(chunk_handle, None)
+            fragments = [name if name in self.server_chunks else None for name in operation["fragments"]]
+            self.chunk_coding[chunk_handle] = {"data_shards": operation["data_shards"],
+                                               "parity_shards": operation["parity_shards"], "fragments": fragments}
+            for index, name in enumerate(fragments):
+                if name:
+                    self.server_chunks[name].add(fragment_handle(chunk_handle, index))
+        elif op == "set_fragment":
+            # Moves a fragment to a server, or marks it lost when the server is None
+            coding = self.chunk_coding.get(chunk_handle)
+            if coding:
+                index = operation["index"]
+                previous = coding["fragments"][index]
+                if previous in self.server_chunks:
+                    self.server_chunks[previous].discard(fragment_handle(chunk_handle, index))
+                name = operation["server"] if operation["server"] in self.server_chunks else None
+                coding["fragments"][index] = name
+                if name:
+                    self.server_chunks[name].add(fragment_handle(chunk_handle, index))
+        else:
+            log.error("Unknown metadata operation", op=op)
+
+    def log_operation(self, operation):
+        # Apply and log a mutation; callers hold metadata_lock and wait for durability before replying
+        self.apply_operation(operation)
+        return self.operation_log.append(operation)
+
+    def checkpoint(self):
+        # Snapshot under the lock and roll the log so the snapshot covers every closed segment
+        with self.metadata_lock:
+            state = {
+                "next_chunk_handle": self.next_chunk_handle,
+                "file_chunk_mapping": {name: list(handles) for name, handles in self.file_chunk_mapping.items()},
+                "chunk_replicas": {handle: list(replicas) for handle, replicas in self.chunk_replicas.items()},
+                "chunk_primaries": dict(self.chunk_primaries),
+                "chunk_versions": dict(self.chunk_versions),
+                "chunk_lengths": dict(self.chunk_lengths),
+                "chunk_coding": {handle: dict(coding, fragments=list(coding["fragments"]))
+                                 for handle, coding in self.chunk_coding.items()},
+            }
+            covered_segment = self.operation_log.roll()
+        oplog.write_checkpoint(self.metadata_directory, state, covered_segment)
+        oplog.remove_segments(self.metadata_directory, covered_segment)
+        log.info("Checkpoint written", files=len(state['file_chunk_mapping']))
+
+    def start_checkpointing(self):
+        checkpoint_thread = threading.Thread(target=self.run_checkpoints, daemon=True)
+        checkpoint_thread.start()
+
+    def run_checkpoints(self):
+        last_checkpoint = time.monotonic()
+        while True:
+            time.sleep(1)
+            records = self.operation_log.records_since_roll
+            due = time.monotonic() - last_checkpoint >= self.checkpoint_interval
+            if records >= self.checkpoint_log_records or (records and due):
+                try:
+                    self.checkpoint()
+                except OSError as e:
+                    log.error("Error writing checkpoint", error=e)
+                last_checkpoint = time.monotonic()
 
     def init_server(self):
+        if self.server_mode == 'asyncio':
+            asyncio.run(self.init_server_async())
+            return
         try:
             self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             self.server_socket.bind((self.master_address, self.master_port))
-            self.server_socket.listen(5)
-            print(f"Master Server started at {self.master_address}:{self.master_port}")
+            self.server_socket.listen(self.listen_backlog)
+            log.info("Master server started", address=f"{self.master_address}:{self.master_port}")
 
             while True:
                 conn, addr = self.server_socket.accept()
-                print(f"Connected by {addr}")
+                set_nodelay(conn)
+                with self.stats_lock:
+                    accepted = self.connections < self.max_connections
+                    if accepted:
+                        self.connections += 1
+                if not accepted:
+                    self.reject_connection(conn)
+                    continue
+                log.debug("Connection accepted", peer=addr)
                 client_thread = threading.Thread(target=self.handle_client, args=(conn,))
                 client_thread.start()
         except Exception as e:
-            print(f"Error starting Master Server: {e}")
+            log.error("Error starting master server", error=e)
 
-    def handle_client(self, conn):
+    def reject_connection(self, conn):
+        # Past the connection limit the client gets a busy reply instead of a thread
+        self.metrics.increment("connections_rejected")
         try:
-            # Receive request from the client
-            data = conn.recv(4096)
-            if not data:
-                print("No data received from client.")
-                return
+            conn.settimeout(1)
+            send_message(conn, busy_response(self.busy_retry_after))
+        except OSError:
+            pass
+        finally:
+            conn.close()
 
-            # Parse the client request
-            request = json.loads(data.decode('utf-8'))
-            request_type = request.get("type")
-            file_name = request.get("file_name")
-
-            if request_type == "read":
-                # Handle read request
-                print(f"Received read request for file: {file_name}")
-                chunk_server_address = self.get_chunk_server_for_file(file_name, is_write=False)
-                if chunk_server_address:
-                    conn.sendall(chunk_server_address.encode())
-                    print(f"Sent chunk server address to client: {chunk_server_address}")
-                else:
-                    print(f"No chunk server found for file: {file_name}")
-                    conn.sendall(b"Error: File not found")
-
-            elif request_type == "write":
-                print(f"Received write request for file: {file_name}")
-                chunk_server_address = self.get_chunk_server_for_file(file_name, is_write=True)
-                if chunk_server_address:
-                    response = json.dumps({"address": chunk_server_address.split(":")[0],
-                                           "port": int(chunk_server_address.split(":")[1])})
-                    conn.sendall(response.encode())
-                    print(f"Sent primary server address to client: {chunk_server_address}")
-                else:
-                    print("No available chunk servers to assign as primary.")
-                    conn.sendall(b"Error: No available chunk server for writing.")
+    def request_class(self, request):
+        # Lookups are limited; heartbeats and other control traffic are never turned away
+        request_type = request.get("type")
+        if request_type in ("read", "lookup_batch"):
+            return "read"
+        if request_type == "write":
+            return "write"
+        return None
 
+    async def init_server_async(self):
+        # One event loop serves every client connection instead of a thread per connection;
+        # blocking work runs on a fixed pool of worker threads
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=self.worker_threads))
+        self.admission = AsyncAdmissionController(self.request_limits, self.request_queue_limits,
+                                                  self.request_queue_timeout)
+        try:
+            server = await asyncio.start_server(self.handle_client_async, self.master_address, self.master_port,
+                                                backlog=self.listen_backlog, reuse_address=True)
+            log.info("Master server started", address=f"{self.master_address}:{self.master_port}", mode="asyncio")
+            async with server:
+                await server.serve_forever()
+        except Exception as e:
+            log.error("Error starting master server", error=e)
+
+    async def handle_client_async(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                request, _ = await read_message(reader)
+                if request is None:
+                    break
+                request_class = self.request_class(request)
+                if not await self.admission.admit_async(request_class):
+                    self.metrics.increment(f"busy.{request_class}")
+                    await write_message(writer, busy_response(self.busy_retry_after))
+                    continue
+                try:
+                    if request.get("type") in ("write", "corrupt_chunk", "heartbeat") or "offset" in request:
+                        # Writes may seal chunks and notify a new primary over the network, heartbeats may
+                        # log stale replicas and wait for the log, and ranged reads may ask a replica for
+                        # a chunk length, so keep them off the loop
+                        response = await loop.run_in_executor(None, self.handle_request, request)
+                    else:
+                        response = self.handle_request(request)
+                finally:
+                    await self.admission.release_async(request_class)
+                await write_message(writer, response)
+        except Exception as e:
+            log.warning("Error handling client request", error=e)
+        finally:
+            writer.close()
+
+    def handle_client(self, conn):
+        try:
+            # Serve framed requests until the client closes its persistent connection or leaves
+            # it idle; pools retry a request once on a connection closed while idle
+            while True:
+                if not wait_for_message(conn, self.idle_timeout):
+                    self.metrics.increment("connections_idle_closed")
+                    break
+                request, _ = recv_message(conn)
+                if request is None:
+                    break
+                request_class = self.request_class(request)
+                if not self.admission.admit(request_class):
+                    self.metrics.increment(f"busy.{request_class}")
+                    send_message(conn, busy_response(self.busy_retry_after))
+                    continue
+                try:
+                    response = self.handle_request(request)
+                finally:
+                    self.admission.release(request_class)
+                send_message(conn, response)
         except Exception as e:
-            print(f"Error handling client request: {e}")
+            log.warning("Error handling client request", error=e)
         finally:
+            with self.stats_lock:
+                self.connections -= 1
             conn.close()
 
-    def get_chunk_server_for_file(self, file_name, is_write=False):
+    def handle_request(self, request):
+        started = time.monotonic()
+        with self.stats_lock:
+            self.in_flight += 1
+        try:
+            return self.dispatch_request(request)
+        finally:
+            with self.stats_lock:
+                self.in_flight -= 1
+            self.metrics.observe(f"request.{request.get('type')}", time.monotonic() - started)
+
+    def dispatch_request(self, request):
+        request_type = request.get("type")
+        file_name = request.get("file_name")
+        if "latency_feedback" in request:
+            self.record_latency_feedback(request["latency_feedback"])
+
+        if request_type == "read":
+            # Handle read request: resolve every chunk of the file, or only those covering a byte range
+            log.debug("Read request", file=file_name, offset=request.get("offset"), length=request.get("length"))
+            all_replicas = request.get("all_replicas", False)
+            if "offset" in request:
+                chunk_locations = self.get_chunk_locations_for_range(file_name, request["offset"], request.get("length"),
+                                                                     all_replicas)
+            else:
+                chunk_locations = self.get_chunk_locations_for_file(file_name, all_replicas)
+            if chunk_locations is not None:
+                log.debug("Sent chunk locations", file=file_name, chunks=len(chunk_locations))
+                return {"status": "ok", "chunks": chunk_locations}
+            log.debug("File not found", file=file_name)
+            return {"status": "error", "message": "File not found"}
+
+        elif request_type == "stats":
+            return {"status": "ok", "stats": self.metrics.snapshot()}
+
+        elif request_type == "heartbeat":
+            stale_chunks = self.record_heartbeat(request)
+            response = {"status": "ok", "leases": self.renew_leases(request.get("server"), request.get("leases", []))}
+            if stale_chunks:
+                # The replicas are dropped from the metadata before the server is told to delete them
+                self.operation_log.wait_durable()
+                response["stale_chunks"] = stale_chunks
+            return response
+
+        elif request_type == "corrupt_chunk":
+            delete = self.drop_corrupt_replica(request.get("server"), request.get("chunk_handle"))
+            return {"status": "ok", "delete": delete}
+
+        elif request_type == "lookup_batch":
+            # Resolve many files in one round-trip; unknown files map to None
+            all_replicas = request.get("all_replicas", False)
+            file_names = request.get("file_names", [])
+            log.debug("Batch lookup", files=len(file_names))
+            return {"status": "ok",
+                    "files": {name: self.get_chunk_locations_for_file(name, all_replicas) for name in file_names}}
+
+        elif request_type == "write":
+            # The client names the chunk it found full so we only allocate one new tail chunk
+            log.debug("Write request", file=file_name)
+            self.last_write[file_name] = time.monotonic()
+            full_chunk = request.get("full_chunk")
+            try:
+                grant = self.get_chunk_server_for_file(file_name, is_write=True, full_chunk=full_chunk)
+            except LeaseHeld as e:
+                log.info("Waiting for the lease of an unreachable primary", file=file_name, remaining=round(e.remaining, 1))
+                return busy_response(e.remaining)
+            # Any chunk allocation or primary election must be on disk before the client acts on it
+            self.operation_log.wait_durable()
+            if grant is None:
+                log.warning("No available chunk servers to assign as primary", file=file_name)
+                return {"status": "error", "message": "No available chunk server for writing."}
+            chunk_handle = grant["chunk_handle"]
+            self.chunk_last_write[chunk_handle] = time.monotonic()
+            if grant["primary"] is None:
+                log.info("Primary was dropped before the write was answered", file=file_name, chunk=chunk_handle)
+                return busy_response(self.busy_retry_after)
+            primary_server = self.get_server(grant["primary"])
+            secondaries = [[server['address'], server['port']] for server in map(self.get_server, grant["secondaries"])]
+            log.debug("Sent primary to client", file=file_name, chunk=chunk_handle, primary=primary_server['name'])
+            # The client may keep writing straight to the primary until the lease runs out
+            return {"status": "ok",
+                    "chunk_handle": chunk_handle,
+                    "address": primary_server['address'],
+                    "port": primary_server['port'],
+                    "secondaries": secondaries,
+                    "version": grant["version"],
+                    "lease_seconds": max(0.0, grant["expires"] - time.monotonic())}
+
+        log.warning("Unknown request type", type=request_type)
+        return {"status": "error", "message": f"Unknown request type {request_type}"}
+
+    def get_server(self, server_name):
+        return next((server for server in self.chunk_servers if server['name'] == server_name), None)
+
+    def get_chunk_server_for_file(self, file_name, is_write=False, full_chunk=None):
         if is_write:
-            # Check if there's already a primary for this file
-            primary_address = self.file_chunk_mapping.get(file_name)
-            if not primary_address:
-                # Elect a new primary server if none exists
-                primary_server = self.select_primary_server(file_name)
-                if primary_server:
-                    primary_address = f"{primary_server['address']}:{primary_server['port']}"
-                    self.file_chunk_mapping[file_name] = primary_address
-                    print(f"Primary server for '{file_name}' selected: {primary_address}")
-                    self.notify_primary_server(primary_server, file_name)
-            return primary_address
+            while True:
+                with self.metadata_lock:
+                    handles = self.file_chunk_mapping.get(file_name, [])
+                    tail = handles[-1] if handles else None
+                # Whoever moves a file to a new tail chunk holds the lock of its current tail, or of
+                # the file name while it has none, so the tail is checked again under that lock
+                with self.chunk_lock(tail or file_name):
+                    with self.metadata_lock:
+                        handles = self.file_chunk_mapping.get(file_name, [])
+                        if (handles[-1] if handles else None) != tail:
+                            continue
+                        # Allocate a new tail chunk for new files or when the client filled the current one.
+                        # A sealed tail chunk, e.g. one sealed to be copied or erasure coded, takes no more
+                        # appends, so no primary is ever elected for it again
+                        full = tail is None or tail in self.chunk_lengths or full_chunk == tail
+                    if not full:
+                        return self.ensure_primary(file_name, tail)
+                    if tail and not self.seal_chunk(tail):
+                        remaining = self.lease_remaining(tail)
+                        if remaining > 0:
+                            raise LeaseHeld(remaining)
+                    with self.metadata_lock:
+                        if not self.allocate_chunk(file_name):
+                            return None
+                # The new tail chunk gets its primary on the next pass, under its own lock
         else:
-            # For read requests, return any available server
-            return self.select_any_server(file_name)
+            # For read requests, return any available replica of the first chunk
+            handles = self.file_chunk_mapping.get(file_name)
+            if not handles:
+                return None
+            return self.select_any_server(handles[0])
+
+    def ensure_primary(self, file_name, chunk_handle):
+        # Elect a new primary for the tail chunk once no primary holds a lease. A primary that
+        # went down, or whose replica was dropped, may still be serving writes until its lease
+        # runs out. Called with the chunk's lock held: the election is decided and logged under
+        # metadata_lock, and the replicas are told once it is durable, outside it. Returns the
+        # chunk's primary_grant, or None if no replica could be made primary
+        with self.metadata_lock:
+            primary_name = self.chunk_primaries.get(chunk_handle)
+            remaining = self.lease_remaining(chunk_handle)
+            if remaining > 0:
+                if not primary_name or not self.server_status.get(primary_name):
+                    raise LeaseHeld(remaining)
+                return self.primary_grant(chunk_handle)
+            with self.lease_lock:
+                self.leases.pop(chunk_handle, None)
+            primary_server = self.select_primary_server(chunk_handle)
+            if not primary_server:
+                return None
+            # A new version marks every replica that misses this election as stale
+            version = self.chunk_versions.get(chunk_handle, 0) + 1
+            self.log_operation({"op": "set_primary", "chunk_handle": chunk_handle,
+                                "primary": primary_server['name'], "version": version})
+        self.operation_log.wait_durable()
+        log.info("Primary selected", file=file_name, chunk=chunk_handle, primary=primary_server['name'],
+                 version=version)
+        self.notify_primary_server(primary_server, chunk_handle, version)
+        if primary_server['name'] not in self.version_acks[chunk_handle]:
+            return None
+        with self.metadata_lock:
+            return self.primary_grant(chunk_handle)
+
+    def primary_grant(self, chunk_handle):
+        # What a writer is told about the chunk's primary, read together with metadata_lock held.
+        # The primary is None once its replica was dropped, e.g. as stale or corrupt, or the
+        # chunk was erasure coded
+        primary_name = self.chunk_primaries.get(chunk_handle)
+        _, expires = self.leases.get(chunk_handle, (0, 0))
+        return {"chunk_handle": chunk_handle, "primary": primary_name,
+                "secondaries": [name for name in self.chunk_replicas.get(chunk_handle, []) if name != primary_name],
+                "version": self.chunk_versions.get(chunk_handle, 0), "expires": expires}
 
-    def select_any_server(self, file_name):
+    def chunk_lock(self, key):
+        return self.chunk_locks[hash(key) % len(self.chunk_locks)]
+
+    def get_chunk_locations_for_file(self, file_name, all_replicas=False):
+        handles = self.file_chunk_mapping.get(file_name)
+        if handles is None:
+            return None
+        chunk_locations = []
+        for chunk_handle in handles:
+            location = self.locate_chunk(chunk_handle, all_replicas)
+            if location is None:
+                # A chunk with no live replica makes the whole file unreadable
+                return None
+            chunk_locations.append(location)
+        return chunk_locations
+
+    def get_chunk_locations_for_range(self, file_name, offset, length=None, all_replicas=False):
+        # Resolve only the chunks covering [offset, offset + length); each location carries the
+        # range to read inside its chunk. A None length reads to the end of the file
+        handles = self.file_chunk_mapping.get(file_name)
+        if handles is None:
+            return None
+        end = None if length is None else offset + length
+        chunk_locations = []
+        position = 0  # File offset of the current chunk
+        for index, chunk_handle in enumerate(handles):
+            if end is not None and position >= end:
+                break
+            tail = index == len(handles) - 1
+            chunk_length = None if tail else self.get_sealed_length(chunk_handle)
+            if chunk_length is None and not tail:
+                log.warning("Length of sealed chunk is unknown", chunk=chunk_handle)
+                return None
+            if chunk_length is not None and position + chunk_length <= offset:
+                position += chunk_length
+                continue
+
+            start = max(0, offset - position)
+            read_length = None if end is None else end - position - start
+            if chunk_length is not None:
+                read_length = chunk_length - start if read_length is None else min(read_length, chunk_length - start)
+            location = self.locate_chunk(chunk_handle, all_replicas)
+            if location is None:
+                return None
+            location.update(offset=start, length=read_length)
+            chunk_locations.append(location)
+            if tail:
+                break
+            position += chunk_length
+        return chunk_locations
+
+    def locate_chunk(self, chunk_handle, all_replicas=False):
+        if chunk_handle in self.chunk_coding:
+            return self.locate_fragments(chunk_handle)
+        if all_replicas:
+            # Parallel readers stripe each chunk over every live replica
+            addresses = self.select_live_servers(chunk_handle)
+            return {"chunk_handle": chunk_handle, "addresses": addresses} if addresses else None
+        address = self.select_any_server(chunk_handle)
+        return {"chunk_handle": chunk_handle, "address": address} if address else None
+
+    def locate_fragments(self, chunk_handle):
+        # Clients rebuild a coded chunk from any data_shards of its fragments; fragments on
+        # servers that are down, or lost, have no address
+        coding = self.chunk_coding[chunk_handle]
+        addresses = []
+        for name in coding["fragments"]:
+            server = self.get_server(name) if name and self.server_status[name] else None
+            addresses.append(f"{server['address']}:{server['port']}" if server else None)
+        if sum(address is not None for address in addresses) < coding["data_shards"]:
+            return None
+        return {"chunk_handle": chunk_handle,
+                "coding": {"data_shards": coding["data_shards"], "parity_shards": coding["parity_shards"],
+                           "length": self.chunk_lengths[chunk_handle], "fragments": addresses}}
+
+    def lease_remaining(self, chunk_handle):
+        _, expires = self.leases.get(chunk_handle, (0, 0))
+        return expires - time.monotonic()
+
+    def seal_chunk(self, chunk_handle):
+        # Called with the chunk's lock held when a file moves on to a new tail chunk or a chunk is
+        # about to be copied or coded. Every live replica stops accepting appends, the primary
+        # first, and the shortest one holds exactly the committed bytes. Returns whether the
+        # chunk is sealed: it is not while a primary we cannot seal may still hold its lease
+        with self.metadata_lock:
+            if chunk_handle in self.chunk_lengths:
+                return True
+            primary_name = self.chunk_primaries.get(chunk_handle)
+            if primary_name and not self.server_status[primary_name] and self.lease_remaining(chunk_handle) > 0:
+                log.info("Not sealing chunk while its unreachable primary holds the lease", chunk=chunk_handle,
+                         primary=primary_name)
+                return False
+            replicas = sorted((name for name in self.chunk_replicas.get(chunk_handle, []) if self.server_status[name]),
+                              key=lambda name: name != primary_name)
+        lengths = {}
+        for name in replicas:
+            server = self.get_server(name)
+            try:
+                response, _ = self.connection_pool.request((server['address'], server['port']),
+                                                           {"type": "seal_chunk", "chunk_handle": chunk_handle})
+                if response.get("status") == "ok":
+                    lengths[name] = response["length"]
+                else:
+                    log.warning("Failed to seal chunk", chunk=chunk_handle, server=name, error=response.get('message'))
+            except Exception as e:
+                log.warning("Failed to seal chunk", chunk=chunk_handle, server=name, error=e)
+        if not lengths or (primary_name and primary_name not in lengths and self.lease_remaining(chunk_handle) > 0):
+            return False
+        length = min(lengths.values())
+        with self.metadata_lock:
+            self.log_operation({"op": "seal_chunk", "chunk_handle": chunk_handle, "length": length})
+        log.info("Sealed chunk", chunk=chunk_handle, length=length)
+        return True
+
+    def query_chunk_length(self, chunk_handle):
+        # Every replica holds the committed bytes, so the shortest live one has exactly those
+        lengths = []
+        for name in self.chunk_replicas.get(chunk_handle, []):
+            server = self.get_server(name)
+            if not self.server_status[name]:
+                continue
+            try:
+                response, _ = self.connection_pool.request((server['address'], server['port']),
+                                                           {"type": "chunk_length", "chunk_handle": chunk_handle})
+                if response.get("status") == "ok":
+                    lengths.append(response["length"])
+            except Exception as e:
+                log.warning("Failed to get chunk length", chunk=chunk_handle, server=name, error=e)
+        return min(lengths) if lengths else None
+
+    def get_sealed_length(self, chunk_handle):
+        # Chunks sealed before lengths were tracked are measured once and recorded
+        if chunk_handle not in self.chunk_lengths:
+            with self.chunk_lock(chunk_handle):
+                if chunk_handle not in self.chunk_lengths:
+                    length = self.query_chunk_length(chunk_handle)
+                    if length is None:
+                        return None
+                    with self.metadata_lock:
+                        self.log_operation({"op": "seal_chunk", "chunk_handle": chunk_handle, "length": length})
+        return self.chunk_lengths[chunk_handle]
+
+    def allocate_chunk(self, file_name):
+        # Place the new chunk on the live servers currently holding the fewest chunks
         available_servers = [server for server in self.chunk_servers if self.server_status[server['name']]]
-        if available_servers:
-            least_loaded_server = min(available_servers, key=lambda server: self.server_loads[server['name']])
-            self.server_loads[least_loaded_server['name']] += 1
-            return f"{least_loaded_server['address']}:{least_loaded_server['port']}"
+        if not available_servers:
+            return None
+        available_servers.sort(key=lambda server: len(self.server_chunks[server['name']]))
+        replicas = [server['name'] for server in available_servers[:self.replication_factor]]
+
+        chunk_handle = f"{self.next_chunk_handle:016x}"
+        self.log_operation({"op": "add_chunk", "file_name": file_name, "chunk_handle": chunk_handle,
+                            "replicas": replicas})
+        log.info("Allocated chunk", file=file_name, chunk=chunk_handle, replicas=replicas)
+        return chunk_handle
+
+    def select_primary_server(self, chunk_handle):
+        live_replicas = [name for name in self.chunk_replicas.get(chunk_handle, []) if self.server_status[name]]
+        if live_replicas:
+            return self.get_server(live_replicas[0])
         return None
 
+    def select_any_server(self, chunk_handle):
+        # Route the read to one live replica of the chunk
+        addresses = self.select_live_servers(chunk_handle)
+        return addresses[0] if addresses else None
+
+    def select_live_servers(self, chunk_handle):
+        # Return every live replica of the chunk, the routed choice first and the rest cheapest first
+        live_replicas = [name for name in self.chunk_replicas.get(chunk_handle, []) if self.server_status[name]]
+        ordered = self.read_router.order(live_replicas)
+        if ordered:
+            self.read_router.record_routed(ordered[0])
+        return [f"{server['address']}:{server['port']}" for server in map(self.get_server, ordered)]
 
-    def notify_primary_server(self, primary_server, file_name):
+    def record_latency_feedback(self, feedback):
+        # Clients report their observed read latency per chunk server address
+        for address, seconds in feedback.items():
+            server_name = self.server_by_address.get(address)
+            if server_name:
+                self.read_router.observe_latency(server_name, seconds)
+
+    def notify_primary_server(self, primary_server, chunk_handle, version):
+        # Secondaries learn the new version first; the primary then trims any uncommitted tail
+        acked = set()
+        secondaries = []
+        for name in list(self.chunk_replicas.get(chunk_handle, [])):
+            server = self.get_server(name)
+            if name == primary_server['name'] or not self.server_status[name]:
+                continue
+            try:
+                notification = {"type": "version_update", "chunk_handle": chunk_handle, "version": version}
+                self.connection_pool.request((server['address'], server['port']), notification)
+                acked.add(name)
+                secondaries.append([server['address'], server['port']])
+            except Exception as e:
+                log.warning("Failed to send chunk version", chunk=chunk_handle, version=version, server=name, error=e)
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.connect((primary_server['address'], primary_server['port']))
-                notification = json.dumps({"type": "primary_assignment", "file_name": file_name})
-                s.sendall(notification.encode())
-                print(f"Primary server {primary_server['name']} notified for file: {file_name}")
+            notification = {"type": "primary_assignment", "chunk_handle": chunk_handle, "version": version,
+                            "secondaries": secondaries, "lease_seconds": self.lease_duration}
+            self.connection_pool.request((primary_server['address'], primary_server['port']), notification)
+            # Granted once the primary has it, so our lease never ends before the primary's does
+            now = time.monotonic()
+            with self.lease_lock:
+                self.leases[chunk_handle] = (now, now + self.lease_duration)
+            acked.add(primary_server['name'])
+            log.debug("Primary notified", chunk=chunk_handle, server=primary_server['name'])
         except Exception as e:
-            print(f"Failed to notify primary server {primary_server['name']}: {e}")
+            log.warning("Failed to notify primary", chunk=chunk_handle, server=primary_server['name'], error=e)
+        self.version_acks[chunk_handle] = acked
 
-    def select_any_server(self, file_name):
-        # Select any server to handle the read request
-        available_servers = [server for server in self.chunk_servers if self.server_status[server['name']]]
-        if available_servers:
-            least_loaded_server = min(available_servers, key=lambda server: self.server_loads[server['name']])
-            self.server_loads[least_loaded_server['name']] += 1
-            return f"{least_loaded_server['address']}:{least_loaded_server['port']}"
-        return None
+    def record_heartbeat(self, heartbeat):
+        # Returns the chunks the server holds stale replicas of
+        server_name = heartbeat.get("server")
+        if server_name not in self.server_status:
+            log.warning("Heartbeat from unknown server", server=server_name)
+            return []
+        self.last_heartbeat[server_name] = time.monotonic()
+        previous = self.server_stats.get(server_name, {})
+        self.server_stats[server_name] = {
+            "in_flight": heartbeat.get("in_flight", 0),
+            "bytes_served": heartbeat.get("bytes_served", 0),
+            "free_disk": heartbeat.get("free_disk"),
+            # Only sent with chunk reports, so the last known value carries over
+            "used_bytes": heartbeat.get("used_bytes", previous.get("used_bytes")),
+        }
+        self.access_heat.record(heartbeat.get("chunk_reads", {}))
+        for chunk_handle in heartbeat.get("chunk_writes", {}):
+            self.chunk_last_write[chunk_handle] = self.last_heartbeat[server_name]
+        stale_chunks = []
+        if "chunks" in heartbeat:
+            self.reported_chunks[server_name] = set(heartbeat["chunks"])
+            stale_chunks = self.find_stale_replicas(server_name, heartbeat["chunks"])
+        self.read_router.report_load(server_name, heartbeat.get("in_flight", 0), heartbeat.get("latency"))
+        if not self.server_status[server_name]:
+            log.info("Server is back up", server=server_name)
+            self.server_status[server_name] = True
+            self.down_since.pop(server_name, None)
+        return stale_chunks
+
+    def renew_leases(self, server_name, held_leases):
+        # Extends the leases a primary reports holding and returns the renewed ones with their
+        # duration. The server counts the duration from when it sent the heartbeat, which is no
+        # later than when we count it from. Only lease_lock is taken, so renewals never wait
+        # behind a seal or an election. A lease is only extended while its chunk is written; an
+        # idle one runs out so the chunk can be moved or coded, and the next write elects again
+        now = time.monotonic()
+        held_leases = set(held_leases)
+        renewed = {}
+        with self.lease_lock:
+            for chunk_handle, (granted, expires) in list(self.leases.items()):
+                if self.chunk_primaries.get(chunk_handle) != server_name:
+                    continue
+                if chunk_handle in held_leases and expires > now:
+                    if now - self.chunk_last_write.get(chunk_handle, granted) < self.lease_duration:
+                        self.leases[chunk_handle] = (now, now + self.lease_duration)
+                        renewed[chunk_handle] = self.lease_duration
+                elif chunk_handle not in held_leases and now - granted > 2 * self.heartbeat_interval:
+                    # The primary restarted or let the lease lapse, e.g. while we were down; a
+                    # lease granted since the heartbeat was sent is given time to show up
+                    del self.leases[chunk_handle]
+        return renewed
+
+    def drop_corrupt_replica(self, server_name, chunk_handle):
+        # Forget a replica that failed its checksums, unless it is the last copy we have
+        fragment = parse_fragment_handle(chunk_handle)
+        if fragment:
+            return self.drop_corrupt_fragment(server_name, *fragment)
+        with self.metadata_lock:
+            replicas = self.chunk_replicas.get(chunk_handle, [])
+            if server_name not in replicas:
+                return True
+            if len(replicas) == 1:
+                log.warning("Only replica is corrupt; keeping it", chunk=chunk_handle, server=server_name)
+                return False
+            self.log_operation({"op": "remove_replica", "chunk_handle": chunk_handle, "server": server_name})
+        self.operation_log.wait_durable()
+        log.info("Dropped corrupt replica", chunk=chunk_handle, server=server_name)
+        return True
+
+    def drop_corrupt_fragment(self, server_name, chunk_handle, index):
+        # The fragment is rebuilt elsewhere from the others by the re-replication pass
+        with self.metadata_lock:
+            coding = self.chunk_coding.get(chunk_handle)
+            if not coding or coding["fragments"][index] != server_name:
+                return True
+            self.log_operation({"op": "set_fragment", "chunk_handle": chunk_handle, "index": index, "server": None})
+        self.operation_log.wait_durable()
+        log.info("Dropped corrupt fragment", chunk=chunk_handle, index=index, server=server_name)
+        return True
+
+    def find_stale_replicas(self, server_name, reported_versions):
+        # A replica reporting an older version missed mutations while it was unreachable.
+        # Servers we told about the current version may have built their report just before
+        # that, so their older number is not trusted
+        stale_chunks = []
+        with self.metadata_lock:
+            for chunk_handle, version in reported_versions.items():
+                if chunk_handle not in self.server_chunks[server_name]:
+                    # A copy of a chunk we know that this server should not hold, e.g. one replaced
+                    # while the server was down, unless it is the destination of a running copy.
+                    # Fragments are checked against their chunk; those of a chunk that is not coded
+                    # and not being coded are left over from a failed encoding
+                    fragment = parse_fragment_handle(chunk_handle)
+                    parent = fragment[0] if fragment else chunk_handle
+                    if fragment:
+                        tracked = parent in self.chunk_coding or parent not in self.encoding
+                    else:
+                        tracked = parent in self.chunk_replicas
+                    if tracked and not self.replication_scheduler.is_copy_destination(parent, server_name):
+                        stale_chunks.append(chunk_handle)
+                        log.info("Replica is no longer tracked", chunk=chunk_handle, server=server_name)
+                    continue
+                current = self.chunk_versions.get(chunk_handle, 0)
+                if version < current and server_name not in self.version_acks.get(chunk_handle, ()):
+                    self.log_operation({"op": "remove_replica", "chunk_handle": chunk_handle, "server": server_name})
+                    stale_chunks.append(chunk_handle)
+                    log.info("Replica is stale", chunk=chunk_handle, server=server_name, version=version, current=current)
+        return stale_chunks
 
     def start_health_check(self):
         health_check_thread = threading.Thread(target=self.check_server_health, daemon=True)
         health_check_thread.start()
 
     def check_server_health(self):
+        # Servers push heartbeats; one that misses several in a row is marked down
         while True:
-            for server in self.chunk_servers:
-                server_name = server['name']
-                server_address = (server['address'], server['port'])
-                try:
-                    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    s.settimeout(2)
-                    s.connect(server_address)
-                    s.close()
-                    self.server_status[server_name] = True
-                except Exception:
+            deadline = time.monotonic() - self.heartbeat_interval * self.missed_heartbeats
+            for server_name, last_seen in list(self.last_heartbeat.items()):
+                if last_seen < deadline and self.server_status[server_name]:
                     self.server_status[server_name] = False
-                    print(f"Server {server_name} is down.")
-            time.sleep(10)  # Check every 10 seconds
+                    self.down_since[server_name] = time.monotonic()
+                    log.warning("Server is down", server=server_name)
+            time.sleep(self.heartbeat_interval)
+
+    def start_re_replication(self):
+        self.replication_scheduler = ReplicationScheduler(self.copy_chunk, self.copies_per_server,
+                                                          max_workers=len(self.chunk_servers) * self.copies_per_server)
+        re_replication_thread = threading.Thread(target=self.run_re_replication, daemon=True)
+        re_replication_thread.start()
+
+    def run_re_replication(self):
+        while True:
+            time.sleep(self.heartbeat_interval)
+            try:
+                candidates = self.find_under_replicated()
+                # Replication lag as the master sees it: chunks still short of their replicas
+                self.metrics.set_gauge("under_replicated_chunks", len(candidates))
+                started = self.replication_scheduler.schedule(candidates)
+                if started:
+                    log.info("Started chunk copies", copies=started)
+            except Exception as e:
+                log.error("Error scheduling re-replication", error=e)
+
+    def find_under_replicated(self):
+        # Chunks with fewer live replicas than the target, fewest remaining first. A replica
+        # only counts as lost once its server has been down for replication_delay seconds
+        now = time.monotonic()
+        live_servers = [server['name'] for server in self.chunk_servers if self.server_status[server['name']]]
+        candidates = []
+        with self.metadata_lock:
+            for chunk_handle, replicas in self.chunk_replicas.items():
+                live = [name for name in replicas if self.server_status[name]]
+                if not live or len(live) >= self.replication_factor:
+                    continue
+                lost = [name for name in replicas if not self.server_status[name]
+                        and now - self.down_since.get(name, now) >= self.replication_delay]
+                if len(replicas) >= self.replication_factor and not lost:
+                    continue
+                # Fill the emptiest servers first
+                destinations = sorted((name for name in live_servers if name not in replicas),
+                                      key=lambda name: len(self.server_chunks[name]))
+                candidates.append({"chunk_handle": chunk_handle, "live": live, "destinations": destinations})
+            candidates += self.find_lost_fragments(now, live_servers)
+        candidates.sort(key=lambda candidate: candidate.get("redundancy", len(candidate["live"])))
+        return candidates
+
+    def find_lost_fragments(self, now, live_servers):
+        # One lost fragment per coded chunk, rebuilt by its destination from the others. The
+        # chunks closest to losing data go first. Called with metadata_lock held
+        candidates = []
+        for chunk_handle, coding in self.chunk_coding.items():
+            fragments = coding["fragments"]
+            live = [name for name in fragments if name and self.server_status[name]]
+            if len(live) < coding["data_shards"]:
+                continue
+            lost = next((index for index, name in enumerate(fragments) if name is None or (
+                not self.server_status[name] and now - self.down_since.get(name, now) >= self.replication_delay)), None)
+            if lost is None:
+                continue
+            destinations = sorted((name for name in live_servers if name not in fragments),
+                                  key=lambda name: len(self.server_chunks[name]))
+            # Fragments to spare plus one compares with the live replicas of a replicated chunk
+            candidates.append({"chunk_handle": chunk_handle, "live": live, "destinations": destinations,
+                               "redundancy": len(live) - coding["data_shards"] + 1, "options": {"fragment": lost}})
+        return candidates
+
+    def start_rebalancer(self):
+        if self.rebalance_interval:
+            rebalancer_thread = threading.Thread(target=self.run_rebalancer, daemon=True)
+            rebalancer_thread.start()
+
+    def run_rebalancer(self):
+        while True:
+            time.sleep(self.rebalance_interval)
+            try:
+                self.rebalance()
+            except Exception as e:
+                log.error("Error rebalancing replicas", error=e)
+
+    def rebalance(self):
+        # Hot chunks get extra read replicas and lose them again once they cool down; cold chunks
+        # move from the fullest servers to the emptiest. Repairs always go first, and the copies
+        # run under their own concurrency and bandwidth limits
+        self.access_heat.decay()
+        if self.find_under_replicated():
+            return
+        self.trim_cold_replicas()
+        candidates = self.find_hot_chunks() + self.find_disk_moves()
+        started = self.replication_scheduler.schedule(candidates, group="rebalance",
+                                                      max_running=self.rebalance_concurrency)
+        if started:
+            log.info("Started rebalancing copies", copies=started)
+
+    def target_replicas(self, read_rate):
+        return min(self.max_replicas, self.replication_factor + int(read_rate // self.hot_read_rate))
+
+    def get_used_bytes(self, live_servers):
+        # Servers that have not sent a chunk report yet are left out
+        usage = {}
+        for name in live_servers:
+            used = self.server_stats.get(name, {}).get("used_bytes")
+            if used is not None:
+                usage[name] = used
+        return usage
+
+    def find_movable_chunks(self):
+        # Chunk handle -> file name for every chunk that may be copied or trimmed. A file's tail
+        # chunk stays put while the file is being written, since copying it would seal it
+        # Called with metadata_lock held
+        now = time.monotonic()
+        movable = {}
+        for file_name, handles in self.file_chunk_mapping.items():
+            for chunk_handle in handles:
+                if chunk_handle not in self.chunk_coding and chunk_handle not in self.encoding:
+                    movable[chunk_handle] = file_name
+            if handles and (self.write_idle(file_name, handles, now) < self.rebalance_write_idle
+                            or self.lease_remaining(handles[-1]) > 0):
+                movable.pop(handles[-1], None)
+        return movable
+
+    def write_idle(self, file_name, handles, now):
+        # Seconds since the file was last written. Clients append straight to the primary while
+        # they hold its lease, so the tail's commits reported in heartbeats count as well as
+        # write lookups
+        last_write = self.last_write.get(file_name, self.started)
+        if handles:
+            last_write = max(last_write, self.chunk_last_write.get(handles[-1], last_write))
+        return now - last_write
+
+    def trim_cold_replicas(self):
+        # Drop replicas beyond what a chunk's read rate still earns. A chunk keeps its extras
+        # until its rate falls to half of what earned them, so replicas don't flap at the edge.
+        # The server deletes the replica once its next chunk report shows it untracked
+        rates = self.access_heat.snapshot()
+        usage = self.get_used_bytes([server['name'] for server in self.chunk_servers])
+        trimmed = 0
+        with self.metadata_lock:
+            for chunk_handle, file_name in self.find_movable_chunks().items():
+                replicas = self.chunk_replicas.get(chunk_handle, [])
+                if len(replicas) <= self.target_replicas(2 * rates.get(chunk_handle, 0.0)):
+                    continue
+                if self.replication_scheduler.is_copying(chunk_handle):
+                    continue
+                # Servers that are down go first, then the fullest
+                victim = max(replicas, key=lambda name: (not self.server_status[name], usage.get(name, 0)))
+                self.log_operation({"op": "remove_replica", "chunk_handle": chunk_handle, "server": victim})
+                log.info("Removed extra replica", file=file_name, chunk=chunk_handle, server=victim)
+                trimmed += 1
+        if trimmed:
+            self.operation_log.wait_durable()
+
+    def find_hot_chunks(self):
+        # Chunks read often enough to earn more replicas than they have, hottest first
+        rates = self.access_heat.snapshot()
+        live_servers = [server['name'] for server in self.chunk_servers if self.server_status[server['name']]]
+        usage = self.get_used_bytes(live_servers)
+        candidates = []
+        with self.metadata_lock:
+            movable = self.find_movable_chunks()
+            for chunk_handle, rate in sorted(rates.items(), key=lambda item: item[1], reverse=True):
+                if rate < self.hot_read_rate:
+                    break
+                if chunk_handle not in movable:
+                    continue
+                replicas = self.chunk_replicas.get(chunk_handle, [])
+                live = [name for name in replicas if self.server_status[name]]
+                if not live or len(replicas) >= self.target_replicas(rate):
+                    continue
+                destinations = sorted((name for name in live_servers if name not in replicas),
+                                      key=lambda name: (usage.get(name, 0), len(self.server_chunks[name])))
+                log.info("Chunk is hot", file=movable[chunk_handle], chunk=chunk_handle,
+                         reads_per_second=round(rate, 1), replicas=len(replicas))
+                candidates.append({"chunk_handle": chunk_handle, "live": live, "destinations": destinations,
+                                   "options": {"bandwidth": self.rebalance_bandwidth}})
+        return candidates
+
+    def find_disk_moves(self):
+        # Pair the fullest servers with the emptiest and move the coldest chunk that narrows the gap
+        live_servers = [server['name'] for server in self.chunk_servers if self.server_status[server['name']]]
+        usage = self.get_used_bytes(live_servers)
+        if len(usage) < 2:
+            return []
+        mean = sum(usage.values()) / len(usage)
+        ordered = sorted(usage, key=usage.get)
+        rates = self.access_heat.snapshot()
+        candidates = []
+        with self.metadata_lock:
+            movable = self.find_movable_chunks()
+            while len(ordered) >= 2:
+                emptiest, fullest = ordered.pop(0), ordered.pop()
+                gap = usage[fullest] - usage[emptiest]
+                if gap <= self.rebalance_threshold * mean:
+                    break
+                # Only sealed chunks have a known size; one larger than half the gap would just
+                # swap which server is fuller
+                choices = [chunk_handle for chunk_handle in self.server_chunks[fullest]
+                           if chunk_handle in movable and chunk_handle in self.chunk_lengths
+                           and 0 < self.chunk_lengths[chunk_handle] <= gap // 2
+                           and emptiest not in self.chunk_replicas.get(chunk_handle, [])]
+                if not choices:
+                    continue
+                chunk_handle = min(choices, key=lambda handle: (rates.get(handle, 0.0), -self.chunk_lengths[handle]))
+                log.info("Moving chunk", file=movable[chunk_handle], chunk=chunk_handle, source=fullest,
+                         source_bytes=usage[fullest], destination=emptiest, destination_bytes=usage[emptiest])
+                candidates.append({"chunk_handle": chunk_handle, "live": [fullest], "destinations": [emptiest],
+                                   "options": {"move_from": fullest, "bandwidth": self.rebalance_bandwidth}})
+        return candidates
+
+    def copy_chunk(self, chunk_handle, source_name, destination_name, move_from=None, bandwidth=None, fragment=None):
+        # Only immutable chunks are copied, so a tail chunk is sealed first and writers move on
+        # to a new fully replicated chunk. A move drops the replica on move_from once the copy is in.
+        # For coded chunks the destination rebuilds the given fragment instead
+        if fragment is not None:
+            self.rebuild_fragment(chunk_handle, fragment, destination_name)
+            return
+        with self.chunk_lock(chunk_handle):
+            sealed = self.seal_chunk(chunk_handle)
+        with self.metadata_lock:
+            length = self.chunk_lengths.get(chunk_handle)
+            version = self.chunk_versions.get(chunk_handle, 0)
+        if not sealed:
+            log.warning("Cannot copy chunk yet: it could not be sealed", chunk=chunk_handle)
+            return
+        self.operation_log.wait_durable()
+
+        source = self.get_server(source_name)
+        destination = self.get_server(destination_name)
+        request = {"type": "replicate", "chunk_handle": chunk_handle, "source": [source['address'], source['port']],
+                   "length": length, "version": version,
+                   # Split the server's copy budget evenly over the copies it may run at once
+                   "bandwidth": bandwidth or self.replication_bandwidth // self.copies_per_server}
+        started = time.monotonic()
+        response, _ = self.replication_pool.request((destination['address'], destination['port']), request)
+        if response.get("status") != "ok":
+            log.warning("Copy of chunk failed", chunk=chunk_handle, destination=destination_name,
+                        error=response.get('message'))
+            self.metrics.increment("chunk_copies_failed")
+            return
+
+        # The new replica takes the place of every replica on a server that is still down
+        with self.metadata_lock:
+            if chunk_handle in self.chunk_coding:
+                log.info("Chunk was erasure coded while being copied", chunk=chunk_handle)
+                return
+            self.log_operation({"op": "add_replica", "chunk_handle": chunk_handle, "server": destination_name})
+            for name in list(self.chunk_replicas[chunk_handle]):
+                if not self.server_status[name]:
+                    self.log_operation({"op": "remove_replica", "chunk_handle": chunk_handle, "server": name})
+            if move_from in self.chunk_replicas[chunk_handle]:
+                self.log_operation({"op": "remove_replica", "chunk_handle": chunk_handle, "server": move_from})
+        self.operation_log.wait_durable()
+        self.metrics.observe("chunk_copy", time.monotonic() - started)
+        self.metrics.increment("chunk_copies")
+        self.metrics.increment("bytes_copied", length)
+        log.info("Copied chunk", chunk=chunk_handle, bytes=length, source=source_name, destination=destination_name,
+                 seconds=round(time.monotonic() - started, 2))
+
+    def rebuild_fragment(self, chunk_handle, index, destination_name):
+        with self.metadata_lock:
+            coding = self.chunk_coding.get(chunk_handle)
+            if not coding:
+                return
+            sources = {}
+            for source_index, name in enumerate(coding["fragments"]):
+                if name and self.server_status[name] and source_index != index:
+                    server = self.get_server(name)
+                    sources[str(source_index)] = [server['address'], server['port']]
+            request = {"type": "rebuild_fragment", "chunk_handle": chunk_handle, "index": index,
+                       "data_shards": coding["data_shards"], "parity_shards": coding["parity_shards"],
+                       "sources": sources}
+        destination = self.get_server(destination_name)
+        started = time.monotonic()
+        response, _ = self.replication_pool.request((destination['address'], destination['port']), request)
+        if response.get("status") != "ok":
+            log.warning("Rebuilding fragment failed", chunk=chunk_handle, index=index, destination=destination_name,
+                        error=response.get('message'))
+            self.metrics.increment("fragment_rebuilds_failed")
+            return
+        with self.metadata_lock:
+            self.log_operation({"op": "set_fragment", "chunk_handle": chunk_handle, "index": index,
+                                "server": destination_name})
+        self.operation_log.wait_durable()
+        self.metrics.increment("fragments_rebuilt")
+        log.info("Rebuilt fragment", chunk=chunk_handle, index=index, destination=destination_name,
+                 seconds=round(time.monotonic() - started, 2))
+
+    def start_erasure_coding(self):
+        if self.coding_cold_seconds:
+            coding_thread = threading.Thread(target=self.run_erasure_coding, daemon=True)
+            coding_thread.start()
+
+    def run_erasure_coding(self):
+        # Cold chunks are coded one at a time, so conversion only ever costs one server's
+        # coding_bandwidth
+        while True:
+            time.sleep(self.coding_interval)
+            try:
+                for chunk_handle in self.find_cold_chunks():
+                    self.encode_chunk(chunk_handle)
+            except Exception as e:
+                log.error("Error erasure coding chunks", error=e)
+
+    def find_cold_chunks(self):
+        # Replicated chunks of files not written for coding_cold_seconds. Chunks read hot enough
+        # to have earned extra replicas stay replicated, as does a chunk whose lease is unexpired
+        now = time.monotonic()
+        rates = self.access_heat.snapshot()
+        cold = []
+        with self.metadata_lock:
+            for file_name, handles in self.file_chunk_mapping.items():
+                if self.write_idle(file_name, handles, now) < self.coding_cold_seconds:
+                    continue
+                for chunk_handle in handles:
+                    if (chunk_handle not in self.chunk_coding and rates.get(chunk_handle, 0.0) < self.hot_read_rate
+                            and self.lease_remaining(chunk_handle) <= 0
+                            and any(self.server_status[name] for name in self.chunk_replicas.get(chunk_handle, []))):
+                        cold.append(chunk_handle)
+        return cold
+
+    def encode_chunk(self, chunk_handle):
+        # A replica holder cuts the chunk into fragments and sends one to each of
+        # data_shards + parity_shards servers. Holders of the other replicas are picked first
+        # so fewer fragments cross the network, then the servers holding the fewest chunks
+        total_shards = self.data_shards + self.parity_shards
+        with self.metadata_lock:
+            if (chunk_handle in self.chunk_coding or chunk_handle in self.encoding
+                    or self.replication_scheduler.is_copying(chunk_handle)):
+                return
+            live_servers = [server['name'] for server in self.chunk_servers if self.server_status[server['name']]]
+            replicas = [name for name in self.chunk_replicas.get(chunk_handle, []) if self.server_status[name]]
+            if len(live_servers) < total_shards or not replicas:
+                return
+            self.encoding.add(chunk_handle)
+        try:
+            with self.chunk_lock(chunk_handle):
+                self.seal_chunk(chunk_handle)
+            with self.metadata_lock:
+                length = self.chunk_lengths.get(chunk_handle)
+                if length is None:
+                    return
+                source = self.get_server(replicas[0])
+                holders = sorted(live_servers, key=lambda name: (name != source['name'], name not in replicas,
+                                                                len(self.server_chunks[name])))[:total_shards]
+            self.operation_log.wait_durable()
+            request = {"type": "encode_chunk", "chunk_handle": chunk_handle, "length": length,
+                       "data_shards": self.data_shards, "parity_shards": self.parity_shards,
+                       "bandwidth": self.coding_bandwidth,
+                       "destinations": [[server['address'], server['port']]
+                                        for server in map(self.get_server, holders)]}
+            started = time.monotonic()
+            response, _ = self.replication_pool.request((source['address'], source['port']), request)
+            if response.get("status") != "ok":
+                log.warning("Erasure coding failed", chunk=chunk_handle, server=source['name'],
+                            error=response.get('message'))
+                self.metrics.increment("chunk_encodes_failed")
+                return
+            with self.metadata_lock:
+                self.log_operation({"op": "encode_chunk", "chunk_handle": chunk_handle,
+                                    "data_shards": self.data_shards, "parity_shards": self.parity_shards,
+                                    "fragments": holders})
+            self.operation_log.wait_durable()
+        finally:
+            with self.metadata_lock:
+                self.encoding.discard(chunk_handle)
+        self.metrics.observe("chunk_encode", time.monotonic() - started)
+        self.metrics.increment("chunks_encoded")
+        self.metrics.increment("bytes_encoded", length)
+        log.info("Erasure coded chunk", chunk=chunk_handle, bytes=length, fragments=holders,
+                 seconds=round(time.monotonic() - started, 2))
 
 def client_handler():
     master_server = MasterServer(config_file='mserver_config.json')
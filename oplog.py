@@ -0,0 +1,299 @@
+import json
+import os
+import struct
+import threading
+import zlib
+from metrics import get_logger
+
+log = get_logger("oplog")
+
+# Log records are framed as (length, crc32) followed by a JSON-encoded operation
+RECORD_PREFIX_FORMAT = "!II"
+RECORD_PREFIX_SIZE = struct.calcsize(RECORD_PREFIX_FORMAT)
+# Format 1 had no chunk versions, format 2 no sealed chunk lengths and format 3 no erasure-coded
+# chunks; all still load
+CHECKPOINT_MAGIC_PREFIX = b"GFSMETA"
+CHECKPOINT_FORMAT = 4
+CHECKPOINT_MAGIC = CHECKPOINT_MAGIC_PREFIX + str(CHECKPOINT_FORMAT).encode()
+UNKNOWN_LENGTH = 2 ** 64 - 1  # Stored for chunks that are not sealed yet
+LOST_FRAGMENT = 2 ** 16 - 1  # Stored as the server of a fragment that is lost
+CHECKPOINT_FILE = "checkpoint"
+SEGMENT_PREFIX = "oplog."
+
+
+def list_segments(directory):
+    segments = []
+    for entry in os.listdir(directory):
+        if entry.startswith(SEGMENT_PREFIX) and entry[len(SEGMENT_PREFIX):].isdigit():
+            segments.append(int(entry[len(SEGMENT_PREFIX):]))
+    return sorted(segments)
+
+
+def segment_path(directory, segment):
+    return os.path.join(directory, f"{SEGMENT_PREFIX}{segment:08d}")
+
+
+def fsync_directory(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class OperationLog:
+    # Append-only log of metadata mutations split into numbered segments. Appends only
+    # buffer the record; wait_durable group-commits everything buffered with one fsync
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        segments = list_segments(directory)
+        self.segment = segments[-1] if segments else 0
+        self.fd = self.open_segment()
+        self.durable_offset = os.fstat(self.fd).st_size  # Bytes of the current segment known to be on disk
+        self.condition = threading.Condition()
+        self.pending = []
+        self.last_sequence = 0  # Sequence number of the newest appended record
+        self.durable_sequence = 0  # Every record up to this sequence number is fsynced
+        self.flushing = False
+        self.records_since_roll = 0
+
+    def open_segment(self):
+        return os.open(segment_path(self.directory, self.segment), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def append(self, operation):
+        data = json.dumps(operation, separators=(",", ":")).encode()
+        record = struct.pack(RECORD_PREFIX_FORMAT, len(data), zlib.crc32(data)) + data
+        with self.condition:
+            self.pending.append(record)
+            self.last_sequence += 1
+            self.records_since_roll += 1
+            return self.last_sequence
+
+    def wait_durable(self, sequence=None):
+        with self.condition:
+            if sequence is None:
+                sequence = self.last_sequence
+            while self.durable_sequence < sequence:
+                if self.flushing:
+                    # Another writer is flushing; its fsync may cover our record too
+                    self.condition.wait()
+                    continue
+                # Become the leader and flush every record buffered so far in one batch
+                self.flushing = True
+                batch, self.pending = self.pending, []
+                batch_end = self.last_sequence
+                self.condition.release()
+                try:
+                    self.write_batch(b"".join(batch))
+                except BaseException:
+                    self.condition.acquire()
+                    # Nothing in the batch is durable. It goes back ahead of newer records so the
+                    # next leader writes it again, in order; our caller sees the error
+                    self.pending[:0] = batch
+                    self.flushing = False
+                    self.condition.notify_all()
+                    raise
+                self.condition.acquire()
+                self.durable_sequence = batch_end
+                self.flushing = False
+                self.condition.notify_all()
+
+    def write_batch(self, data):
+        # Write and sync data at the end of the segment. On failure the segment is cut back to
+        # its last durable byte, so a retry neither leaves a torn record in the middle of the
+        # log nor trusts pages a failed fsync may have dropped
+        try:
+            written = 0
+            while written < len(data):
+                written += os.write(self.fd, data[written:])
+            os.fsync(self.fd)
+        except OSError:
+            os.ftruncate(self.fd, self.durable_offset)
+            raise
+        self.durable_offset += len(data)
+
+    def roll(self):
+        # Start a new segment; returns the number of the last segment that is now closed
+        with self.condition:
+            while self.flushing:
+                self.condition.wait()
+            self.write_batch(b"".join(self.pending))
+            self.pending = []
+            self.durable_sequence = self.last_sequence
+            os.close(self.fd)
+            closed_segment = self.segment
+            self.segment += 1
+            self.fd = self.open_segment()
+            self.durable_offset = os.fstat(self.fd).st_size
+            self.records_since_roll = 0
+            return closed_segment
+
+    def close(self):
+        self.wait_durable()
+        os.close(self.fd)
+
+
+def replay_segments(directory, after_segment=-1):
+    # Yield the operations of every segment newer than after_segment, in order. A torn or
+    # corrupt record can only be the tail of the newest segment, so replay stops there
+    for segment in list_segments(directory):
+        if segment <= after_segment:
+            continue
+        path = segment_path(directory, segment)
+        with open(path, 'rb') as f:
+            data = f.read()
+        position = 0
+        while position + RECORD_PREFIX_SIZE <= len(data):
+            length, checksum = struct.unpack_from(RECORD_PREFIX_FORMAT, data, position)
+            body = data[position + RECORD_PREFIX_SIZE:position + RECORD_PREFIX_SIZE + length]
+            if len(body) < length or zlib.crc32(body) != checksum:
+                break
+            yield json.loads(body)
+            position += RECORD_PREFIX_SIZE + length
+        if position < len(data):
+            log.warning("Truncating torn tail of log segment", path=path, position=position)
+            with open(path, 'r+b') as f:
+                f.truncate(position)
+
+
+def write_checkpoint(directory, state, covered_segment):
+    # Compact binary snapshot of the namespace; chunk handles are stored as 64-bit integers and
+    # server names through an index table. Written to a temporary file and renamed into place
+    chunk_coding = state.get("chunk_coding", {})
+    server_names = sorted({name for replicas in state["chunk_replicas"].values() for name in replicas}
+                          | set(state["chunk_primaries"].values())
+                          | {name for coding in chunk_coding.values() for name in coding["fragments"] if name})
+    server_index = {name: index for index, name in enumerate(server_names)}
+
+    parts = [CHECKPOINT_MAGIC, struct.pack("!QQH", state["next_chunk_handle"], covered_segment, len(server_names))]
+    for name in server_names:
+        encoded = name.encode()
+        parts.append(struct.pack("!H", len(encoded)) + encoded)
+
+    parts.append(struct.pack("!I", len(state["file_chunk_mapping"])))
+    for file_name, handles in state["file_chunk_mapping"].items():
+        encoded = file_name.encode()
+        parts.append(struct.pack(f"!H{len(encoded)}sI{len(handles)}Q", len(encoded), encoded, len(handles),
+                                 *(int(handle, 16) for handle in handles)))
+
+    parts.append(struct.pack("!I", len(state["chunk_replicas"])))
+    for handle, replicas in state["chunk_replicas"].items():
+        primary = state["chunk_primaries"].get(handle)
+        length = state["chunk_lengths"].get(handle)
+        parts.append(struct.pack(f"!QQQhB{len(replicas)}H", int(handle, 16), state["chunk_versions"].get(handle, 0),
+                                 UNKNOWN_LENGTH if length is None else length,
+                                 server_index[primary] if primary is not None else -1, len(replicas),
+                                 *(server_index[name] for name in replicas)))
+
+    parts.append(struct.pack("!I", len(chunk_coding)))
+    for handle, coding in chunk_coding.items():
+        fragments = coding["fragments"]
+        parts.append(struct.pack(f"!QBB{len(fragments)}H", int(handle, 16), coding["data_shards"],
+                                 coding["parity_shards"],
+                                 *(LOST_FRAGMENT if name is None else server_index[name] for name in fragments)))
+
+    body = b"".join(parts)
+    temp_path = os.path.join(directory, CHECKPOINT_FILE + ".tmp")
+    with open(temp_path, 'wb') as f:
+        f.write(body)
+        f.write(struct.pack("!I", zlib.crc32(body)))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, os.path.join(directory, CHECKPOINT_FILE))
+    fsync_directory(directory)
+
+
+def read_checkpoint(directory):
+    # Returns (state, covered_segment), or (None, -1) when no checkpoint exists
+    path = os.path.join(directory, CHECKPOINT_FILE)
+    if not os.path.exists(path):
+        return None, -1
+    with open(path, 'rb') as f:
+        data = f.read()
+    body, (checksum,) = data[:-4], struct.unpack("!I", data[-4:])
+    magic = body[:len(CHECKPOINT_MAGIC)]
+    suffix = magic[len(CHECKPOINT_MAGIC_PREFIX):]
+    checkpoint_format = int(suffix) if suffix.isdigit() else 0
+    if (not magic.startswith(CHECKPOINT_MAGIC_PREFIX) or not 1 <= checkpoint_format <= CHECKPOINT_FORMAT
+            or zlib.crc32(body) != checksum):
+        raise ValueError(f"Corrupt metadata checkpoint {path}")
+
+    position = len(CHECKPOINT_MAGIC)
+    next_chunk_handle, covered_segment, server_count = struct.unpack_from("!QQH", body, position)
+    position += struct.calcsize("!QQH")
+    server_names = []
+    for _ in range(server_count):
+        (length,) = struct.unpack_from("!H", body, position)
+        server_names.append(body[position + 2:position + 2 + length].decode())
+        position += 2 + length
+
+    file_chunk_mapping = {}
+    (file_count,) = struct.unpack_from("!I", body, position)
+    position += 4
+    for _ in range(file_count):
+        (length,) = struct.unpack_from("!H", body, position)
+        file_name = body[position + 2:position + 2 + length].decode()
+        position += 2 + length
+        (handle_count,) = struct.unpack_from("!I", body, position)
+        position += 4
+        handles = struct.unpack_from(f"!{handle_count}Q", body, position)
+        position += 8 * handle_count
+        file_chunk_mapping[file_name] = [f"{handle:016x}" for handle in handles]
+
+    chunk_replicas = {}
+    chunk_primaries = {}
+    chunk_versions = {}
+    chunk_lengths = {}
+    (chunk_count,) = struct.unpack_from("!I", body, position)
+    position += 4
+    for _ in range(chunk_count):
+        version, length = 0, UNKNOWN_LENGTH
+        if checkpoint_format >= 3:
+            handle, version, length, primary, replica_count = struct.unpack_from("!QQQhB", body, position)
+            position += struct.calcsize("!QQQhB")
+        elif checkpoint_format == 2:
+            handle, version, primary, replica_count = struct.unpack_from("!QQhB", body, position)
+            position += struct.calcsize("!QQhB")
+        else:
+            handle, primary, replica_count = struct.unpack_from("!QhB", body, position)
+            position += struct.calcsize("!QhB")
+        replicas = struct.unpack_from(f"!{replica_count}H", body, position)
+        position += 2 * replica_count
+        handle = f"{handle:016x}"
+        chunk_replicas[handle] = [server_names[index] for index in replicas]
+        chunk_versions[handle] = version
+        if length != UNKNOWN_LENGTH:
+            chunk_lengths[handle] = length
+        if primary >= 0:
+            chunk_primaries[handle] = server_names[primary]
+
+    chunk_coding = {}
+    if checkpoint_format >= 4:
+        (coded_count,) = struct.unpack_from("!I", body, position)
+        position += 4
+        for _ in range(coded_count):
+            handle, data_shards, parity_shards = struct.unpack_from("!QBB", body, position)
+            position += struct.calcsize("!QBB")
+            fragments = struct.unpack_from(f"!{data_shards + parity_shards}H", body, position)
+            position += 2 * (data_shards + parity_shards)
+            chunk_coding[f"{handle:016x}"] = {
+                "data_shards": data_shards, "parity_shards": parity_shards,
+                "fragments": [None if index == LOST_FRAGMENT else server_names[index] for index in fragments]}
+
+    state = {
+        "next_chunk_handle": next_chunk_handle,
+        "file_chunk_mapping": file_chunk_mapping,
+        "chunk_replicas": chunk_replicas,
+        "chunk_primaries": chunk_primaries,
+        "chunk_versions": chunk_versions,
+        "chunk_lengths": chunk_lengths,
+        "chunk_coding": chunk_coding,
+    }
+    return state, covered_segment
+
+
+def remove_segments(directory, up_to_segment):
+    for segment in list_segments(directory):
+        if segment <= up_to_segment:
+            os.remove(segment_path(directory, segment))
@@ -0,0 +1,334 @@
+import asyncio
+import contextlib
+import json
+import os
+import socket
+import stat
+import struct
+import threading
+from compression import decode_payload
+
+# Every message is a fixed prefix (JSON header length, payload length), the JSON header
+# and then the raw binary payload, so many messages can share one connection
+PREFIX_FORMAT = "!IQ"
+PREFIX_SIZE = struct.calcsize(PREFIX_FORMAT)
+TRANSFER_BLOCK_SIZE = 64 * 1024  # Default bytes copied per read when a file payload cannot use sendfile
+COALESCE_LIMIT = 64 * 1024  # Payloads up to this size go out in the same send as their header
+
+
+class FileRange:
+    # A payload streamed straight from a file instead of being held in memory
+    def __init__(self, path, offset, length):
+        self.path = path
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+
+def recv_into_exactly(sock, view):
+    # Fill a writable memoryview straight from the socket, with no intermediate copies
+    received = 0
+    while received < len(view):
+        count = sock.recv_into(view[received:])
+        if count == 0:
+            raise ConnectionError("Connection closed in the middle of a message")
+        received += count
+
+
+def recv_exactly(sock, size):
+    buffer = bytearray(size)
+    recv_into_exactly(sock, memoryview(buffer))
+    return bytes(buffer)
+
+
+def is_regular_file(f):
+    return stat.S_ISREG(os.fstat(f.fileno()).st_mode)
+
+
+def set_nodelay(sock):
+    # Every message is answered before the next is sent, so Nagle's algorithm would hold each
+    # message's last segment back until the peer's delayed ACK, for tens of milliseconds
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+def send_message(sock, header, payload=b"", block_size=TRANSFER_BLOCK_SIZE):
+    header_bytes = json.dumps(header).encode()
+    prefix = struct.pack(PREFIX_FORMAT, len(header_bytes), len(payload)) + header_bytes
+    if not isinstance(payload, FileRange) and len(payload) <= COALESCE_LIMIT:
+        # One send per small message; copying the payload is cheaper than a second segment
+        sock.sendall(prefix + bytes(payload) if payload else prefix)
+        return
+    sock.sendall(prefix)
+    if isinstance(payload, FileRange):
+        with open(payload.path, 'rb') as f:
+            if is_regular_file(f):
+                # Zero-copy: the kernel moves the range from the page cache to the socket
+                sent = sock.sendfile(f, payload.offset, payload.length)
+                if sent != payload.length:
+                    raise ConnectionError(f"File {payload.path} shrank while being sent")
+                return
+            # Pipes and other non-regular files are copied through userspace
+            if payload.offset:
+                f.seek(payload.offset)
+            remaining = payload.length
+            while remaining > 0:
+                block = f.read(min(block_size, remaining))
+                if not block:
+                    raise ConnectionError(f"File {payload.path} shrank while being sent")
+                sock.sendall(block)
+                remaining -= len(block)
+    elif payload:
+        sock.sendall(payload)
+
+
+def recv_header(sock):
+    # Returns the header and the length of the payload that follows it, or (None, None) when
+    # the peer closes the connection between messages
+    prefix = b""
+    while len(prefix) < PREFIX_SIZE:
+        piece = sock.recv(PREFIX_SIZE - len(prefix))
+        if not piece:
+            if prefix:
+                raise ConnectionError("Connection closed in the middle of a message")
+            return None, None
+        prefix += piece
+    header_length, payload_length = struct.unpack(PREFIX_FORMAT, prefix)
+    return json.loads(recv_exactly(sock, header_length).decode()), payload_length
+
+
+def recv_message(sock):
+    # Returns (None, None) when the peer closes the connection between messages
+    header, payload_length = recv_header(sock)
+    if header is None:
+        return None, None
+    payload = recv_exactly(sock, payload_length) if payload_length else b""
+    return header, payload
+
+
+def wait_for_message(sock, timeout):
+    # Whether the peer started its next message, or closed the connection, within timeout
+    # seconds. Only the wait between messages is bounded; a falsy timeout waits forever
+    if not timeout:
+        return True
+    sock.settimeout(timeout)
+    try:
+        sock.recv(1, socket.MSG_PEEK)
+    except socket.timeout:
+        return False
+    finally:
+        sock.settimeout(None)
+    return True
+
+
+class PayloadReader:
+    # The payload of a response still waiting on its connection, read in place into buffers
+    # the caller owns instead of being collected into one bytes object
+    def __init__(self, sock, length):
+        self.sock = sock
+        self.remaining = length
+
+    def read_into(self, view):
+        # Fill view, which must not be longer than what remains
+        if len(view) > self.remaining:
+            raise ValueError(f"Only {self.remaining} payload bytes remain, {len(view)} requested")
+        recv_into_exactly(self.sock, view)
+        self.remaining -= len(view)
+
+    def iter_blocks(self, buffer):
+        # Yield the payload as memoryviews over the one reusable buffer; each is only valid
+        # until the next is requested
+        view = memoryview(buffer).cast("B")
+        while self.remaining:
+            count = self.sock.recv_into(view, min(len(view), self.remaining))
+            if count == 0:
+                raise ConnectionError("Connection closed in the middle of a message")
+            self.remaining -= count
+            yield view[:count]
+
+    def read_all(self):
+        data = recv_exactly(self.sock, self.remaining) if self.remaining else b""
+        self.remaining = 0
+        return data
+
+
+async def write_message(writer, header, payload=b"", block_size=TRANSFER_BLOCK_SIZE):
+    header_bytes = json.dumps(header).encode()
+    prefix = struct.pack(PREFIX_FORMAT, len(header_bytes), len(payload)) + header_bytes
+    if not isinstance(payload, FileRange) and len(payload) <= COALESCE_LIMIT:
+        writer.write(prefix + bytes(payload) if payload else prefix)
+        await writer.drain()
+        return
+    writer.write(prefix)
+    if isinstance(payload, FileRange):
+        loop = asyncio.get_running_loop()
+        with open(payload.path, 'rb') as f:
+            if is_regular_file(f):
+                # loop.sendfile uses os.sendfile on the transport's socket once its buffer drains
+                await writer.drain()
+                sent = await loop.sendfile(writer.transport, f, payload.offset, payload.length)
+                if sent != payload.length:
+                    raise ConnectionError(f"File {payload.path} shrank while being sent")
+                return
+            if payload.offset:
+                f.seek(payload.offset)
+            remaining = payload.length
+            while remaining > 0:
+                # Disk reads run on the executor so the event loop never blocks on them
+                block = await loop.run_in_executor(None, f.read, min(block_size, remaining))
+                if not block:
+                    raise ConnectionError(f"File {payload.path} shrank while being sent")
+                writer.write(block)
+                remaining -= len(block)
+                await writer.drain()
+    elif payload:
+        writer.write(payload)
+    await writer.drain()
+
+
+async def read_message(reader):
+    # Returns (None, None) when the peer closes the connection between messages
+    try:
+        prefix = await reader.readexactly(PREFIX_SIZE)
+    except asyncio.IncompleteReadError as e:
+        if e.partial:
+            raise ConnectionError("Connection closed in the middle of a message")
+        return None, None
+    header_length, payload_length = struct.unpack(PREFIX_FORMAT, prefix)
+    try:
+        header = json.loads((await reader.readexactly(header_length)).decode())
+        payload = await reader.readexactly(payload_length) if payload_length else b""
+    except asyncio.IncompleteReadError:
+        raise ConnectionError("Connection closed in the middle of a message")
+    return header, payload
+
+
+def file_range_for(path, offset=0, length=None):
+    # Clamp a requested range to the current size of the file
+    file_size = os.path.getsize(path)
+    offset = min(offset, file_size)
+    available = file_size - offset
+    return FileRange(path, offset, available if length is None else min(length, available))
+
+
+class ConnectionPool:
+    # Keeps idle connections per (host, port) so requests skip connect and teardown
+    def __init__(self, max_idle_per_address=8, timeout=None):
+        self.max_idle_per_address = max_idle_per_address
+        self.timeout = timeout
+        self.idle_connections = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, address):
+        # Returns a connection and whether it was reused from the pool
+        with self.lock:
+            idle = self.idle_connections.get(address)
+            if idle:
+                return idle.pop(), True
+        return set_nodelay(socket.create_connection(address, timeout=self.timeout)), False
+
+    def release(self, address, sock):
+        with self.lock:
+            idle = self.idle_connections.setdefault(address, [])
+            if len(idle) < self.max_idle_per_address:
+                idle.append(sock)
+                return
+        sock.close()
+
+    def request(self, address, header, payload=b""):
+        address = (address[0], int(address[1]))
+        for attempt in range(2):
+            sock, reused = self.acquire(address)
+            try:
+                send_message(sock, header, payload)
+                response, response_payload = recv_message(sock)
+                if response is None:
+                    raise ConnectionError("Connection closed before a response was received")
+            except OSError:
+                sock.close()
+                # A pooled connection may have been closed by the server while idle; retry once
+                if reused and attempt == 0:
+                    continue
+                raise
+            self.release(address, sock)
+            return response, decode_payload(response, response_payload)
+
+    @contextlib.contextmanager
+    def stream(self, address, header, payload=b""):
+        # Like request, but yields the response header with a PayloadReader for its payload.
+        # The connection goes back to the pool only if the caller read the whole payload
+        address = (address[0], int(address[1]))
+        for attempt in range(2):
+            sock, reused = self.acquire(address)
+            try:
+                send_message(sock, header, payload)
+                response, payload_length = recv_header(sock)
+                if response is None:
+                    raise ConnectionError("Connection closed before a response was received")
+            except OSError:
+                sock.close()
+                if reused and attempt == 0:
+                    continue
+                raise
+            break
+        reader = PayloadReader(sock, payload_length)
+        try:
+            yield response, reader
+        except BaseException:
+            sock.close()
+            raise
+        if reader.remaining:
+            sock.close()
+        else:
+            self.release(address, sock)
+
+    def close(self):
+        with self.lock:
+            for idle in self.idle_connections.values():
+                for sock in idle:
+                    sock.close()
+            self.idle_connections.clear()
+
+
+class AsyncConnectionPool:
+    # Event-loop counterpart of ConnectionPool; only used from a single event loop
+    def __init__(self, max_idle_per_address=8, timeout=None):
+        self.max_idle_per_address = max_idle_per_address
+        self.timeout = timeout
+        self.idle_connections = {}
+
+    async def request(self, address, header, payload=b""):
+        address = (address[0], int(address[1]))
+        for attempt in range(2):
+            idle = self.idle_connections.get(address)
+            reused = bool(idle)
+            if reused:
+                reader, writer = idle.pop()
+            else:
+                reader, writer = await asyncio.wait_for(asyncio.open_connection(*address), self.timeout)
+                set_nodelay(writer.get_extra_info("socket"))
+            try:
+                await write_message(writer, header, payload)
+                response, response_payload = await asyncio.wait_for(read_message(reader), self.timeout)
+                if response is None:
+                    raise ConnectionError("Connection closed before a response was received")
+            except (OSError, asyncio.TimeoutError):
+                writer.close()
+                # A pooled connection may have been closed by the server while idle; retry once
+                if reused and attempt == 0:
+                    continue
+                raise
+            idle = self.idle_connections.setdefault(address, [])
+            if len(idle) < self.max_idle_per_address:
+                idle.append((reader, writer))
+            else:
+                writer.close()
+            return response, decode_payload(response, response_payload)
+
+    def close(self):
+        for idle in self.idle_connections.values():
+            for _, writer in idle:
+                writer.close()
+        self.idle_connections.clear()
@@ -0,0 +1,117 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from metrics import get_logger
+
+DEFAULT_COPIES_PER_SERVER = 2  # Concurrent copies a server may take part in, as source or destination
+DEFAULT_REPLICATION_BANDWIDTH = 32 * 1024 * 1024  # Bytes per second a server may spend on copies
+DEFAULT_REPLICATION_DELAY = 30  # Seconds a replica must be down before it is replaced
+DEFAULT_REBALANCE_INTERVAL = 60  # Seconds between rebalancing passes; 0 turns the rebalancer off
+DEFAULT_HOT_READ_RATE = 50  # Reads per second that earn a chunk one replica beyond the replication factor
+DEFAULT_MAX_REPLICAS = 5  # Upper bound on replicas of a hot chunk
+DEFAULT_REBALANCE_THRESHOLD = 0.1  # Gap between the fullest and emptiest server, as a share of the mean, worth moving data for
+DEFAULT_REBALANCE_BANDWIDTH = 8 * 1024 * 1024  # Bytes per second a rebalancing copy may use
+DEFAULT_REBALANCE_CONCURRENCY = 2  # Rebalancing copies running at once across the cluster
+DEFAULT_REBALANCE_WRITE_IDLE = 300  # Seconds without writes before a file's tail chunk may be moved
+HEAT_ALPHA = 0.5  # Weight of the latest interval in the smoothed read rates
+MIN_READ_RATE = 0.01  # Read rates below this are forgotten
+
+log = get_logger("replication")
+
+
+class AccessHeat:
+    # Smoothed reads per second per chunk, fed by the read counts servers send with heartbeats
+    # and folded into the rates once per rebalancing pass
+    def __init__(self, alpha=HEAT_ALPHA):
+        self.alpha = alpha
+        self.counts = {}  # Reads per chunk since the last decay
+        self.rates = {}
+        self.last_decay = time.monotonic()
+        self.lock = threading.Lock()
+
+    def record(self, chunk_reads):
+        with self.lock:
+            for chunk_handle, reads in chunk_reads.items():
+                self.counts[chunk_handle] = self.counts.get(chunk_handle, 0) + reads
+
+    def decay(self):
+        now = time.monotonic()
+        with self.lock:
+            elapsed = max(now - self.last_decay, 1e-3)
+            for chunk_handle in set(self.rates) | set(self.counts):
+                rate = self.rates.get(chunk_handle, 0.0)
+                rate += self.alpha * (self.counts.get(chunk_handle, 0) / elapsed - rate)
+                if rate < MIN_READ_RATE:
+                    self.rates.pop(chunk_handle, None)
+                else:
+                    self.rates[chunk_handle] = rate
+            self.counts = {}
+            self.last_decay = now
+
+    def rate(self, chunk_handle):
+        with self.lock:
+            return self.rates.get(chunk_handle, 0.0)
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.rates)
+
+
+class ReplicationScheduler:
+    # Runs chunk copies for re-replication and rebalancing. Candidates are handled in the order
+    # given, one copy per chunk at a time, and no server is source or destination of more than
+    # copies_per_server copies at once
+    def __init__(self, copy_chunk, copies_per_server=DEFAULT_COPIES_PER_SERVER, max_workers=8):
+        self.copy_chunk = copy_chunk  # Called as copy_chunk(chunk_handle, source, destination, **options)
+        self.copies_per_server = copies_per_server
+        self.active = {}  # Copies each server currently takes part in
+        self.in_progress = {}  # Chunk handle -> destination of its running copy
+        self.running = {}  # Copies running per group, e.g. "repair" or "rebalance"
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def schedule(self, candidates, group="repair", max_running=None):
+        # candidates: dicts with chunk_handle, live (possible sources), destinations (eligible
+        # servers, best first) and optional options for copy_chunk. At most max_running copies
+        # of the group run at once. Returns how many copies were started
+        started = 0
+        with self.lock:
+            for candidate in candidates:
+                if max_running is not None and self.running.get(group, 0) >= max_running:
+                    break
+                chunk_handle = candidate["chunk_handle"]
+                if chunk_handle in self.in_progress:
+                    continue
+                sources = [name for name in candidate["live"] if self.active.get(name, 0) < self.copies_per_server]
+                destination = next((name for name in candidate["destinations"]
+                                    if self.active.get(name, 0) < self.copies_per_server), None)
+                if not sources or destination is None:
+                    continue
+                source = min(sources, key=lambda name: self.active.get(name, 0))
+                for name in (source, destination):
+                    self.active[name] = self.active.get(name, 0) + 1
+                self.in_progress[chunk_handle] = destination
+                self.running[group] = self.running.get(group, 0) + 1
+                self.executor.submit(self.run, chunk_handle, source, destination, group, candidate.get("options", {}))
+                started += 1
+        return started
+
+    def run(self, chunk_handle, source, destination, group, options):
+        try:
+            self.copy_chunk(chunk_handle, source, destination, **options)
+        except Exception as e:
+            log.error("Error copying chunk", chunk=chunk_handle, source=source, destination=destination, error=e)
+        finally:
+            with self.lock:
+                for name in (source, destination):
+                    self.active[name] -= 1
+                self.running[group] -= 1
+                del self.in_progress[chunk_handle]
+
+    def is_copying(self, chunk_handle):
+        with self.lock:
+            return chunk_handle in self.in_progress
+
+    def is_copy_destination(self, chunk_handle, server_name):
+        with self.lock:
+            return self.in_progress.get(chunk_handle) == server_name
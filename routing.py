@@ -0,0 +1,68 @@
+import random
+import threading
+
+DEFAULT_LATENCY = 0.005  # Seconds assumed for a replica until we have latency samples for it
+EWMA_ALPHA = 0.2  # Weight of the newest latency sample
+
+
+class ReadRouter:
+    # Routes reads between replicas with power-of-two-choices: sample two candidates and take
+    # the one with the lower expected wait, (outstanding requests + 1) * latency EWMA.
+    # Keys are opaque (server names on the master, "host:port" addresses on the client)
+    def __init__(self, alpha=EWMA_ALPHA, default_latency=DEFAULT_LATENCY):
+        self.alpha = alpha
+        self.default_latency = default_latency
+        self.latency = {}  # Latency EWMA per key in seconds
+        self.in_flight = {}  # Outstanding requests per key, reported or tracked locally
+        self.routed = {}  # Requests routed to a key since its last load report
+        self.lock = threading.Lock()
+
+    def cost(self, key):
+        outstanding = self.in_flight.get(key, 0) + self.routed.get(key, 0)
+        return (outstanding + 1) * self.latency.get(key, self.default_latency)
+
+    def order(self, keys):
+        # Best candidate first by two random choices, then the rest cheapest first for fallback
+        keys = list(keys)
+        if len(keys) < 2:
+            return keys
+        with self.lock:
+            first, second = random.sample(keys, 2)
+            chosen = first if self.cost(first) <= self.cost(second) else second
+            rest = sorted((key for key in keys if key != chosen), key=self.cost)
+        return [chosen] + rest
+
+    def choose(self, keys):
+        ordered = self.order(keys)
+        return ordered[0] if ordered else None
+
+    def record_routed(self, key):
+        with self.lock:
+            self.routed[key] = self.routed.get(key, 0) + 1
+
+    def observe_latency(self, key, seconds):
+        with self.lock:
+            previous = self.latency.get(key)
+            self.latency[key] = seconds if previous is None else previous + self.alpha * (seconds - previous)
+
+    def report_load(self, key, in_flight, latency=None):
+        # A fresh load report already includes whatever we routed there before it
+        with self.lock:
+            self.in_flight[key] = in_flight
+            self.routed[key] = 0
+        if latency is not None:
+            self.observe_latency(key, latency)
+
+    def begin(self, key):
+        with self.lock:
+            self.in_flight[key] = self.in_flight.get(key, 0) + 1
+
+    def end(self, key, seconds=None):
+        with self.lock:
+            self.in_flight[key] = max(0, self.in_flight.get(key, 0) - 1)
+        if seconds is not None:
+            self.observe_latency(key, seconds)
+
+    def latency_snapshot(self):
+        with self.lock:
+            return dict(self.latency)
@@ -1,222 +1,1113 @@
+import asyncio
+import contextlib
 import socket
 import json
 import os
+import shutil
+import sys
 import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from admission import (DEFAULT_IDLE_TIMEOUT, DEFAULT_MAX_CONNECTIONS, DEFAULT_QUEUE_TIMEOUT, DEFAULT_RETRY_AFTER,
+                       DEFAULT_WORKER_THREADS, AdmissionController, AsyncAdmissionController, busy_response)
+from append_engine import DEFAULT_MAX_OPEN_FILES, AppendEngine, MutationBatcher
+from checksum import checksum_path
+from compression import (CompressedChunk, decode_payload, encode_payload, inflate_chunk, negotiate,
+                         write_compressed_chunk)
+from erasure import ReedSolomon, fragment_handle
+from metrics import MetricsRegistry, configure_logging, get_logger
+from routing import EWMA_ALPHA
+from protocol import (TRANSFER_BLOCK_SIZE, AsyncConnectionPool, ConnectionPool, FileRange, file_range_for,
+                      read_message, recv_message, send_message, set_nodelay, wait_for_message, write_message)
+
+
+DEFAULT_CHUNK_SIZE = 64 * 1024 * 1024  # 64 MB chunks
+DEFAULT_LISTEN_BACKLOG = 1024
+DEFAULT_REPLICATION_WORKERS = 16
+DEFAULT_STAGING_BUFFER_BYTES = 256 * 1024 * 1024
+DEFAULT_HEARTBEAT_INTERVAL = 2  # Seconds between heartbeats to the master
+DEFAULT_CHUNK_REPORT_EVERY = 10  # Send the full chunk list on every Nth heartbeat
+DEFAULT_SCRUB_BYTES_PER_SECOND = 8 * 1024 * 1024  # Read budget of the background scrubber
+DEFAULT_SCRUB_COLD_SECONDS = 60  # Chunks read or written this recently are verified by that traffic instead
+SCRUB_PIECE_SIZE = 1024 * 1024  # Bytes the scrubber verifies between throttling pauses
+REPLICATION_PIECE_SIZE = 1024 * 1024  # Bytes pulled per request when copying a chunk from another server
+DEFAULT_COMPRESSION_MIN_BYTES = 4096  # Smaller payloads are not worth compressing on the wire
+DEFAULT_COMPRESS_AFTER_SECONDS = 300  # Idle time before a chunk is compressed at rest
+
+log = get_logger("server")
+
+class StagingBuffer:
+    # Holds pushed write data by data ID until a commit applies it; the oldest entries are evicted first
+    def __init__(self, max_bytes=DEFAULT_STAGING_BUFFER_BYTES):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def put(self, data_id, data):
+        if len(data) > self.max_bytes:
+            return False
+        with self.lock:
+            self._remove(data_id)
+            self.entries[data_id] = data
+            self.total_bytes += len(data)
+            while self.total_bytes > self.max_bytes:
+                evicted_id, evicted = self.entries.popitem(last=False)
+                self.total_bytes -= len(evicted)
+                log.warning("Evicted staged data", data_id=evicted_id, bytes=len(evicted))
+        return True
+
+    def get(self, data_id):
+        with self.lock:
+            return self.entries.get(data_id)
+
+    def discard(self, data_id):
+        with self.lock:
+            self._remove(data_id)
+
+    def _remove(self, data_id):
+        data = self.entries.pop(data_id, None)
+        if data is not None:
+            self.total_bytes -= len(data)
 
 
 class Server:
-    def __init__(self, server_id):
+    def __init__(self, server_id, config=None):
+        config = config or {}
+        configure_logging(config)
         self.server_id = server_id
-        self.files = {}
+        self.log = get_logger("server", server=server_id)
+        self.chunk_size = config.get('chunk_size', DEFAULT_CHUNK_SIZE)
+        self.server_mode = config.get('server_mode', 'threaded')  # 'threaded' or 'asyncio'
+        self.listen_backlog = config.get('listen_backlog', DEFAULT_LISTEN_BACKLOG)
+        self.transfer_block_size = config.get('transfer_block_size', TRANSFER_BLOCK_SIZE)
+        self.directory = f"{server_id}_files"  # E.g., "server1_files"
+        self.chunks = {}  # Map chunk handles to their file paths
+        self.chunk_versions = {}  # Version of each chunk, bumped by the master whenever it elects a primary
+        self.mutation_batchers = {}  # Orders the mutations of every chunk this server is primary for
+        self.chunk_access = {}  # Monotonic time each chunk was last read or written
+        self.sealed_chunks = set()  # Chunks that reported chunk_full or were sealed by the master; no more appends
+        self.leases = {}  # Monotonic expiry of the lease of every chunk this server is primary for
+        self.batchers_lock = threading.Lock()
+        # Batches concurrent appends per chunk into one write and one sync
+        self.append_engine = AppendEngine(config.get('fsync_appends', True),
+                                          config.get('max_open_chunk_files', DEFAULT_MAX_OPEN_FILES))
+        self.staging_buffer = StagingBuffer(config.get('staging_buffer_bytes', DEFAULT_STAGING_BUFFER_BYTES))
         self.server_address = None  # Placeholder for server IP
         self.server_port = None     # Placeholder for server port
+        master = config.get('master_server', {})
+        self.master_address = (master['address'], master['port']) if master else None
+        self.heartbeat_interval = config.get('heartbeat_interval', DEFAULT_HEARTBEAT_INTERVAL)
+        self.chunk_report_every = config.get('chunk_report_every', DEFAULT_CHUNK_REPORT_EVERY)
+        self.scrub_bytes_per_second = config.get('scrub_bytes_per_second', DEFAULT_SCRUB_BYTES_PER_SECOND)
+        self.scrub_cold_seconds = config.get('scrub_cold_seconds', DEFAULT_SCRUB_COLD_SECONDS)
+        self.wire_compression = config.get('wire_compression')  # Codec for data forwarded to secondaries, e.g. "zlib"
+        self.compression_min_bytes = config.get('compression_min_bytes', DEFAULT_COMPRESSION_MIN_BYTES)
+        self.compress_at_rest = config.get('compress_at_rest')  # Codec for idle chunks; None keeps them raw
+        self.compress_after_seconds = config.get('compress_after_seconds', DEFAULT_COMPRESS_AFTER_SECONDS)
+        # Orders switching a chunk between its raw and compressed form against writes to it
+        self.storage_lock = threading.Lock()
+        self.chunks_in_use = {}  # Reads and scrubs running per chunk; the compactor leaves these alone
+        self.stats_lock = threading.Lock()
+        self.in_flight = 0  # Requests currently being handled
+        self.bytes_served = 0  # Payload bytes sent in responses since startup
+        self.latency_ewma = None  # Smoothed request service time in seconds
+        self.chunk_reads = {}  # Reads per chunk since the last heartbeat, for the master's heat tracking
+        self.chunk_writes = {}  # Records committed per chunk since the last heartbeat; clients write here without the master
+        self.connection_pool = ConnectionPool(timeout=5)  # Persistent connections to other chunk servers
+        self.async_connection_pool = AsyncConnectionPool(timeout=5)  # Same, for the asyncio mode
+        # Fans writes out to all secondaries concurrently in threaded mode
+        self.replication_executor = ThreadPoolExecutor(
+            max_workers=config.get('replication_workers', DEFAULT_REPLICATION_WORKERS)
+        )
+        # Per-class limits on requests running at once, with bounded queues; overflow gets a busy reply
+        self.request_limits = config.get('request_limits')
+        self.request_queue_limits = config.get('request_queue_limits')
+        self.request_queue_timeout = config.get('request_queue_timeout', DEFAULT_QUEUE_TIMEOUT)
+        self.admission = AdmissionController(self.request_limits, self.request_queue_limits, self.request_queue_timeout)
+        self.busy_retry_after = config.get('busy_retry_after', DEFAULT_RETRY_AFTER)
+        self.max_connections = config.get('max_connections', DEFAULT_MAX_CONNECTIONS)
+        # Idle pooled connections would otherwise hold a thread and a connection slot for good
+        self.idle_timeout = config.get('idle_timeout', DEFAULT_IDLE_TIMEOUT)
+        self.worker_threads = config.get('worker_threads', DEFAULT_WORKER_THREADS)
+        self.connections = 0  # Connections being served in threaded mode
+        # Request latencies, byte counts and replication lag, served by the "stats" request
+        self.metrics = MetricsRegistry()
+        self.metrics.register_gauge("connections", lambda: self.connections)
+        self.metrics.register_gauge("admission", lambda: self.admission.snapshot())
+        self.metrics.register_gauge("in_flight", lambda: self.in_flight)
+        self.metrics.register_gauge("chunks", lambda: len(self.chunks))
+        self.metrics.register_gauge("staged_bytes", lambda: self.staging_buffer.total_bytes)
+        self.metrics.register_gauge("open_chunk_files", lambda: len(self.append_engine.appenders))
         self.load_server_files()
 
     def load_server_files(self):
-        # Load files from the corresponding directory based on server_id
-        directory = f"{self.server_id}_files"  # E.g., "server1_files"
-        
-        # Load files from files_metadata.json
-        with open("files_metadata.json", "r") as f:
-            file_metadata = json.load(f)
-
-        # For each file in the metadata, check if this server manages it
-        for file_name, file_info in file_metadata.items():
-            if self.server_id in file_info["replicas"]:
-                # File path is inside the server's specific directory
-                file_path = os.path.join(directory, file_name)
-                if os.path.exists(file_path):
-                    self.files[file_name] = file_path
-        
-        print(f"Server {self.server_id} managing files: {list(self.files.keys())}")
+        # Chunks are stored by handle as "<handle>.chunk" inside the server's directory
+        os.makedirs(self.directory, exist_ok=True)
+        compressed = {}
+        for entry in os.listdir(self.directory):
+            if entry.endswith(".chunkz"):
+                compressed[entry[:-len(".chunkz")]] = os.path.join(self.directory, entry)
+            elif entry.endswith(".chunk"):
+                chunk_handle = entry[:-len(".chunk")]
+                self.chunks[chunk_handle] = os.path.join(self.directory, entry)
+            elif entry.endswith(".version"):
+                with open(os.path.join(self.directory, entry), 'r') as f:
+                    self.chunk_versions[entry[:-len(".version")]] = int(f.read().strip() or 0)
+        # A raw copy next to a compressed one means a write inflated it; the raw one is current
+        for chunk_handle, path in compressed.items():
+            self.chunks.setdefault(chunk_handle, path)
+
+        self.log.info("Loaded chunks", chunks=len(self.chunks))
+
+    def get_chunk_path(self, chunk_handle):
+        return os.path.join(self.directory, f"{chunk_handle}.chunk")
+
+    def get_compressed_path(self, chunk_handle):
+        return os.path.join(self.directory, f"{chunk_handle}.chunkz")
+
+    def is_compressed(self, chunk_handle):
+        return self.chunks.get(chunk_handle, "").endswith(".chunkz")
+
+    @contextlib.contextmanager
+    def chunk_in_use(self, chunk_handle):
+        # Yields the chunk's current path, or None, and keeps the compactor from swapping the
+        # file out underneath the caller until it is done
+        with self.storage_lock:
+            path = self.chunks.get(chunk_handle)
+            self.chunks_in_use[chunk_handle] = self.chunks_in_use.get(chunk_handle, 0) + 1
+        try:
+            yield path
+        finally:
+            with self.storage_lock:
+                self.chunks_in_use[chunk_handle] -= 1
+                if not self.chunks_in_use[chunk_handle]:
+                    del self.chunks_in_use[chunk_handle]
+
+    def set_chunk_version(self, chunk_handle, version):
+        # Persisted next to the chunk so a restarted server still reports the version it holds
+        version_path = os.path.join(self.directory, f"{chunk_handle}.version")
+        with open(version_path + ".tmp", 'w') as f:
+            f.write(str(version))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(version_path + ".tmp", version_path)
+        self.chunk_versions[chunk_handle] = version
+
+    def delete_chunk(self, chunk_handle):
+        file_path = self.get_chunk_path(chunk_handle)
+        self.append_engine.discard(file_path)
+        for path in (file_path, checksum_path(file_path), self.get_compressed_path(chunk_handle),
+                     os.path.join(self.directory, f"{chunk_handle}.version")):
+            if os.path.exists(path):
+                os.remove(path)
+        self.chunks.pop(chunk_handle, None)
+        self.chunk_versions.pop(chunk_handle, None)
+        self.log.info("Deleted replica", chunk=chunk_handle)
+
+    def begin_request(self):
+        with self.stats_lock:
+            self.in_flight += 1
+        return time.monotonic()
+
+    def record_read(self, chunk_handle):
+        self.chunk_access[chunk_handle] = time.monotonic()
+        with self.stats_lock:
+            self.chunk_reads[chunk_handle] = self.chunk_reads.get(chunk_handle, 0) + 1
+
+    def get_used_bytes(self):
+        used = 0
+        for path in list(self.chunks.values()):
+            try:
+                used += os.path.getsize(path)
+            except OSError:
+                continue
+        return used
+
+    def end_request(self, bytes_sent, started, request_type=None, bytes_received=0):
+        elapsed = time.monotonic() - started
+        with self.stats_lock:
+            self.in_flight -= 1
+            self.bytes_served += bytes_sent
+            self.latency_ewma = elapsed if self.latency_ewma is None else self.latency_ewma + EWMA_ALPHA * (elapsed - self.latency_ewma)
+        self.metrics.observe(f"request.{request_type}", elapsed)
+        self.metrics.increment("bytes_sent", bytes_sent)
+        self.metrics.increment("bytes_received", bytes_received)
+
+    def start_heartbeat(self):
+        if self.master_address:
+            heartbeat_thread = threading.Thread(target=self.send_heartbeats, daemon=True)
+            heartbeat_thread.start()
+
+    def send_heartbeats(self):
+        # Push liveness and load to the master; the full chunk list rides on every Nth beat
+        beat = 0
+        while True:
+            with self.stats_lock:
+                heartbeat = {
+                    "type": "heartbeat",
+                    "server": self.server_id,
+                    "in_flight": self.in_flight,
+                    "bytes_served": self.bytes_served,
+                    "latency": self.latency_ewma,
+                    "chunk_reads": self.chunk_reads,
+                    "chunk_writes": self.chunk_writes,
+                }
+                self.chunk_reads = {}
+                self.chunk_writes = {}
+            # Ask to extend the leases still held; a renewal counts from before the request is sent
+            sent_at = time.monotonic()
+            heartbeat["leases"] = [chunk_handle for chunk_handle, expires in list(self.leases.items())
+                                   if expires > sent_at and chunk_handle not in self.sealed_chunks]
+            heartbeat["free_disk"] = shutil.disk_usage(self.directory).free
+            if beat % self.chunk_report_every == 0:
+                # Bytes held in chunks; servers may share a disk, so free space alone can't balance them
+                heartbeat["used_bytes"] = self.get_used_bytes()
+                # Versions let the master spot replicas that missed a mutation while down
+                heartbeat["chunks"] = {chunk_handle: self.chunk_versions.get(chunk_handle, 0)
+                                       for chunk_handle in list(self.chunks)}
+            try:
+                response, _ = self.connection_pool.request(self.master_address, heartbeat)
+                for chunk_handle, seconds in response.get("leases", {}).items():
+                    if chunk_handle in self.leases:
+                        self.leases[chunk_handle] = max(self.leases[chunk_handle], sent_at + seconds)
+                for chunk_handle in response.get("stale_chunks", []):
+                    self.delete_chunk(chunk_handle)
+                beat += 1
+            except Exception as e:
+                self.log.warning("Error sending heartbeat to master", error=e)
+            time.sleep(self.heartbeat_interval)
+
+    def start_scrubber(self):
+        if self.scrub_bytes_per_second:
+            scrubber_thread = threading.Thread(target=self.scrub_chunks, daemon=True)
+            scrubber_thread.start()
+
+    def scrub_chunks(self):
+        # Slowly verify chunks nobody has touched lately; reads and writes check hot ones already
+        while True:
+            scrubbed = 0
+            for chunk_handle in list(self.chunks):
+                if time.monotonic() - self.chunk_access.get(chunk_handle, 0) < self.scrub_cold_seconds:
+                    continue
+                file_path = self.chunks.get(chunk_handle)
+                if self.is_compressed(chunk_handle):
+                    # Compressed chunks carry a checksum per block in their index
+                    try:
+                        stored = os.path.getsize(file_path)
+                        intact = CompressedChunk(file_path).verify()
+                    except (OSError, ValueError) as e:
+                        self.log.error("Error scrubbing chunk", chunk=chunk_handle, error=e)
+                        continue
+                    if not intact:
+                        self.report_corrupt_chunk(chunk_handle)
+                    scrubbed += stored
+                    time.sleep(stored / self.scrub_bytes_per_second)
+                    continue
+                offset = 0
+                while file_path and offset < self.get_chunk_length(chunk_handle):
+                    # The chunk may be compressed, replaced or deleted between pieces; stop if so
+                    with self.chunk_in_use(chunk_handle) as current_path:
+                        if current_path != file_path:
+                            break
+                        try:
+                            intact = self.append_engine.verify(file_path, offset, SCRUB_PIECE_SIZE)
+                        except OSError as e:
+                            self.log.error("Error scrubbing chunk", chunk=chunk_handle, error=e)
+                            break
+                    if not intact:
+                        self.report_corrupt_chunk(chunk_handle)
+                        break
+                    offset += SCRUB_PIECE_SIZE
+                    scrubbed += SCRUB_PIECE_SIZE
+                    time.sleep(SCRUB_PIECE_SIZE / self.scrub_bytes_per_second)
+            if not scrubbed:
+                time.sleep(self.scrub_cold_seconds)
+
+    def report_corrupt_chunk(self, chunk_handle):
+        # The master drops the replica if a good copy exists elsewhere, and then we delete ours
+        self.log.error("Checksum mismatch", chunk=chunk_handle)
+        if not self.master_address:
+            return
+        try:
+            response, _ = self.connection_pool.request(
+                self.master_address, {"type": "corrupt_chunk", "server": self.server_id, "chunk_handle": chunk_handle}
+            )
+            if response.get("delete"):
+                self.delete_chunk(chunk_handle)
+        except Exception as e:
+            self.log.warning("Error reporting corrupt chunk to master", chunk=chunk_handle, error=e)
+
+    def start_compactor(self):
+        if self.compress_at_rest:
+            compactor_thread = threading.Thread(target=self.compress_idle_chunks, daemon=True)
+            compactor_thread.start()
+
+    def compress_idle_chunks(self):
+        while True:
+            time.sleep(self.compress_after_seconds / 2)
+            for chunk_handle in list(self.chunks):
+                idle = time.monotonic() - self.chunk_access.get(chunk_handle, 0) >= self.compress_after_seconds
+                if idle and not self.is_compressed(chunk_handle):
+                    try:
+                        self.compress_chunk(chunk_handle)
+                    except (OSError, ValueError) as e:
+                        self.log.error("Error compressing chunk", chunk=chunk_handle, error=e)
+
+    def compress_chunk(self, chunk_handle):
+        # Rewrite an idle chunk in compressed form; a read or write while we work keeps it raw
+        raw_path = self.get_chunk_path(chunk_handle)
+        compressed_path = self.get_compressed_path(chunk_handle)
+        last_access = self.chunk_access.get(chunk_handle, 0)
+        if chunk_handle in self.chunks_in_use or self.chunks.get(chunk_handle) != raw_path:
+            return
+        size = os.path.getsize(raw_path)
+        if not size:
+            return
+        if not self.append_engine.verify(raw_path, 0, size):
+            self.report_corrupt_chunk(chunk_handle)
+            return
+        stored = write_compressed_chunk(raw_path, compressed_path, self.compress_at_rest)
+        with self.storage_lock:
+            # A read or scrub still using the raw file, or one that started meanwhile, wins
+            if (self.chunk_access.get(chunk_handle, 0) != last_access or stored >= size
+                    or chunk_handle in self.chunks_in_use or self.chunks.get(chunk_handle) != raw_path):
+                os.remove(compressed_path)
+                return
+            self.append_engine.discard(raw_path)
+            self.chunks[chunk_handle] = compressed_path
+            for path in (raw_path, checksum_path(raw_path)):
+                if os.path.exists(path):
+                    os.remove(path)
+        self.log.info("Compressed chunk", chunk=chunk_handle, size=size, stored=stored)
+
+    def open_for_write(self, chunk_handle):
+        # Every mutation path calls this first; a compressed chunk goes back to raw form so the
+        # append engine can extend or truncate it
+        with self.storage_lock:
+            self.chunk_access[chunk_handle] = time.monotonic()
+            if not self.is_compressed(chunk_handle):
+                return
+            compressed_path = self.chunks[chunk_handle]
+            raw_path = self.get_chunk_path(chunk_handle)
+            inflate_chunk(compressed_path, raw_path)
+            self.chunks[chunk_handle] = raw_path
+            os.remove(compressed_path)
+            self.log.info("Inflated chunk for writing", chunk=chunk_handle)
 
     def start(self):
+        self.start_heartbeat()
+        self.start_scrubber()
+        self.start_compactor()
+        if self.server_mode == 'asyncio':
+            asyncio.run(self.start_async())
+            return
         try:
             # Create the server socket
             server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             server_socket.bind((self.server_address, self.server_port))  # Corrected the attribute names
-            server_socket.listen(5)
-            print(f"Server {self.server_id} listening on {self.server_address}:{self.server_port}")  # Corrected print statement
+            server_socket.listen(self.listen_backlog)
+            self.log.info("Listening", address=f"{self.server_address}:{self.server_port}")
 
-            # Accept clients in a loop
+            # Accept clients in a loop, one thread each up to max_connections
             while True:
                 client_socket, addr = server_socket.accept()
-                print(f"Connection from {addr}")
+                set_nodelay(client_socket)
+                with self.stats_lock:
+                    accepted = self.connections < self.max_connections
+                    if accepted:
+                        self.connections += 1
+                if not accepted:
+                    self.reject_connection(client_socket)
+                    continue
+                self.log.debug("Connection accepted", peer=addr)
                 client_handler = threading.Thread(target=self.handle_client, args=(client_socket,))
                 client_handler.start()
 
         except Exception as e:
-            print(f"Error starting server {self.server_id}: {e}")  # Corrected the attribute name
+            self.log.error("Error starting server", error=e)
         finally:
             server_socket.close()
-    
-    def handle_client(self, client_socket):
+
+    def reject_connection(self, client_socket):
+        # Past the connection limit the peer gets a busy reply instead of a thread
+        self.metrics.increment("connections_rejected")
         try:
-            # Step 1: Receive and decode the request from the client
-            data = client_socket.recv(4096).decode().strip()
-            request = json.loads(data)  # Parse JSON request
-            request_type = request.get("type")
-            file_name = request.get("file_name")
-
-            # Handle write requests differently based on the server type
-            if request_type == "write":
-                content = request.get("data")
-                server_type = request.get("server")  # 'primary' or 'secondary'
-                print(f"Received write request for {file_name} with content '{content}'")
-
-                # Primary server handles write and forwards to secondary servers
-                if server_type == "primary":
-                    print(f"Primary server {self.server_id} handling write to {file_name} with content '{content}'")
-
-                    # Append data to the file locally
-                    success = self.append_to_file(file_name, content)
-
-                    if success:
-                        # Deduce secondaries by excluding the current server from the replicas
-                        secondaries = self.get_secondaries(file_name)
-                        print(f"Secondaries for {file_name}: {secondaries}")
-
-                        # Forward the write to secondaries
-                        secondary_status = []
-                        for secondary_address in secondaries:
-                            try:
-                                sec_host, sec_port = secondary_address
-                                secondary_status.append(self.forward_to_secondary(sec_host, sec_port, file_name, content))
-                            except Exception as e:
-                                print(f"Error forwarding to secondary {secondary_address}: {e}")
-                                secondary_status.append(False)
-
-                        # Verify if all secondaries succeeded
-                        if all(secondary_status):
-                            client_socket.sendall(b"Write success")
-                            print("Write committed successfully to primary and all secondaries")
-                        else:
-                            # Rollback if any secondary fails
-                            self.rollback_file(file_name)
-                            for sec_addr in secondaries:
-                                self.rollback_secondary(sec_addr, file_name)
-                            client_socket.sendall(b"Write failed")
-                            print("Write failed; rolled back changes")
-                    else:
-                        client_socket.sendall(b"Write failed")
-                        print("Write failed locally")
-
-                # Secondary server forwards the write to its file (it does not initiate writes)
-                elif server_type == "secondary":
-                    print(f"Secondary server {self.server_id} received write request for {file_name} with content '{content}'")
-                    success = self.append_to_file(file_name, content)
-                    if success:
-                        client_socket.sendall(b"Write success")
-                        print(f"Write successful on secondary server {self.server_id}")
-                    else:
-                        client_socket.sendall(b"Write failed")
-                        print(f"Write failed on secondary server {self.server_id}")
-
-            # Handle read requests (not server_type dependent)
-            if request_type == "read":
-                print(f"Client requested to read: {file_name}")
-                if file_name in self.files and os.path.exists(self.files[file_name]):
-                    # Open and send the file contents in chunks
-                    try:
-                        with open(self.files[file_name], 'rb') as f:
-                            while chunk := f.read(4096):
-                                client_socket.sendall(chunk)
-                        print(f"Sent file {file_name} to client")
-                    except Exception as e:
-                        print(f"Error reading file {file_name}: {e}")
-                        client_socket.sendall(f"Error: Could not read file {file_name}".encode())
-                else:
-                    error_message = f"Error: File {file_name} not found on server."
-                    print(error_message)
-                    client_socket.sendall(error_message.encode())
+            client_socket.settimeout(1)
+            send_message(client_socket, busy_response(self.busy_retry_after))
+        except OSError:
+            pass
+        finally:
+            client_socket.close()
 
-            else:
-                print(f"Unknown request type {request_type}")
+    def request_class(self, request):
+        # Admission class of a request; None for control traffic, which is never turned away
+        request_type = request.get("type")
+        if request_type in ("read", "chunk_length"):
+            return "read"
+        if request_type == "push_data" or (request_type == "write" and request.get("server") == "primary"):
+            return "write"
+        if request_type in ("write", "replicate", "rollback", "encode_chunk", "store_fragment", "rebuild_fragment"):
+            return "replication"
+        return None
+
+    async def start_async(self):
+        # One event loop serves every connection instead of a thread per connection; blocking
+        # work runs on a fixed pool of worker threads
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=self.worker_threads))
+        self.admission = AsyncAdmissionController(self.request_limits, self.request_queue_limits,
+                                                  self.request_queue_timeout)
+        try:
+            server = await asyncio.start_server(self.handle_client_async, self.server_address, self.server_port,
+                                                backlog=self.listen_backlog, reuse_address=True)
+            self.log.info("Listening", address=f"{self.server_address}:{self.server_port}", mode="asyncio")
+            async with server:
+                await server.serve_forever()
+        except Exception as e:
+            self.log.error("Error starting server", error=e)
 
+    async def handle_client_async(self, reader, writer):
+        try:
+            while True:
+                request, payload = await read_message(reader)
+                if request is None:
+                    break
+                request_class = self.request_class(request)
+                if not await self.admission.admit_async(request_class):
+                    self.metrics.increment(f"busy.{request_class}")
+                    await write_message(writer, busy_response(self.busy_retry_after))
+                    continue
+                started = self.begin_request()
+                response_payload = b""
+                try:
+                    response, response_payload = await self.handle_request_async(request, payload)
+                    await write_message(writer, response, response_payload, self.transfer_block_size)
+                finally:
+                    self.end_request(len(response_payload), started, request.get("type"), len(payload))
+                    await self.admission.release_async(request_class)
         except Exception as e:
-            print(f"Error handling client request: {e}")
+            self.log.warning("Error handling client request", error=e)
         finally:
-            client_socket.close()
+            writer.close()
 
+    async def handle_request_async(self, request, payload):
+        loop = asyncio.get_running_loop()
+        if request.get("type") == "write" and request.get("server") == "primary":
+            if request.get("encoding"):
+                payload = await loop.run_in_executor(None, decode_payload, request, payload)
+            return await self.handle_primary_write_async(request, payload)
+        # Everything else only touches the local disk, so run it on the default executor
+        return await loop.run_in_executor(None, self.handle_request, request, payload)
 
-    def append_to_file(self, file_name, content):
+    def handle_client(self, client_socket):
         try:
-            file_path = os.path.join(f"{self.server_id}_files", file_name)
-            # Open the file in append mode
-            with open(file_path, 'a') as f:
-                f.write(content)
-            print(f"Write successful on {file_name}")
-            return True
+            # Serve framed requests until the peer closes its persistent connection or leaves it
+            # idle; pools retry a request once on a connection closed while idle
+            while True:
+                if not wait_for_message(client_socket, self.idle_timeout):
+                    self.metrics.increment("connections_idle_closed")
+                    break
+                request, payload = recv_message(client_socket)
+                if request is None:
+                    break
+                request_class = self.request_class(request)
+                if not self.admission.admit(request_class):
+                    self.metrics.increment(f"busy.{request_class}")
+                    send_message(client_socket, busy_response(self.busy_retry_after))
+                    continue
+                started = self.begin_request()
+                response_payload = b""
+                try:
+                    response, response_payload = self.handle_request(request, payload)
+                    send_message(client_socket, response, response_payload, self.transfer_block_size)
+                finally:
+                    self.end_request(len(response_payload), started, request.get("type"), len(payload))
+                    self.admission.release(request_class)
+
         except Exception as e:
-            print(f"Error writing to {file_name}: {e}")
-            return False
+            self.log.warning("Error handling client request", error=e)
+        finally:
+            with self.stats_lock:
+                self.connections -= 1
+            client_socket.close()
 
-    def get_secondaries(self, file_name):
+    def handle_request(self, request, payload):
+        # Payloads may arrive compressed, and replies are compressed for peers that accept it
         try:
-            # Load file metadata
-            with open("files_metadata.json", "r") as f:
-                file_metadata = json.load(f)
-
-            if file_name in file_metadata:
-                replicas = file_metadata[file_name]["replicas"]
-                # Exclude the current server from the list of replicas
-                secondaries = [replica for replica in replicas if replica != self.server_id]
-                
-                # Retrieve full server address (host, port) from servers.json for each secondary server
-                secondary_addresses = []
-                with open("servers.json", "r") as servers_file:
-                    servers_data = json.load(servers_file)
-                    
-                    # Get the actual address (IP and port) for each secondary server
-                    for secondary in secondaries:
-                        if secondary in servers_data:
-                            secondary_addresses.append(tuple(servers_data[secondary]))
-                        else:
-                            print(f"Warning: No address found for {secondary} in servers.json")
-
-                return secondary_addresses
+            payload = decode_payload(request, payload)
+        except ValueError as e:
+            return {"status": "error", "message": str(e)}, b""
+        response, response_payload = self.dispatch_request(request, payload)
+        return self.encode_response(request, response, response_payload)
+
+    def encode_response(self, request, response, payload):
+        codec_name = negotiate(request.get("accept_encoding"))
+        if not codec_name or len(payload) < self.compression_min_bytes:
+            return response, payload
+        if isinstance(payload, FileRange):
+            # Compressed replies give up sendfile, which is the trade for fewer bytes on the wire
+            with open(payload.path, 'rb') as f:
+                payload = os.pread(f.fileno(), payload.length, payload.offset)
+        return response, encode_payload(response, payload, codec_name)
+
+    def dispatch_request(self, request, payload):
+        request_type = request.get("type")
+        chunk_handle = request.get("chunk_handle")
+
+        if request_type == "stats":
+            return {"status": "ok", "stats": self.metrics.snapshot()}, b""
+
+        # Phase one of a write: hold the client's data until the primary orders the mutation
+        if request_type == "push_data":
+            data_id = request.get("data_id")
+            if self.staging_buffer.put(data_id, payload):
+                self.log.debug("Staged data", data_id=data_id, bytes=len(payload))
+                return {"status": "ok"}, b""
+            return {"status": "error", "message": "Data larger than the staging buffer"}, b""
+
+        # Handle write requests differently based on the server type
+        elif request_type == "write":
+            server_type = request.get("server")  # 'primary' or 'secondary'
+
+            # Primary server handles write and forwards to secondary servers
+            if server_type == "primary":
+                content = self.resolve_write_content(request, payload)
+                if content is None:
+                    return {"status": "error", "message": f"Data {request.get('data_id')} not staged"}, b""
+                self.log.debug("Primary write request", chunk=chunk_handle, bytes=len(content))
+                return self.handle_primary_write(request, content)
+
+            # Secondary server applies the mutation at the offset the primary chose
+            elif server_type == "secondary":
+                self.log.debug("Secondary write request", chunk=chunk_handle)
+                return self.apply_secondary_write(request, payload)
+
+            return {"status": "error", "message": f"Unknown server type {server_type}"}, b""
+
+        elif request_type == "rollback":
+            # Undo a failed mutation by cutting the chunk back to the offset it started at
+            if self.rollback_chunk(chunk_handle, request.get("offset")):
+                return {"status": "ok"}, b""
+            return {"status": "error", "message": f"Could not roll back chunk {chunk_handle}"}, b""
+
+        # Handle read requests (not server_type dependent)
+        elif request_type == "read":
+            # An optional byte range lets clients stripe one chunk across several replicas
+            offset = request.get("offset", 0)
+            length = request.get("length")
+            self.log.debug("Read request", chunk=chunk_handle, offset=offset, length=length)
+            with self.chunk_in_use(chunk_handle) as path:
+                if path is not None and path.endswith(".chunkz"):
+                    # Only the blocks covering the range are decompressed, and each is checked as it is
+                    try:
+                        self.record_read(chunk_handle)
+                        data = CompressedChunk(path).read(offset, length)
+                        self.log.debug("Sending compressed chunk data", chunk=chunk_handle, bytes=len(data))
+                        return {"status": "ok"}, data
+                    except ValueError as e:
+                        self.log.error("Corrupt compressed chunk", chunk=chunk_handle, error=e)
+                        threading.Thread(target=self.report_corrupt_chunk, args=(chunk_handle,), daemon=True).start()
+                        return {"status": "error", "message": f"Chunk {chunk_handle} is corrupt on this server"}, b""
+                    except OSError as e:
+                        self.log.error("Error reading chunk", chunk=chunk_handle, error=e)
+                        return {"status": "error", "message": f"Could not read chunk {chunk_handle}"}, b""
+                if path is not None and os.path.exists(path):
+                    # The chunk contents are streamed from disk as the response payload, after checking
+                    # the checksums of just the blocks the range touches. Recording the read first
+                    # keeps the compactor from replacing the file before it is sent
+                    try:
+                        self.record_read(chunk_handle)
+                        file_range = file_range_for(path, offset, length)
+                        if not self.append_engine.verify(file_range.path, file_range.offset, file_range.length):
+                            threading.Thread(target=self.report_corrupt_chunk, args=(chunk_handle,),
+                                             daemon=True).start()
+                            return ({"status": "error", "message": f"Chunk {chunk_handle} is corrupt on this server"},
+                                    b"")
+                        self.log.debug("Sending chunk data", chunk=chunk_handle, bytes=file_range.length)
+                        return {"status": "ok"}, file_range
+                    except OSError as e:
+                        self.log.error("Error reading chunk", chunk=chunk_handle, error=e)
+                        return {"status": "error", "message": f"Could not read chunk {chunk_handle}"}, b""
+            error_message = f"Chunk {chunk_handle} not found on server."
+            self.log.debug("Chunk not found", chunk=chunk_handle)
+            return {"status": "error", "message": error_message}, b""
+
+        elif request_type == "chunk_length":
+            if chunk_handle in self.chunks:
+                return {"status": "ok", "length": self.get_chunk_length(chunk_handle)}, b""
+            return {"status": "error", "message": f"Chunk {chunk_handle} not found on server."}, b""
+
+        elif request_type == "replicate":
+            # The master asks us to pull a copy of a sealed chunk from another replica
+            try:
+                self.replicate_chunk(chunk_handle, tuple(request["source"]), request["length"], request.get("version", 0),
+                                     request.get("bandwidth"))
+                return {"status": "ok"}, b""
+            except (OSError, ValueError) as e:
+                self.log.error("Error copying chunk", chunk=chunk_handle, error=e)
+                return {"status": "error", "message": f"Could not copy chunk {chunk_handle}: {e}"}, b""
+
+        elif request_type == "encode_chunk":
+            # The master asks us to turn our replica of a sealed chunk into erasure-coded fragments
+            try:
+                self.encode_chunk(chunk_handle, request["length"], request["data_shards"], request["parity_shards"],
+                                  [tuple(address) for address in request["destinations"]], request.get("bandwidth"))
+                return {"status": "ok"}, b""
+            except (OSError, ValueError) as e:
+                self.log.error("Error erasure coding chunk", chunk=chunk_handle, error=e)
+                return {"status": "error", "message": f"Could not erasure code chunk {chunk_handle}: {e}"}, b""
+
+        elif request_type == "store_fragment":
+            try:
+                self.store_fragment(chunk_handle, payload)
+                return {"status": "ok"}, b""
+            except OSError as e:
+                self.log.error("Error storing fragment", chunk=chunk_handle, error=e)
+                return {"status": "error", "message": f"Could not store fragment {chunk_handle}: {e}"}, b""
+
+        elif request_type == "rebuild_fragment":
+            try:
+                sources = {int(index): tuple(address) for index, address in request["sources"].items()}
+                self.rebuild_fragment(chunk_handle, request["index"], request["data_shards"],
+                                      request["parity_shards"], sources)
+                return {"status": "ok"}, b""
+            except (OSError, ValueError) as e:
+                self.log.error("Error rebuilding fragment", chunk=chunk_handle, error=e)
+                return {"status": "error", "message": f"Could not rebuild fragment of {chunk_handle}: {e}"}, b""
+
+        elif request_type == "seal_chunk":
+            # Queue behind any batch in flight so the length we report is final. The master seals
+            # secondaries too, so no write a stale primary forwards can extend the chunk afterwards
+            if chunk_handle not in self.chunks:
+                return {"status": "error", "message": f"Chunk {chunk_handle} not found on server."}, b""
+            seal = {"data_id": None, "content": b"", "secondaries": []}
+            self.open_for_write(chunk_handle)
+            self.sealed_chunks.add(chunk_handle)
+            self.get_mutation_batcher(chunk_handle).submit(
+                seal, lambda records: self.apply_mutation(chunk_handle, records, self.forward_in_threads)
+            )
+            return {"status": "ok", "length": self.append_engine.size(self.get_chunk_path(chunk_handle))}, b""
+
+        elif request_type in ("primary_assignment", "version_update"):
+            received = time.monotonic()
+            # Make sure the chunk exists locally so reads of a fresh chunk succeed
+            self.create_chunk(chunk_handle)
+            if "version" in request:
+                self.set_chunk_version(chunk_handle, request["version"])
+            # A newer election may have made another replica primary. The master never elects for
+            # a sealed chunk, so one it elects for takes appends again
+            self.leases.pop(chunk_handle, None)
+            self.sealed_chunks.discard(chunk_handle)
+            if request_type == "primary_assignment":
+                # Counted from when the assignment arrived, before the master starts its own count
+                self.leases[chunk_handle] = received + request.get("lease_seconds", 0)
+                self.log.info("Assigned primary", chunk=chunk_handle, lease_seconds=request.get("lease_seconds"))
+                secondaries = [tuple(address) for address in request.get("secondaries", [])]
+                self.reconcile_chunk(chunk_handle, secondaries)
+            return {"status": "ok"}, b""
+
+        self.log.warning("Unknown request type", type=request_type)
+        return {"status": "error", "message": f"Unknown request type {request_type}"}, b""
+
+    def check_primary_write(self, chunk_handle, content, version=None):
+        # Returns an error response if the write cannot go to this chunk, otherwise None
+        self.log.debug("Handling primary write", chunk=chunk_handle)
+        if len(content) > self.chunk_size:
+            self.log.warning("Rejected write larger than chunk size", chunk=chunk_handle, bytes=len(content))
+            return {"status": "error", "message": "Write larger than chunk size"}, b""
+
+        # Either this replica or the client's view of the chunk missed a primary election
+        local_version = self.chunk_versions.get(chunk_handle, 0)
+        if version is not None and version != local_version:
+            self.log.warning("Rejected write with a different version", chunk=chunk_handle, version=version,
+                             local_version=local_version)
+            return {"status": "error", "message": "Chunk version mismatch"}, b""
+
+        # Only the holder of an unexpired lease may order writes; once it runs out the master is
+        # free to make another replica primary
+        if self.leases.get(chunk_handle, 0) <= time.monotonic():
+            self.log.warning("Rejected write without a primary lease", chunk=chunk_handle)
+            return {"status": "error", "message": "Not primary or lease expired"}, b""
+        return None
+
+    def resolve_write_content(self, request, payload):
+        # Two-phase writes name data pushed earlier; single-phase writes carry it as the payload
+        data_id = request.get("data_id")
+        if data_id:
+            return self.staging_buffer.get(data_id)
+        return payload
+
+    def get_mutation_batcher(self, chunk_handle):
+        with self.batchers_lock:
+            return self.mutation_batchers.setdefault(chunk_handle, MutationBatcher())
+
+    def handle_primary_write(self, request, content, forward=None):
+        chunk_handle = request.get("chunk_handle")
+        rejection = self.check_primary_write(chunk_handle, content, request.get("version"))
+        if rejection:
+            return rejection
+
+        # The master hands the secondaries of this chunk to the client with the primary
+        record = {
+            "data_id": request.get("data_id"),
+            "content": content,
+            "secondaries": [tuple(address) for address in request.get("secondaries", [])],
+        }
+        # Concurrent writes to the chunk are applied one batch at a time, so every replica
+        # sees the same mutations at the same offsets
+        response = self.get_mutation_batcher(chunk_handle).submit(
+            record, lambda records: self.apply_mutation(chunk_handle, records, forward or self.forward_in_threads)
+        )
+        return response, b""
+
+    async def handle_primary_write_async(self, request, payload):
+        # Batching runs on the executor while forwarding to secondaries stays on the event loop
+        loop = asyncio.get_running_loop()
+        content = self.resolve_write_content(request, payload)
+        if content is None:
+            return {"status": "error", "message": f"Data {request.get('data_id')} not staged"}, b""
+
+        def forward(secondaries, write_data, forward_payload):
+            return [
+                asyncio.run_coroutine_threadsafe(self.forward_to_secondary_async(address, write_data, forward_payload), loop)
+                for address in secondaries
+            ]
+
+        return await loop.run_in_executor(None, self.handle_primary_write, request, content, forward)
+
+    def apply_mutation(self, chunk_handle, records, forward):
+        # Returns one response per record. The batch starts at the current end of the chunk;
+        # records that no longer fit, or arrive after the chunk is sealed, get chunk_full instead
+        self.open_for_write(chunk_handle)
+        offset = self.append_engine.size(self.get_chunk_path(chunk_handle))
+        responses = []
+        accepted = []
+        end = offset
+        for record in records:
+            if chunk_handle in self.sealed_chunks or end + len(record["content"]) > self.chunk_size:
+                # Once full the chunk stays full, so its length is final when the master seals it
+                self.log.debug("Chunk is full", chunk=chunk_handle)
+                self.sealed_chunks.add(chunk_handle)
+                responses.append({"status": "chunk_full"})
+                continue
+            responses.append({"status": "ok", "offset": end})
+            accepted.append(record)
+            end += len(record["content"])
+        if not accepted:
+            return responses
+
+        secondaries = accepted[0]["secondaries"]
+        self.log.debug("Forwarding to secondaries", chunk=chunk_handle, secondaries=secondaries)
+        write_data = {
+            "type": "write",
+            "server": "secondary",
+            "chunk_handle": chunk_handle,
+            "version": self.chunk_versions.get(chunk_handle, 0),
+            "offset": offset,
+            "records": [],
+        }
+        inline = []
+        for record in accepted:
+            if record["data_id"]:
+                # Secondaries already hold the pushed data, so only its ID is sent
+                write_data["records"].append({"data_id": record["data_id"]})
             else:
-                print(f"Error: {file_name} not found in metadata")
-                return []
+                write_data["records"].append({"length": len(record["content"])})
+                inline.append(record["content"])
+        inline_payload = b"".join(inline)
+        if self.wire_compression and len(inline_payload) >= self.compression_min_bytes:
+            inline_payload = encode_payload(write_data, inline_payload, self.wire_compression)
+
+        # Forward to every secondary at once while writing locally, so latency tracks the slowest replica
+        forwards = forward(secondaries, write_data, inline_payload)
+        local_offset = self.append_to_chunk(chunk_handle, b"".join(record["content"] for record in accepted), offset)
+        local_done = time.monotonic()
+        secondary_status = [future.result() for future in forwards]
+        # How long the secondaries trail the primary's own append
+        self.metrics.observe("replication_lag", time.monotonic() - local_done)
+        for record in accepted:
+            self.staging_buffer.discard(record["data_id"])
+
+        if local_offset is not None and all(secondary_status):
+            self.log.debug("Committed writes", chunk=chunk_handle, count=len(accepted), offset=offset)
+            self.metrics.increment("records_committed", len(accepted))
+            with self.stats_lock:
+                self.chunk_writes[chunk_handle] = self.chunk_writes.get(chunk_handle, 0) + len(accepted)
+            return responses
+        if local_offset is None:
+            self.log.error("Write failed locally", chunk=chunk_handle)
+        # Nothing at or past the batch offset was acknowledged, so truncating there undoes it everywhere
+        self.rollback_chunk(chunk_handle, offset)
+        list(self.replication_executor.map(lambda sec_addr: self.rollback_secondary(sec_addr, chunk_handle, offset),
+                                           secondaries))
+        self.log.warning("Write failed; rolled back", chunk=chunk_handle, offset=offset)
+        failed = {"status": "error", "message": "Write failed"}
+        return [failed if response["status"] == "ok" else response for response in responses]
+
+    def apply_secondary_write(self, request, payload):
+        chunk_handle = request.get("chunk_handle")
+        version = request.get("version", 0)
+        local_version = self.chunk_versions.get(chunk_handle, 0)
+        if version != local_version:
+            self.log.warning("Rejected write with a different version", chunk=chunk_handle, version=version,
+                             local_version=local_version)
+            return {"status": "error", "message": "Chunk version mismatch"}, b""
+        if chunk_handle in self.sealed_chunks:
+            self.log.warning("Rejected write to a sealed chunk", chunk=chunk_handle)
+            return {"status": "error", "message": "Chunk is sealed"}, b""
+        self.open_for_write(chunk_handle)
+
+        # Records name staged data or take their bytes from the inline payload, in order
+        parts = []
+        position = 0
+        for record in request.get("records", []):
+            if "data_id" in record:
+                data = self.staging_buffer.get(record["data_id"])
+                if data is None:
+                    return {"status": "error", "message": f"Data {record['data_id']} not staged"}, b""
+            else:
+                data = payload[position:position + record["length"]]
+                position += record["length"]
+            parts.append(data)
+
+        offset = self.append_to_chunk(chunk_handle, b"".join(parts), request.get("offset"))
+        if offset is None:
+            self.log.error("Write failed on secondary", chunk=chunk_handle)
+            return {"status": "error", "message": "Write failed"}, b""
+        for record in request.get("records", []):
+            self.staging_buffer.discard(record.get("data_id"))
+        self.log.debug("Write applied on secondary", chunk=chunk_handle, offset=offset)
+        return {"status": "ok", "offset": offset}, b""
+
+    def reconcile_chunk(self, chunk_handle, secondaries):
+        # A new primary cuts every replica back to the shortest one: acknowledged data is on
+        # all of them, so anything past that is the tail of a mutation that never committed
+        self.open_for_write(chunk_handle)
+        lengths = [self.append_engine.size(self.get_chunk_path(chunk_handle))]
+        reachable = []
+        for address in secondaries:
+            try:
+                response, _ = self.connection_pool.request(address, {"type": "chunk_length", "chunk_handle": chunk_handle})
+            except Exception as e:
+                self.log.warning("Error getting chunk length", chunk=chunk_handle, peer=address, error=e)
+                continue
+            if response.get("status") == "ok":
+                lengths.append(response["length"])
+                reachable.append(address)
+        committed = min(lengths)
+        if max(lengths) > committed:
+            self.log.info("Truncating replicas", chunk=chunk_handle, length=committed)
+            self.rollback_chunk(chunk_handle, committed)
+            for address in reachable:
+                self.rollback_secondary(address, chunk_handle, committed)
+
+    def replicate_chunk(self, chunk_handle, source, length, version, bandwidth=None):
+        # Pull the chunk piece by piece, pacing the pieces to stay within bandwidth bytes per
+        # second, then move the finished copy into place
+        file_path = self.get_chunk_path(chunk_handle)
+        temp_path = file_path + ".copy"
+        started = time.monotonic()
+        try:
+            with open(temp_path, 'wb') as f:
+                offset = 0
+                while offset < length:
+                    request = {"type": "read", "chunk_handle": chunk_handle, "offset": offset,
+                               "length": min(REPLICATION_PIECE_SIZE, length - offset)}
+                    if self.wire_compression:
+                        request["accept_encoding"] = [self.wire_compression]
+                    response, data = self.connection_pool.request(source, request)
+                    if response.get("status") != "ok" or not data:
+                        raise ValueError(f"Source {source} could not serve offset {offset}: {response.get('message')}")
+                    f.write(data)
+                    offset += len(data)
+                    if bandwidth:
+                        ahead = offset / bandwidth - (time.monotonic() - started)
+                        if ahead > 0:
+                            time.sleep(ahead)
+                f.flush()
+                os.fsync(f.fileno())
+        except (OSError, ValueError):
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        self.install_chunk(chunk_handle, temp_path)
+        self.set_chunk_version(chunk_handle, version)
+        self.log.info("Copied chunk", chunk=chunk_handle, bytes=length, source=f"{source[0]}:{source[1]}")
+
+    def install_chunk(self, chunk_handle, temp_path):
+        # Move a finished, synced copy into place as a sealed chunk, replacing any older one
+        file_path = self.get_chunk_path(chunk_handle)
+        with self.storage_lock:
+            self.append_engine.discard(file_path)
+            for path in (checksum_path(file_path), self.get_compressed_path(chunk_handle)):
+                if os.path.exists(path):
+                    os.remove(path)
+            os.replace(temp_path, file_path)
+            self.chunks[chunk_handle] = file_path
+            self.chunk_access[chunk_handle] = time.monotonic()
+        self.sealed_chunks.add(chunk_handle)
+
+    def read_sealed_chunk(self, chunk_handle, length):
+        # The first length bytes of a local chunk, checked against their checksums
+        with self.chunk_in_use(chunk_handle) as path:
+            if path is None:
+                raise ValueError(f"Chunk {chunk_handle} not found on server")
+            if path.endswith(".chunkz"):
+                data = CompressedChunk(path).read(0, length)
+            else:
+                with open(path, 'rb') as f:
+                    data = f.read(length)
+                if not self.append_engine.verify(path, 0, len(data)):
+                    threading.Thread(target=self.report_corrupt_chunk, args=(chunk_handle,), daemon=True).start()
+                    raise ValueError(f"Chunk {chunk_handle} is corrupt on this server")
+        if len(data) != length:
+            raise ValueError(f"Chunk {chunk_handle} holds {len(data)} bytes, expected {length}")
+        return data
+
+    def encode_chunk(self, chunk_handle, length, data_shards, parity_shards, destinations, bandwidth=None):
+        # Cut the chunk into fragments and send fragment i to destinations[i], pacing the sends
+        # to stay within bandwidth bytes per second. A fragment for this server is stored directly
+        started = time.monotonic()
+        fragments = ReedSolomon(data_shards, parity_shards).encode(self.read_sealed_chunk(chunk_handle, length))
+        sent = 0
+        for index, (address, fragment) in enumerate(zip(destinations, fragments)):
+            handle = fragment_handle(chunk_handle, index)
+            if address == (self.server_address, self.server_port):
+                self.store_fragment(handle, fragment)
+                continue
+            response, _ = self.connection_pool.request(address, {"type": "store_fragment", "chunk_handle": handle},
+                                                       fragment)
+            if response.get("status") != "ok":
+                raise ValueError(f"{address[0]}:{address[1]} could not store {handle}: {response.get('message')}")
+            sent += len(fragment)
+            if bandwidth:
+                ahead = sent / bandwidth - (time.monotonic() - started)
+                if ahead > 0:
+                    time.sleep(ahead)
+        self.log.info("Erasure coded chunk", chunk=chunk_handle, bytes=length, fragments=len(fragments),
+                      seconds=round(time.monotonic() - started, 2))
+
+    def store_fragment(self, handle, data):
+        # Fragments arrive whole and are never appended to, so they are stored sealed
+        temp_path = self.get_chunk_path(handle) + ".copy"
+        try:
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        self.install_chunk(handle, temp_path)
+        self.log.debug("Stored fragment", chunk=handle, bytes=len(data))
+
+    def rebuild_fragment(self, chunk_handle, index, data_shards, parity_shards, sources):
+        # Fetch whole fragments from the other servers, data_shards at a time and in parallel,
+        # until enough have arrived to rebuild fragment index
+        def fetch(source_index):
+            request = {"type": "read", "chunk_handle": fragment_handle(chunk_handle, source_index)}
+            if self.wire_compression:
+                request["accept_encoding"] = [self.wire_compression]
+            try:
+                response, data = self.connection_pool.request(sources[source_index], request)
+            except OSError as e:
+                return None, str(e)
+            if response.get("status") != "ok":
+                return None, response.get("message")
+            return data, None
+
+        remaining = sorted(sources)
+        fragments = {}
+        while len(fragments) < data_shards and remaining:
+            batch, remaining = remaining[:data_shards - len(fragments)], remaining[data_shards - len(fragments):]
+            for source_index, (data, error) in zip(batch, self.replication_executor.map(fetch, batch)):
+                if data is None:
+                    self.log.warning("Could not fetch fragment", chunk=chunk_handle, index=source_index, error=error)
+                else:
+                    fragments[source_index] = data
+        if len(fragments) < data_shards:
+            raise ValueError(f"Only {len(fragments)} of the {data_shards} fragments needed could be fetched")
+        if len({len(data) for data in fragments.values()}) > 1:
+            raise ValueError("Fetched fragments differ in length")
+        self.store_fragment(fragment_handle(chunk_handle, index),
+                            ReedSolomon(data_shards, parity_shards).reconstruct(fragments, index))
+        self.log.info("Rebuilt fragment", chunk=chunk_handle, index=index, sources=sorted(fragments))
+
+    def get_chunk_length(self, chunk_handle):
+        path = self.chunks.get(chunk_handle)
+        if self.is_compressed(chunk_handle):
+            return CompressedChunk(path).length
+        if path and os.path.exists(path):
+            return os.path.getsize(path)
+        return 0
+
+    def create_chunk(self, chunk_handle):
+        if self.is_compressed(chunk_handle):
+            return
+        file_path = self.get_chunk_path(chunk_handle)
+        if not os.path.exists(file_path):
+            open(file_path, 'a').close()
+        self.chunks[chunk_handle] = file_path
+
+    def append_to_chunk(self, chunk_handle, content, offset=None):
+        # Returns the offset the content was committed at, or None if the append failed
+        try:
+            file_path = self.get_chunk_path(chunk_handle)
+            # The append engine keeps the chunk open, creating it on the first write, and
+            # returns only once the batch holding this append is synced
+            offset = self.append_engine.append(file_path, content, offset)
+            self.chunks[chunk_handle] = file_path
+            self.chunk_access[chunk_handle] = time.monotonic()
+            self.log.debug("Appended to chunk", chunk=chunk_handle, offset=offset, bytes=len(content))
+            return offset
         except Exception as e:
-            print(f"Error getting secondaries: {e}")
-            return []
+            self.log.error("Error writing to chunk", chunk=chunk_handle, error=e)
+            return None
+
+    def forward_in_threads(self, secondaries, write_data, payload):
+        return [self.replication_executor.submit(self.forward_to_secondary, address, write_data, payload)
+                for address in secondaries]
 
-    def forward_to_secondary(self, host, port, file_name, content):
+    def forward_to_secondary(self, address, write_data, payload):
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sec_sock:
-                sec_sock.connect((host, port))
-                write_data = {
-                    "type": "write",
-                    "file_name": file_name,
-                    "data": content,
-                    "server": "secondary"
-                }
-                sec_sock.sendall(json.dumps(write_data).encode())
+            response, _ = self.connection_pool.request(address, write_data, payload)
+            return response.get("status") == "ok"
+        except Exception as e:
+            self.log.warning("Error communicating with secondary", peer=address, error=e)
+            return False
 
-                response = sec_sock.recv(4096).decode()
-                return response == "Write success"
+    async def forward_to_secondary_async(self, address, write_data, payload):
+        try:
+            response, _ = await self.async_connection_pool.request(address, write_data, payload)
+            return response.get("status") == "ok"
         except Exception as e:
-            print(f"Error communicating with secondary: {e}")
+            self.log.warning("Error communicating with secondary", peer=address, error=e)
             return False
 
-    def rollback_file(self, file_name):
-        # Logic to rollback changes locally (e.g., restore from a backup or clear)
-        print(f"Rolling back changes to {file_name} on this server")
+    def rollback_chunk(self, chunk_handle, offset):
+        # Truncating to where the failed mutation started is all a rollback takes
+        try:
+            self.open_for_write(chunk_handle)
+            self.append_engine.truncate(self.get_chunk_path(chunk_handle), offset)
+            self.log.info("Rolled back chunk", chunk=chunk_handle, offset=offset)
+            return True
+        except (OSError, TypeError) as e:
+            self.log.error("Error rolling back chunk", chunk=chunk_handle, error=e)
+            return False
 
-    def rollback_secondary(self, sec_addr, file_name):
+    def rollback_secondary(self, sec_addr, chunk_handle, offset):
         try:
-            sec_host, sec_port = sec_addr
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sec_sock:
-                sec_sock.connect((sec_host, int(sec_port)))
-                rollback_request = json.dumps({"type": "rollback", "file_name": file_name})
-                sec_sock.sendall(rollback_request.encode())
+            self.connection_pool.request(sec_addr, {"type": "rollback", "chunk_handle": chunk_handle, "offset": offset})
         except Exception as e:
-            print(f"Error rolling back on secondary {sec_addr}: {e}")
+            self.log.warning("Error rolling back on secondary", chunk=chunk_handle, peer=sec_addr, error=e)
 
 
-def start_server_thread(server_id, server_address, server_port):
-    server = Server(server_id)
+def start_server_thread(server_id, server_address, server_port, config=None):
+    server = Server(server_id, config)
     server.server_address = server_address  # Set the correct server address
     server.server_port = server_port        # Set the correct server port
     server.start()
@@ -226,8 +1117,10 @@ if __name__ == "__main__":
     with open("mserver_config.json", "r") as config_file:
         config_data = json.load(config_file)
     
-    # Get the list of chunk servers
+    # Get the list of chunk servers; names given on the command line start just those
     chunk_servers = config_data["chunk_servers"]
+    if len(sys.argv) > 1:
+        chunk_servers = [server_info for server_info in chunk_servers if server_info["name"] in sys.argv[1:]]
     
     # Start each server in its own thread
     threads = []
@@ -237,7 +1130,7 @@ if __name__ == "__main__":
         server_port = server_info["port"]
 
         # Create and start a thread for each server
-        thread = threading.Thread(target=start_server_thread, args=(server_id, server_address, server_port))
+        thread = threading.Thread(target=start_server_thread, args=(server_id, server_address, server_port, config_data))
         thread.start()
         threads.append(thread)
 
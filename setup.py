@@ -1,6 +1,7 @@
 import os
 import json
-import shutil
+
+DEFAULT_CHUNK_SIZE = 64 * 1024 * 1024  # 64 MB chunks
 
 def load_json_config(config_file):
     try:
@@ -12,7 +13,32 @@ def load_json_config(config_file):
         print(f"Error loading config file: {e}")
         return None
 
-def copy_files_to_replicas(config, main_directory):
+def assign_chunk_handles(config, main_directory, chunk_size):
+    # Convert legacy whole-file entries into per-chunk entries with fresh handles
+    next_handle = 1
+    for details in config.values():
+        for chunk in details.get('chunks', []):
+            next_handle = max(next_handle, int(chunk['handle'], 16) + 1)
+
+    for file_name, details in config.items():
+        if 'chunks' in details:
+            continue
+        file_path = os.path.join(main_directory, file_name)
+        file_size = os.path.getsize(file_path) if os.path.exists(file_path) else 0
+        chunk_count = max(1, -(-file_size // chunk_size))
+
+        chunks = []
+        for _ in range(chunk_count):
+            chunks.append({
+                "handle": f"{next_handle:016x}",
+                "primary": details.get('primary'),
+                "replicas": details.get('replicas', [])
+            })
+            next_handle += 1
+        config[file_name] = {"chunks": chunks}
+        print(f"Assigned {chunk_count} chunk(s) to '{file_name}'")
+
+def copy_files_to_replicas(config, main_directory, chunk_size):
     if not os.path.exists(main_directory):
         print(f"Error: Main directory '{main_directory}' does not exist.")
         return
@@ -24,20 +50,21 @@ def copy_files_to_replicas(config, main_directory):
         if not os.path.exists(file_path):
             print(f"Error: File '{file_name}' not found in the main directory.")
             continue
-        
-        # Copy the file to each of the replica directories
-        replicas = details.get('replicas', [])
-        for server in replicas:
-            # Create the directory for the server if it doesn't exist
-            server_directory = f"{server}_files"
-            os.makedirs(server_directory, exist_ok=True)
-            
-            # Define the destination path
-            destination_path = os.path.join(server_directory, file_name)
-
-            # Copy the file
-            shutil.copy(file_path, destination_path)
-            print(f"Copied '{file_name}' to '{server_directory}'")
+
+        # Split the file into fixed-size chunks and copy each one to its replicas
+        with open(file_path, 'rb') as source:
+            for chunk in details.get('chunks', []):
+                chunk_data = source.read(chunk_size)
+                for server in chunk.get('replicas', []):
+                    # Create the directory for the server if it doesn't exist
+                    server_directory = f"{server}_files"
+                    os.makedirs(server_directory, exist_ok=True)
+
+                    # Chunks are stored by handle
+                    destination_path = os.path.join(server_directory, f"{chunk['handle']}.chunk")
+                    with open(destination_path, 'wb') as destination:
+                        destination.write(chunk_data)
+                    print(f"Copied chunk {chunk['handle']} of '{file_name}' to '{server_directory}'")
 
 def main():
     config_file = "files_metadata.json"  
@@ -45,10 +72,16 @@ def main():
 
     # Load the JSON configuration file
     config = load_json_config(config_file)
+    server_config = load_json_config("mserver_config.json") or {}
+    chunk_size = server_config.get("chunk_size", DEFAULT_CHUNK_SIZE)
 
     if config:
-        # Copy the files to the respective replica directories
-        copy_files_to_replicas(config, main_directory)
+        assign_chunk_handles(config, main_directory, chunk_size)
+        with open(config_file, 'w') as file:
+            json.dump(config, file, indent=2)
+
+        # Copy the chunks to the respective replica directories
+        copy_files_to_replicas(config, main_directory, chunk_size)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,239 @@
+import os
+import threading
+import time
+
+import pytest
+
+from append_engine import AppendEngine, ChunkAppender, MutationBatcher
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.001)
+
+
+def run_threads(target, count):
+    # Runs target(i) on count threads; returns what each returned or raised
+    results = [None] * count
+
+    def run(i):
+        try:
+            results[i] = target(i)
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=run, args=(i,), daemon=True) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads, results
+
+
+def join(threads):
+    for thread in threads:
+        thread.join(5)
+        assert not thread.is_alive()
+
+
+def hold_first_sync(monkeypatch, appender, fail_second=False):
+    # The chunk's first fdatasync waits until released, so appends made meanwhile queue up as
+    # one batch for the next leader; with fail_second that batch's sync fails and later ones
+    # succeed, so an append that missed the failure would go on to commit
+    release = threading.Event()
+    calls = []
+    real_fdatasync = os.fdatasync
+
+    def fdatasync(fd):
+        if fd != appender.fd:
+            return real_fdatasync(fd)
+        calls.append(fd)
+        if len(calls) == 1:
+            release.wait(5)
+        elif len(calls) == 2 and fail_second:
+            raise OSError("disk gone")
+        real_fdatasync(fd)
+
+    monkeypatch.setattr(os, "fdatasync", fdatasync)
+    return release, calls
+
+
+def test_concurrent_appends_get_disjoint_contiguous_offsets(tmp_path):
+    path = str(tmp_path / "0000000000000001.chunk")
+    appender = ChunkAppender(path)
+    records = [bytes([i]) * (100 + i) for i in range(32)]
+    threads, offsets = run_threads(lambda i: appender.append(records[i]), len(records))
+    join(threads)
+    spans = sorted((offset, len(records[i])) for i, offset in enumerate(offsets))
+    position = 0
+    for offset, length in spans:
+        assert offset == position
+        position += length
+    assert appender.size == appender.durable_size == position
+    appender.close()
+    with open(path, 'rb') as f:
+        data = f.read()
+    for i, offset in enumerate(offsets):
+        assert data[offset:offset + len(records[i])] == records[i]
+
+
+def test_appends_queued_behind_a_flush_share_one_sync(tmp_path, monkeypatch):
+    path = str(tmp_path / "0000000000000001.chunk")
+    appender = ChunkAppender(path)
+    release, calls = hold_first_sync(monkeypatch, appender)
+    first, first_result = run_threads(lambda i: appender.append(b"a" * 10), 1)
+    wait_for(lambda: calls)
+    rest, offsets = run_threads(lambda i: appender.append(b"b" * 10), 5)
+    wait_for(lambda: len(appender.pending) == 5)
+    release.set()
+    join(first + rest)
+    assert first_result == [0]
+    assert sorted(offsets) == [10, 20, 30, 40, 50]
+    assert len(calls) == 2
+    appender.close()
+
+
+def test_failed_sync_fails_the_whole_batch_and_truncates(tmp_path, monkeypatch):
+    path = str(tmp_path / "0000000000000001.chunk")
+    appender = ChunkAppender(path)
+    release, calls = hold_first_sync(monkeypatch, appender, fail_second=True)
+    first, first_result = run_threads(lambda i: appender.append(b"a" * 10), 1)
+    wait_for(lambda: calls)
+    rest, results = run_threads(lambda i: appender.append(b"b" * 10), 4)
+    wait_for(lambda: len(appender.pending) == 4)
+    release.set()
+    join(first + rest)
+    assert first_result == [0]
+    assert all(isinstance(result, OSError) for result in results)
+    assert appender.size == appender.durable_size == 10
+    assert os.path.getsize(path) == 10
+    monkeypatch.undo()
+    assert appender.append(b"c" * 10) == 10
+    assert appender.verify(0, 20)
+    appender.close()
+    with open(path, 'rb') as f:
+        assert f.read() == b"a" * 10 + b"c" * 10
+
+
+def test_failed_write_leaves_no_partial_data(tmp_path, monkeypatch):
+    path = str(tmp_path / "0000000000000001.chunk")
+    appender = ChunkAppender(path)
+    appender.append(b"a" * 10)
+    real_write = os.write
+    calls = []
+
+    def short_write(fd, data):
+        # Writes half the buffer, then the disk fills up
+        calls.append(fd)
+        if len(calls) > 1:
+            raise OSError("no space left")
+        return real_write(fd, data[:len(data) // 2])
+
+    monkeypatch.setattr(os, "write", short_write)
+    with pytest.raises(OSError):
+        appender.append(b"b" * 100)
+    monkeypatch.undo()
+    assert os.path.getsize(path) == appender.size == 10
+    assert appender.append(b"c" * 5) == 10
+    assert appender.verify(0, 15)
+    appender.close()
+
+
+def test_offset_append_cuts_a_stale_tail(tmp_path):
+    path = str(tmp_path / "0000000000000001.chunk")
+    appender = ChunkAppender(path)
+    appender.append(b"a" * 10)
+    appender.append(b"stale")
+    assert appender.append(b"b" * 10, offset=10) == 10
+    assert appender.size == 20
+    assert appender.verify(0, 20)
+    appender.close()
+    with open(path, 'rb') as f:
+        assert f.read() == b"a" * 10 + b"b" * 10
+
+
+def test_offset_append_rejects_a_gap(tmp_path):
+    path = str(tmp_path / "0000000000000001.chunk")
+    appender = ChunkAppender(path)
+    appender.append(b"a" * 10)
+    with pytest.raises(OSError, match="gap"):
+        appender.append(b"b", offset=11)
+    assert appender.size == 10
+    assert appender.append(b"b", offset=10) == 10
+    appender.close()
+
+
+def test_reopen_drops_bytes_without_checksums(tmp_path):
+    path = str(tmp_path / "0000000000000001.chunk")
+    appender = ChunkAppender(path)
+    appender.append(b"a" * 10)
+    appender.close()
+    with open(path, 'ab') as f:
+        f.write(b"torn")
+    appender = ChunkAppender(path)
+    assert appender.size == 10
+    assert os.path.getsize(path) == 10
+    appender.close()
+
+
+def test_engine_reopens_evicted_appenders(tmp_path):
+    engine = AppendEngine(max_open_files=1)
+    first = str(tmp_path / "0000000000000001.chunk")
+    second = str(tmp_path / "0000000000000002.chunk")
+    assert engine.append(first, b"a" * 10) == 0
+    assert engine.append(second, b"b" * 10) == 0
+    assert list(engine.appenders) == [second]
+    assert engine.append(first, b"c" * 10) == 10
+    assert engine.size(first) == 20
+    engine.truncate(first, 5)
+    assert engine.size(first) == 5
+    assert engine.verify(first, 0, 5)
+    with pytest.raises(FileNotFoundError):
+        engine.verify(str(tmp_path / "0000000000000003.chunk"), 0, 1)
+    engine.close()
+
+
+def hold_first_batch(fail_later=False):
+    # Returns an apply_batch whose first call waits until released, so records submitted
+    # meanwhile are applied together as the next batch
+    release = threading.Event()
+    batches = []
+
+    def apply_batch(records):
+        batches.append(list(records))
+        if len(batches) == 1:
+            release.wait(5)
+        elif fail_later:
+            raise OSError("mutation failed")
+        return [record * 2 for record in records]
+
+    return apply_batch, release, batches
+
+
+def test_batcher_applies_records_queued_behind_a_batch_together():
+    batcher = MutationBatcher()
+    apply_batch, release, batches = hold_first_batch()
+    first, first_result = run_threads(lambda i: batcher.submit(100, apply_batch), 1)
+    wait_for(lambda: batches)
+    rest, results = run_threads(lambda i: batcher.submit(i, apply_batch), 4)
+    wait_for(lambda: len(batcher.queue) == 4)
+    release.set()
+    join(first + rest)
+    assert first_result == [200]
+    assert results == [0, 2, 4, 6]
+    assert len(batches) == 2
+    assert sorted(batches[1]) == [0, 1, 2, 3]
+
+
+def test_batcher_failure_fails_every_record_in_the_batch():
+    batcher = MutationBatcher()
+    apply_batch, release, batches = hold_first_batch(fail_later=True)
+    first, first_result = run_threads(lambda i: batcher.submit(100, apply_batch), 1)
+    wait_for(lambda: batches)
+    rest, results = run_threads(lambda i: batcher.submit(i, apply_batch), 3)
+    wait_for(lambda: len(batcher.queue) == 3)
+    release.set()
+    join(first + rest)
+    assert first_result == [200]
+    assert all(isinstance(result, OSError) for result in results)
+    assert batcher.submit(7, lambda records: [record for record in records]) == 7
@@ -0,0 +1,116 @@
+import os
+import struct
+import zlib
+
+from checksum import HEADER_FORMAT, HEADER_SIZE, BlockChecksums, checksum_path, verify_blocks
+
+BLOCK_SIZE = 16
+
+
+def block_crcs(data):
+    return [zlib.crc32(data[start:start + BLOCK_SIZE]) for start in range(0, len(data), BLOCK_SIZE)]
+
+
+def append(checksums, data):
+    # What an append does: write the data, then persist and apply the extended checksums
+    with open(checksums.chunk_path, 'ab') as f:
+        f.write(data)
+    index, values = checksums.extend(data)
+    size = checksums.size + len(data)
+    checksums.persist(index, values, size)
+    checksums.apply(index, values, size)
+
+
+def test_crc_file_format(tmp_path):
+    chunk = tmp_path / "0000000000000001.chunk"
+    data = os.urandom(3 * BLOCK_SIZE + 5)
+    chunk.write_bytes(data)
+    checksums = BlockChecksums(str(chunk), BLOCK_SIZE)
+    assert checksums.load(len(data)) == len(data)
+    checksums.close()
+    assert checksum_path(str(chunk)) == str(tmp_path / "0000000000000001.crc")
+    stored = (tmp_path / "0000000000000001.crc").read_bytes()
+    assert stored == struct.pack(HEADER_FORMAT, len(data)) + struct.pack("!4I", *block_crcs(data))
+
+
+def test_appends_extend_the_tail_block(tmp_path):
+    chunk = tmp_path / "0000000000000001.chunk"
+    chunk.write_bytes(b"")
+    checksums = BlockChecksums(str(chunk), BLOCK_SIZE)
+    checksums.load(0)
+    data = b""
+    for piece in (b"a" * 5, b"b" * 20, b"c" * 11, b"d" * 40):
+        append(checksums, piece)
+        data += piece
+        assert checksums.checksums == block_crcs(data)
+    checksums.close()
+
+    reloaded = BlockChecksums(str(chunk), BLOCK_SIZE)
+    assert reloaded.load(len(data)) == len(data)
+    assert reloaded.checksums == block_crcs(data)
+    reloaded.close()
+
+
+def test_corrupted_block_is_found(tmp_path):
+    chunk = tmp_path / "0000000000000001.chunk"
+    data = bytearray(os.urandom(5 * BLOCK_SIZE + 3))
+    chunk.write_bytes(bytes(data))
+    checksums = BlockChecksums(str(chunk), BLOCK_SIZE)
+    checksums.load(len(data))
+    assert verify_blocks(str(chunk), 0, checksums.checksums, checksums.size, BLOCK_SIZE) is None
+
+    data[2 * BLOCK_SIZE + 7] ^= 0x01
+    chunk.write_bytes(bytes(data))
+    assert verify_blocks(str(chunk), 0, checksums.checksums, checksums.size, BLOCK_SIZE) == 2
+    # A ranged read only checks the blocks it touches
+    first, values, covered = checksums.snapshot(3 * BLOCK_SIZE, 2 * BLOCK_SIZE)
+    assert verify_blocks(str(chunk), first, values, covered, BLOCK_SIZE) is None
+    first, values, covered = checksums.snapshot(BLOCK_SIZE + 4, BLOCK_SIZE)
+    assert verify_blocks(str(chunk), first, values, covered, BLOCK_SIZE) == 2
+    checksums.close()
+
+
+def test_unflushed_tail_is_not_covered(tmp_path):
+    # Data past the size the .crc file covers never finished its flush
+    chunk = tmp_path / "0000000000000001.chunk"
+    data = os.urandom(2 * BLOCK_SIZE)
+    chunk.write_bytes(data)
+    checksums = BlockChecksums(str(chunk), BLOCK_SIZE)
+    checksums.load(len(data))
+    checksums.close()
+    chunk.write_bytes(data + b"torn")
+    reloaded = BlockChecksums(str(chunk), BLOCK_SIZE)
+    assert reloaded.load(len(data) + 4) == len(data)
+    reloaded.close()
+
+
+def test_short_crc_file_is_rebuilt(tmp_path):
+    chunk = tmp_path / "0000000000000001.chunk"
+    data = os.urandom(3 * BLOCK_SIZE)
+    chunk.write_bytes(data)
+    crc = tmp_path / "0000000000000001.crc"
+    crc.write_bytes(struct.pack(HEADER_FORMAT, len(data)) + struct.pack("!I", 0))
+    checksums = BlockChecksums(str(chunk), BLOCK_SIZE)
+    assert checksums.load(len(data)) == len(data)
+    assert checksums.checksums == block_crcs(data)
+    checksums.close()
+    assert len(crc.read_bytes()) == HEADER_SIZE + 3 * 4
+
+
+def test_truncate_rechecksums_the_new_tail_block(tmp_path):
+    chunk = tmp_path / "0000000000000001.chunk"
+    data = os.urandom(3 * BLOCK_SIZE + 9)
+    chunk.write_bytes(data)
+    checksums = BlockChecksums(str(chunk), BLOCK_SIZE)
+    checksums.load(len(data))
+    size = BLOCK_SIZE + 6
+    with open(chunk, 'r+b') as f:
+        f.truncate(size)
+    checksums.truncate(size)
+    assert checksums.size == size
+    assert checksums.checksums == block_crcs(data[:size])
+    checksums.close()
+    reloaded = BlockChecksums(str(chunk), BLOCK_SIZE)
+    assert reloaded.load(size) == size
+    assert reloaded.checksums == block_crcs(data[:size])
+    reloaded.close()
@@ -0,0 +1,105 @@
+import os
+
+import pytest
+
+from compression import (CompressedChunk, decode_payload, encode_payload, inflate_chunk, negotiate,
+                         write_compressed_chunk)
+
+BLOCK_SIZE = 1024
+
+
+def chunk_data():
+    # Compressible blocks with an incompressible one in the middle, which is stored raw
+    return (b"log line 42\n" * 300)[:3 * BLOCK_SIZE] + os.urandom(BLOCK_SIZE) + b"abc" * 700
+
+
+def write_chunk(tmp_path, data, codec_name="zlib"):
+    raw = tmp_path / "0000000000000001.chunk"
+    raw.write_bytes(data)
+    path = str(tmp_path / "0000000000000001.chunkz")
+    write_compressed_chunk(str(raw), path, codec_name, BLOCK_SIZE)
+    return path
+
+
+@pytest.mark.parametrize("codec_name", ["zlib", "lzma"])
+def test_compressed_chunk_round_trip(tmp_path, codec_name):
+    data = chunk_data()
+    chunk = CompressedChunk(write_chunk(tmp_path, data, codec_name))
+    assert chunk.length == len(data)
+    assert {flag for _, _, flag, _ in chunk.index} == {0, 1}
+    assert chunk.read() == data
+    for offset, length in [(0, 1), (BLOCK_SIZE - 1, 2), (1500, 4000), (len(data) - 10, 100), (len(data), 5)]:
+        assert chunk.read(offset, length) == data[offset:offset + length]
+    assert chunk.verify()
+
+
+def test_corrupted_block(tmp_path):
+    data = chunk_data()
+    path = write_chunk(tmp_path, data)
+    chunk = CompressedChunk(path)
+    offset, stored_length, _, _ = chunk.index[2]
+    with open(path, 'r+b') as f:
+        f.seek(offset + stored_length // 2)
+        byte = f.read(1)
+        f.seek(-1, os.SEEK_CUR)
+        f.write(bytes([byte[0] ^ 0xFF]))
+
+    chunk = CompressedChunk(path)
+    assert not chunk.verify()
+    with pytest.raises(ValueError):
+        chunk.read(2 * BLOCK_SIZE + 10, 10)
+    with pytest.raises(ValueError):
+        chunk.read()
+    # Reads of the other blocks are unaffected
+    assert chunk.read(0, 2 * BLOCK_SIZE) == data[:2 * BLOCK_SIZE]
+    assert chunk.read(3 * BLOCK_SIZE, 100) == data[3 * BLOCK_SIZE:3 * BLOCK_SIZE + 100]
+
+    raw_path = str(tmp_path / "inflated.chunk")
+    with pytest.raises(ValueError):
+        inflate_chunk(path, raw_path)
+    assert not os.path.exists(raw_path)
+
+
+def test_corrupted_raw_block(tmp_path):
+    # Blocks kept raw are still checked against the crc32 in the index
+    data = chunk_data()
+    path = write_chunk(tmp_path, data)
+    chunk = CompressedChunk(path)
+    index = next(index for index, (_, _, flag, _) in enumerate(chunk.index) if flag == 0)
+    offset = chunk.index[index][0]
+    with open(path, 'r+b') as f:
+        f.seek(offset)
+        f.write(b"\x00" if f.read(1) != b"\x00" else b"\x01")
+    assert not CompressedChunk(path).verify()
+
+
+def test_inflate_chunk(tmp_path):
+    data = chunk_data()
+    path = write_chunk(tmp_path, data)
+    raw_path = tmp_path / "inflated.chunk"
+    inflate_chunk(path, str(raw_path))
+    assert raw_path.read_bytes() == data
+
+
+def test_not_a_compressed_chunk(tmp_path):
+    path = tmp_path / "0000000000000001.chunk"
+    path.write_bytes(b"plain chunk data")
+    with pytest.raises(ValueError):
+        CompressedChunk(str(path))
+
+
+@pytest.mark.parametrize("codec_name", ["zlib", "lzma"])
+def test_wire_payload_round_trip(codec_name):
+    payload = chunk_data() * 30
+    header = {}
+    encoded = encode_payload(header, payload, codec_name)
+    assert header["encoding"] == codec_name
+    assert len(encoded) < len(payload)
+    assert decode_payload(header, encoded) == payload
+    assert decode_payload({}, payload) == payload
+
+
+def test_negotiate():
+    assert negotiate(["brotli", "lzma", "zlib"]) == "lzma"
+    assert negotiate(["brotli"]) is None
+    assert negotiate(None) is None
@@ -0,0 +1,58 @@
+import itertools
+import os
+
+import pytest
+
+from erasure import ReedSolomon, fragment_handle, parse_fragment_handle, shard_size
+
+CODES = [(3, 2), (2, 1), (4, 3), (1, 2)]
+
+
+@pytest.mark.parametrize("data_shards,parity_shards", CODES)
+@pytest.mark.parametrize("length", [0, 1, 1000, 3 * 1024 + 7])
+def test_decode_from_any_data_shards_fragments(data_shards, parity_shards, length):
+    code = ReedSolomon(data_shards, parity_shards)
+    data = os.urandom(length)
+    fragments = code.encode(data)
+    assert len(fragments) == data_shards + parity_shards
+    assert all(len(fragment) == shard_size(length, data_shards) for fragment in fragments)
+    for chosen in itertools.combinations(range(code.total_shards), data_shards):
+        assert code.decode({index: fragments[index] for index in chosen}, length) == data
+
+
+@pytest.mark.parametrize("data_shards,parity_shards", CODES)
+def test_reconstruct_every_fragment(data_shards, parity_shards):
+    code = ReedSolomon(data_shards, parity_shards)
+    fragments = code.encode(os.urandom(5000))
+    for lost in range(code.total_shards):
+        others = [index for index in range(code.total_shards) if index != lost]
+        for chosen in itertools.combinations(others, data_shards):
+            assert code.reconstruct({index: fragments[index] for index in chosen}, lost) == fragments[lost]
+
+
+def test_decode_byte_range_of_fragments():
+    # Equal byte ranges of any data_shards fragments rebuild that range of the data fragments
+    code = ReedSolomon(3, 2)
+    fragments = code.encode(os.urandom(9000))
+    start, end = 100, 2500
+    shards = code.decode_shards({index: fragments[index][start:end] for index in (1, 3, 4)})
+    assert [bytes(shard) for shard in shards] == [fragment[start:end] for fragment in fragments[:3]]
+
+
+def test_decode_needs_data_shards_fragments():
+    code = ReedSolomon(3, 2)
+    fragments = code.encode(b"x" * 300)
+    with pytest.raises(ValueError):
+        code.decode({0: fragments[0], 4: fragments[4]}, 300)
+
+
+def test_unsupported_code():
+    with pytest.raises(ValueError):
+        ReedSolomon(0, 2)
+    with pytest.raises(ValueError):
+        ReedSolomon(200, 57)
+
+
+def test_fragment_handle_round_trip():
+    assert parse_fragment_handle(fragment_handle("000000000000002a", 4)) == ("000000000000002a", 4)
+    assert parse_fragment_handle("000000000000002a") is None
@@ -0,0 +1,145 @@
+import os
+import struct
+import zlib
+
+import pytest
+
+import oplog
+
+
+def make_state():
+    return {
+        "next_chunk_handle": 0x2b,
+        "file_chunk_mapping": {"a.txt": ["0000000000000001", "0000000000000002"], "cold.bin": ["000000000000002a"],
+                               "empty": []},
+        "chunk_replicas": {"0000000000000001": ["server1", "server2", "server3"],
+                           "0000000000000002": ["server2", "server4"],
+                           "000000000000002a": []},
+        "chunk_primaries": {"0000000000000001": "server1"},
+        "chunk_versions": {"0000000000000001": 3, "0000000000000002": 0, "000000000000002a": 7},
+        # The tail chunk of a.txt is not sealed yet
+        "chunk_lengths": {"0000000000000001": 1048576, "000000000000002a": 5000},
+        "chunk_coding": {"000000000000002a": {"data_shards": 3, "parity_shards": 2,
+                                              "fragments": ["server1", "server5", None, "server3", "server2"]}},
+    }
+
+
+def test_checkpoint_round_trip(tmp_path):
+    state = make_state()
+    oplog.write_checkpoint(str(tmp_path), state, 12)
+    with open(tmp_path / oplog.CHECKPOINT_FILE, 'rb') as f:
+        assert f.read(len(oplog.CHECKPOINT_MAGIC)) == b"GFSMETA4"
+    assert oplog.read_checkpoint(str(tmp_path)) == (state, 12)
+
+
+def test_format_3_checkpoint_still_loads(tmp_path):
+    # Format 3 is format 4 without the erasure-coded chunk section
+    state = make_state()
+    state["chunk_coding"] = {}
+    oplog.write_checkpoint(str(tmp_path), state, 5)
+    path = tmp_path / oplog.CHECKPOINT_FILE
+    body = path.read_bytes()[:-4]
+    assert body.endswith(struct.pack("!I", 0))
+    body = oplog.CHECKPOINT_MAGIC_PREFIX + b"3" + body[len(oplog.CHECKPOINT_MAGIC):-4]
+    path.write_bytes(body + struct.pack("!I", zlib.crc32(body)))
+    assert oplog.read_checkpoint(str(tmp_path)) == (state, 5)
+
+
+def test_corrupt_checkpoint(tmp_path):
+    oplog.write_checkpoint(str(tmp_path), make_state(), 1)
+    path = tmp_path / oplog.CHECKPOINT_FILE
+    data = bytearray(path.read_bytes())
+    data[len(data) // 2] ^= 0xFF
+    path.write_bytes(bytes(data))
+    with pytest.raises(ValueError):
+        oplog.read_checkpoint(str(tmp_path))
+
+
+def test_missing_checkpoint(tmp_path):
+    assert oplog.read_checkpoint(str(tmp_path)) == (None, -1)
+
+
+def test_replay_after_checkpointed_segments(tmp_path):
+    log = oplog.OperationLog(str(tmp_path))
+    log.append({"op": "add_chunk", "chunk_handle": "0000000000000001"})
+    covered = log.roll()
+    log.append({"op": "seal_chunk", "chunk_handle": "0000000000000001", "length": 10})
+    log.append({"op": "set_primary", "chunk_handle": "0000000000000002", "primary": "server1"})
+    log.close()
+    assert [operation["op"] for operation in oplog.replay_segments(str(tmp_path))] == \
+        ["add_chunk", "seal_chunk", "set_primary"]
+    assert [operation["op"] for operation in oplog.replay_segments(str(tmp_path), covered)] == \
+        ["seal_chunk", "set_primary"]
+
+
+def test_torn_tail_is_truncated(tmp_path):
+    log = oplog.OperationLog(str(tmp_path))
+    log.append({"op": "add_chunk", "chunk_handle": "0000000000000001"})
+    log.append({"op": "seal_chunk", "chunk_handle": "0000000000000001", "length": 10})
+    log.close()
+    path = oplog.segment_path(str(tmp_path), log.segment)
+    size = os.path.getsize(path)
+    with open(path, 'r+b') as f:
+        f.truncate(size - 3)
+    assert [operation["op"] for operation in oplog.replay_segments(str(tmp_path))] == ["add_chunk"]
+    assert os.path.getsize(path) < size - 3
+
+
+def test_failed_fsync_keeps_the_batch_pending(tmp_path, monkeypatch):
+    log = oplog.OperationLog(str(tmp_path))
+    log.append({"op": "add_chunk", "chunk_handle": "0000000000000001"})
+    log.wait_durable()
+    path = oplog.segment_path(str(tmp_path), log.segment)
+    durable_size = os.path.getsize(path)
+
+    fsync = os.fsync
+
+    def failing_fsync(fd):
+        raise OSError("fsync failed")
+
+    log.append({"op": "seal_chunk", "chunk_handle": "0000000000000001", "length": 10})
+    monkeypatch.setattr(os, "fsync", failing_fsync)
+    with pytest.raises(OSError):
+        log.wait_durable()
+    assert log.durable_sequence == 1
+    assert os.path.getsize(path) == durable_size
+
+    # The failed record is written again, ahead of newer ones, by the next flush
+    log.append({"op": "set_primary", "chunk_handle": "0000000000000002", "primary": "server1"})
+    monkeypatch.setattr(os, "fsync", fsync)
+    log.wait_durable()
+    assert log.durable_sequence == 3
+    log.close()
+    assert [operation["op"] for operation in oplog.replay_segments(str(tmp_path))] == \
+        ["add_chunk", "seal_chunk", "set_primary"]
+
+
+def test_partial_write_leaves_no_torn_record(tmp_path, monkeypatch):
+    log = oplog.OperationLog(str(tmp_path))
+    log.append({"op": "add_chunk", "chunk_handle": "0000000000000001"})
+    log.wait_durable()
+    path = oplog.segment_path(str(tmp_path), log.segment)
+    durable_size = os.path.getsize(path)
+
+    write = os.write
+    calls = []
+
+    def short_write(fd, data):
+        # The first call writes half the batch, the second fails
+        calls.append(len(data))
+        if len(calls) == 1:
+            return write(fd, bytes(data[:len(data) // 2]))
+        raise OSError("disk full")
+
+    log.append({"op": "seal_chunk", "chunk_handle": "0000000000000001", "length": 10})
+    log.append({"op": "add_chunk", "chunk_handle": "0000000000000002"})
+    monkeypatch.setattr(os, "write", short_write)
+    with pytest.raises(OSError):
+        log.wait_durable()
+    assert os.path.getsize(path) == durable_size
+
+    monkeypatch.setattr(os, "write", write)
+    log.wait_durable()
+    log.close()
+    assert [operation["op"] for operation in oplog.replay_segments(str(tmp_path))] == \
+        ["add_chunk", "seal_chunk", "add_chunk"]